@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Cascading fill on ragged coverage: per composite time, bytes read and the
+mean upsampling factor of filled pixels when filling from the single zMaxCov
+level against filling from every level between zMaxCov and zMax.
+
+    python benchmarks/bench_cascade.py [--coverage 0.6] [--seed 0]
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
+import mercantile
+import numpy as np
+
+import untiler
+from untiler.scripts import tile_utils, tile_sources
+
+
+class CountingSource(tile_sources.DirectorySource):
+    """
+    A directory source that counts the tiles + bytes it reads
+    """
+    def __init__(self, *args):
+        super(CountingSource, self).__init__(*args)
+        self.reads = 0
+        self.bytes = 0
+
+    def read(self, z, x, y):
+        data = super(CountingSource, self).read(z, x, y)
+        self.reads += 1
+        self.bytes += len(data)
+        return data
+
+
+def make_pyramid(path, root, zMax, coverage, seed):
+    """
+    Every tile from root down to root + 2, then each deeper tile kept
+    with a probability of coverage if its parent was kept
+    """
+    rng = np.random.RandomState(seed)
+    level = [root]
+    for z in range(root.z + 1, zMax + 1):
+        level = [t for p in level for t in mercantile.children(p)]
+        if z > root.z + 2:
+            level = [t for t in level if rng.rand() < coverage]
+        for t in level:
+            tileDir = os.path.join(path, str(t.z), str(t.x))
+            if not os.path.isdir(tileDir):
+                os.makedirs(tileDir)
+            shutil.copy('tests/fixtures/fill_img.jpg', os.path.join(tileDir, '%s.jpg' % t.y))
+
+
+def run(source, job, outputDir):
+    untiler.global_setup(source.path, {
+        'source': source,
+        'tileResolution': 256,
+        'compositezoom': job['z'],
+        'sceneTemplate': os.path.join(outputDir, '%s-%s-%s-tile.tif'),
+        'logdir': None,
+        'creation_opts': {'compress': 'lzw'},
+        'no_fill': False,
+        'decoder': 'gdal',
+        'buffer_bytes': None,
+        'resampling': 'bilinear'
+        })
+
+    source.reads = source.bytes = 0
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        untiler.streaming_tile_worker(job)
+    elapsed = time.time() - start
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        paintTiles = untiler.get_paint_tiles(job)
+
+    fills = [(up, sum((r1 - r0) * (c1 - c0) for (r0, r1), (c0, c1) in windows))
+        for _, _, _, up, _, _, windows in paintTiles if up > 1]
+    filled = sum(area for _, area in fills)
+    meanUp = sum(up * area for up, area in fills) / filled if filled else 0
+
+    return elapsed, source.reads, source.bytes, meanUp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--coverage', type=float, default=0.6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+
+    tmp = tempfile.mkdtemp()
+    try:
+        root = mercantile.tile(-122.4, 37.5, 13)
+        make_pyramid(os.path.join(tmp, 'tiles'), root, 18, args.coverage, args.seed)
+        os.mkdir(os.path.join(tmp, 'out'))
+
+        source = CountingSource(os.path.join(tmp, 'tiles'), '{z}/{x}/{y}.jpg')
+        tiler = tile_utils.TileUtils()
+        tiles = source.list_tiles()
+        jobs = list(tiler.get_sub_tiles(tiles, tiler.get_super_tiles(tiles, 14)))
+
+        print("%-16s %6s %6s | %9s %6s %10s %8s | %9s %6s %10s %8s" % (
+            'composite', 'zMax', 'zCov',
+            'single(s)', 'reads', 'bytes', 'fill up',
+            'cascade(s)', 'reads', 'bytes', 'fill up'))
+
+        for job in jobs:
+            single = dict(job)
+            single['fillTiles'] = job['maxCovTiles'] if job['zMaxCov'] else job['zMaxTiles'][:0]
+
+            results = run(source, single, os.path.join(tmp, 'out')) + run(source, job, os.path.join(tmp, 'out'))
+
+            print("%-16s %6d %6s | %9.3f %6d %10d %7.1fx | %9.3f %6d %10d %7.1fx" % (
+                '%s-%s-%s' % (job['z'], job['x'], job['y']), job['zMax'], job['zMaxCov'],
+                results[0], results[1], results[2], results[3],
+                results[4], results[5], results[6], results[7]))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Tile decode throughput (tiles/sec): GDAL dataset per tile against the pillow
+decoder, which decodes jpgs straight into a preallocated RGBA buffer and
+falls back to GDAL for everything else.
+
+    python benchmarks/bench_decode.py [--repeat N]
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+import time
+import warnings
+
+import numpy as np
+
+import untiler
+from untiler.scripts import tile_sources
+
+
+def fixture_tiles():
+    tiles = {}
+    for name in ('fill_img.jpg', 'fill_img_grey.jpg'):
+        with open('tests/fixtures/%s' % name, 'rb') as src:
+            tiles[name] = src.read()
+
+    source = tile_sources.MBTilesSource('tests/fixtures/testtiles.mbtiles')
+    z, x, y = [int(i) for i in source.list_tiles()[0]]
+    tiles['mbtiles.png'] = source.read(z, x, y)
+
+    return tiles
+
+
+def gdal_decode(data, out):
+    return untiler.make_image_array(untiler.decode_tile(data), 256)
+
+
+def pillow_decode(data, out):
+    imdata = untiler.decode_tile_pillow(data, out)
+    if imdata is None:
+        imdata = gdal_decode(data, out)
+    return imdata
+
+
+def tiles_per_second(decode, data, repeat):
+    out = np.empty((4, 256, 256), dtype=np.uint8)
+    start = time.time()
+    for _ in range(repeat):
+        decode(data, out)
+    return repeat / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+
+    print("%-20s %12s %12s %8s" % ('tile', 'gdal t/s', 'pillow t/s', 'speedup'))
+
+    for name, data in sorted(fixture_tiles().items()):
+        gdal = tiles_per_second(gdal_decode, data, args.repeat)
+        pillow = tiles_per_second(pillow_decode, data, args.repeat)
+        print("%-20s %12.0f %12.0f %7.1fx" % (name, gdal, pillow, pillow / gdal))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for TileUtils.get_fill_super_tiles: grouped counts over packed
+keys against the legacy per-fill-tile boolean scan.
+
+    python benchmarks/bench_fill.py
+"""
+from __future__ import print_function
+from __future__ import division
+import time
+
+import numpy as np
+
+from untiler.scripts import tile_utils
+
+
+def legacy_fill_super_tiles(superTiles, fillTiles, fillThresh):
+    for ct in ((np.all(superTiles == a, axis=1).sum(), a) for a in fillTiles):
+        if ct[0] != fillThresh or ct[0] == 0:
+            yield ct[1]
+
+
+def composite(children, zMax, fillDiff=2, coverage=0.9, seed=0):
+    """
+    zMax children of one composite (with some missing), their parents at
+    the fill zoom, and the fill threshold
+    """
+    rng = np.random.RandomState(seed)
+    side = int(np.sqrt(children))
+    xs, ys = np.meshgrid(np.arange(side), np.arange(side))
+    zMaxTiles = np.column_stack([np.full(xs.size, zMax), xs.ravel(), ys.ravel()])
+    zMaxTiles = zMaxTiles[rng.rand(len(zMaxTiles)) < coverage]
+
+    fillSide = side // 2 ** fillDiff
+    xs, ys = np.meshgrid(np.arange(fillSide), np.arange(fillSide))
+    fillTiles = np.column_stack([np.full(xs.size, zMax - fillDiff), xs.ravel(), ys.ravel()])
+
+    return zMaxTiles, fillTiles, 4 ** fillDiff
+
+
+def timeit(func, *args):
+    start = time.time()
+    out = [t for t in func(*args)]
+    return time.time() - start, len(out)
+
+
+def main():
+    tiler = tile_utils.TileUtils()
+
+    print("%10s %10s %12s %12s %8s" % ('children', 'fill', 'legacy (s)', 'counts (s)', 'speedup'))
+
+    for children in (4096, 16384, 65536):
+        zMaxTiles, fillTiles, fillThresh = composite(children, 20)
+        superTiles = tiler.get_super_tiles(zMaxTiles, fillTiles[0][0])
+
+        legacy, legacyCount = timeit(legacy_fill_super_tiles, superTiles, fillTiles, fillThresh)
+        counts, count = timeit(tiler.get_fill_super_tiles, superTiles, fillTiles, fillThresh)
+
+        assert count == legacyCount
+
+        print("%10d %10d %12.4f %12.4f %7.1fx" % (children, len(fillTiles), legacy, counts, legacy / counts))
+
+
+if __name__ == "__main__":
+    main()
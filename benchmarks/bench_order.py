@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Cold cache throughput of stream_dir with composites in planning (z, x, y)
+order against hilbert + morton curve order, batched into chunks. The page
+cache is dropped for every tile before each run with posix_fadvise.
+
+    python benchmarks/bench_order.py [--rootzoom 11] [--maxzoom 17] [--workers 4]
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
+import mercantile
+
+import untiler
+
+
+def make_pyramid(path, root, zMax):
+    tiles = [root]
+    level = [root]
+    for z in range(root.z + 1, zMax + 1):
+        level = [t for p in level for t in mercantile.children(p)]
+        tiles += level
+    for t in tiles:
+        tileDir = os.path.join(path, 'jpg', str(t.z), str(t.x))
+        if not os.path.isdir(tileDir):
+            os.makedirs(tileDir)
+        shutil.copy('tests/fixtures/fill_img.jpg', os.path.join(tileDir, '%s.jpg' % t.y))
+    return len(level)
+
+
+def drop_cache(path):
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            fd = os.open(os.path.join(dirpath, f), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rootzoom', type=int, default=11)
+    parser.add_argument('--maxzoom', type=int, default=17)
+    parser.add_argument('--compositezoom', type=int, default=15)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+
+    tmp = tempfile.mkdtemp()
+    try:
+        tiles = make_pyramid(os.path.join(tmp, 'tiles'), mercantile.tile(-122.4, 37.5, args.rootzoom), args.maxzoom)
+
+        print("%8s %10s %10s %12s %12s" % ('order', 'chunksize', 'time (s)', 'tiles / s', 'composites'))
+
+        for order, chunksize in (('zxy', 1), ('hilbert', 1), ('hilbert', 4), ('morton', 4)):
+            outdir = os.path.join(tmp, 'out-%s-%s' % (order, chunksize))
+            os.mkdir(outdir)
+            drop_cache(os.path.join(tmp, 'tiles'))
+
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                untiler.stream_dir(os.path.join(tmp, 'tiles'), outdir, args.compositezoom, None, None,
+                    'jpg/{z}/{x}/{y}.jpg', '{z}-{x}-{y}-tile.tif', args.workers, {}, False,
+                    order=order, chunksize=chunksize)
+            elapsed = time.time() - start
+
+            composites = len([l for l in out.getvalue().splitlines() if l.endswith('.tif')])
+            print("%8s %10d %10.2f %12.1f %12d" % (order, chunksize, elapsed, tiles / elapsed, composites))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Scaling benchmark for composite planning: the one-pass TileUtils.get_sub_tiles
+planner against the legacy per-supertile get_zoom_tiles scan.
+
+    python benchmarks/bench_planning.py [--max-tiles N]
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+import time
+
+import numpy as np
+
+from untiler.scripts import tile_utils
+
+
+def synthetic_tiles(side, compositezoom, maxzoom, seed=0):
+    """
+    A side x side grid of supertiles at compositezoom, each fully covered
+    at maxzoom - 1 with a random half of its maxzoom children present
+    """
+    rng = np.random.RandomState(seed)
+    tiles = []
+    for z, keep in ((maxzoom - 1, 1.0), (maxzoom, 0.5)):
+        n = side * 2 ** (z - compositezoom)
+        xs, ys = np.meshgrid(np.arange(n), np.arange(n))
+        zxy = np.column_stack([np.full(xs.size, z), xs.ravel(), ys.ravel()])
+        tiles.append(zxy[rng.rand(len(zxy)) < keep])
+
+    tiles = np.concatenate(tiles)
+    return tiles[rng.permutation(len(tiles))]
+
+
+def legacy_plan(tiler, tiles, superTiles):
+    for t in tiler.get_unique_tiles(superTiles):
+        tiler.get_zoom_tiles(tiles, superTiles, t)
+
+
+def vectorized_plan(tiler, tiles, superTiles):
+    for _ in tiler.get_sub_tiles(tiles, superTiles):
+        pass
+
+
+def timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--max-tiles', type=int, default=2000000)
+    parser.add_argument('--legacy-max-tiles', type=int, default=200000,
+        help="Skip the quadratic legacy path above this many tiles")
+    args = parser.parse_args()
+
+    tiler = tile_utils.TileUtils()
+    compositezoom, maxzoom = 13, 17
+
+    print("%10s %10s %12s %12s %8s" % ('tiles', 'supertiles', 'legacy (s)', 'vector (s)', 'speedup'))
+
+    side = 1
+    while True:
+        tiles = synthetic_tiles(side, compositezoom, maxzoom)
+        if len(tiles) > args.max_tiles:
+            break
+        superTiles = tiler.get_super_tiles(tiles, compositezoom)
+
+        vector = timeit(vectorized_plan, tiler, tiles, superTiles)
+        if len(tiles) <= args.legacy_max_tiles:
+            legacy = timeit(legacy_plan, tiler, tiles, superTiles)
+            print("%10d %10d %12.3f %12.3f %7.1fx" % (len(tiles), side ** 2, legacy, vector, legacy / vector))
+        else:
+            print("%10d %10d %12s %12.3f %8s" % (len(tiles), side ** 2, '-', vector, '-'))
+
+        side *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Worker prefetch against a tile store with per-read latency (eg NFS / EFS):
+one composite rendered in process with a simulated delay on every read,
+at several --prefetch depths.
+
+    python benchmarks/bench_prefetch.py [--latency-ms 10]
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
+import mercantile
+
+import untiler
+from untiler.scripts import tile_utils, tile_sources
+
+
+class SlowSource(tile_sources.DirectorySource):
+    """
+    A directory source that sleeps before every read
+    """
+    latency = 0.01
+
+    def read(self, z, x, y):
+        time.sleep(self.latency)
+        return super(SlowSource, self).read(z, x, y)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--latency-ms', type=float, default=10)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    SlowSource.latency = args.latency_ms / 1000
+
+    tmp = tempfile.mkdtemp()
+    try:
+        level = [mercantile.tile(-122.4, 37.5, 14)]
+        for z in range(15, 18):
+            level = [t for p in level for t in mercantile.children(p)]
+        for t in level:
+            tileDir = os.path.join(tmp, 'tiles', str(t.z), str(t.x))
+            if not os.path.isdir(tileDir):
+                os.makedirs(tileDir)
+            shutil.copy('tests/fixtures/fill_img.jpg', os.path.join(tileDir, '%s.jpg' % t.y))
+
+        source = SlowSource(os.path.join(tmp, 'tiles'), '{z}/{x}/{y}.jpg')
+        tiler = tile_utils.TileUtils()
+        tiles = source.list_tiles()
+        job, = tiler.get_sub_tiles(tiles, tiler.get_super_tiles(tiles, 14))
+
+        print("%9s %10s %12s" % ('prefetch', 'time (s)', 'tiles / s'))
+
+        for prefetch in (0, 2, 4, 8, 16):
+            untiler.global_setup(source.path, {
+                'source': source,
+                'tileResolution': 256,
+                'compositezoom': 14,
+                'sceneTemplate': os.path.join(tmp, '%s-%s-%s-tile.tif'),
+                'logdir': None,
+                'creation_opts': {},
+                'no_fill': False,
+                'prefetch': prefetch
+                })
+
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                untiler.streaming_tile_worker(job)
+            elapsed = time.time() - start
+
+            print("%9d %10.2f %12.1f" % (prefetch, elapsed, len(tiles) / elapsed))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Fill tile upsampling: untiler.upsample_array against rasterio's reproject,
+per factor and resampling method.
+
+    python benchmarks/bench_upsample.py [--repeat N]
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+import time
+import warnings
+
+import numpy as np
+from rasterio import Affine
+from rasterio.warp import reproject, Resampling
+
+import untiler
+
+
+def reproject_upsample(imdata, up, resampling):
+    size = imdata.shape[1] * up
+    out = np.zeros((imdata.shape[0], size, size), dtype=imdata.dtype)
+    reproject(
+        imdata, out,
+        src_transform=Affine(up, 0, 0, 0, -up, size),
+        dst_transform=Affine(1, 0, 0, 0, -1, size),
+        src_crs="EPSG:3857",
+        dst_crs="EPSG:3857",
+        resampling=getattr(Resampling, resampling))
+    return out
+
+
+def timeit(func, repeat, *args):
+    start = time.time()
+    for _ in range(repeat):
+        out = func(*args)
+    return (time.time() - start) / repeat, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+
+    with open('tests/fixtures/fill_img.jpg', 'rb') as src:
+        imdata = untiler.make_image_array(untiler.decode_tile(src.read()), 256)
+
+    print("%4s %-9s %12s %12s %8s %9s" % ('up', 'method', 'gdal (s)', 'numpy (s)', 'speedup', 'max diff'))
+
+    for up in (2, 4, 16):
+        for resampling in ('nearest', 'bilinear', 'cubic'):
+            gdal, expected = timeit(reproject_upsample, args.repeat, imdata, up, resampling)
+            fast, out = timeit(untiler.upsample_array, args.repeat, imdata, up, resampling)
+            print("%4d %-9s %12.4f %12.4f %7.1fx %9d" % (
+                up, resampling, gdal, fast, gdal / fast, np.abs(out.astype(int) - expected).max()))
+
+
+if __name__ == "__main__":
+    main()
@@ -23,11 +23,11 @@ setup(name='untiler',
       install_requires=[
           'click',
           'rasterio',
-          'mercantile',
-          'mbutil'
+          'mercantile'
       ],
       extras_require={
           'test': ['pytest', 'pytest-cov'],
+          'pillow': ['Pillow'],
       },
       entry_points="""
       [console_scripts]
@@ -1,6 +1,15 @@
+import http.server
+import inspect
+import json
+import multiprocessing
 import os
+import pickle
+import pstats
 import shutil
+import socketserver
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from click.testing import CliRunner
 import mercantile
@@ -8,7 +17,10 @@ import numpy as np
 import pytest
 import rasterio as rio
 import sqlite3
+import tarfile
+import untiler
 from untiler.scripts.cli import cli
+from untiler.scripts import tile_utils, tile_index, tile_sources, tile_fetch
 
 
 class TestTiler:
@@ -56,6 +68,11 @@ class TestTiler:
             obj[zooms[i]] = tiles
 
 
+def untiler_outputs(outdir):
+    ## everything but the (hidden) manifest + inventory
+    return sorted(f for f in os.listdir(outdir) if not f.startswith('.'))
+
+
 def test_cli_streamdir_all_ok():
     with TestTiler() as testtiles:
         testtiles.add_tiles(15, 18)
@@ -162,3 +179,878 @@ def test_extract_mbtiles_fails():
             '{z}-{x}-{y}-mbtiles.tif', '--co', 'compress=lzw'])
 
         assert result.exc_info[0] == sqlite3.OperationalError
+
+
+def test_search_template_prunes():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 18)
+        tmp = testtiles.path
+        tiler = tile_utils.TileUtils()
+
+        allFiles = sorted(tiler.search_dir(tmp))
+        assert len(allFiles) == 4 + 16 + 64 + 256
+
+        assert sorted(tiler.search_template(tmp, 'jpg/{z}/{x}/{y}.jpg')) == allFiles
+        assert sorted(tiler.search_template(tmp, '{z}-{x}-{y}.jpg')) == allFiles
+
+        pruned = list(tiler.search_template(tmp, 'jpg/{z}/{x}/{y}.jpg', minzoom=16, maxzoom=17))
+        assert len(pruned) == 16 + 64
+
+        bounds = mercantile.bounds(mercantile.tile(-122.4, 37.5, 16))
+        pruned = list(tiler.search_template(tmp, 'jpg/{z}/{x}/{y}.jpg', bounds=bounds))
+        assert len(pruned) < len(allFiles)
+
+        assert list(tiler.search_template(os.path.join(tmp, 'nope'), 'jpg/{z}/{x}/{y}.jpg')) == []
+
+
+def test_stream_commands_forward_options():
+    ## every option of a stream command is an argument of the function it calls, or the call fails
+    from untiler.scripts import cli as cli_module
+    for command, function, args, extra in [
+            (cli_module.streamdir, untiler.stream_dir, 2, {}),
+            (cli_module.streammbtiles, untiler.stream_mbtiles, 2, {'logdir': None}),
+            (cli_module.streamtar, untiler.stream_tar, 2, {}),
+            (cli_module.streamhttp, untiler.stream_http, 3, {})]:
+        options = dict((p.name, None) for p in command.params[args:])
+        options.update(extra)
+        inspect.signature(function).bind(*[None] * args, **cli_module.get_stream_args(options))
+        inspect.signature(untiler.stream_source).bind(None, None, **dict((k, v) for k, v in options.items()
+            if k not in ('read_template', 'index', 'concurrency', 'retries')))
+
+
+def test_cli_streamdir_fills_above_z15():
+    ## a z13 composite with its z13 tile, one z14 tile and a sparse z16 tile fills from z13 + z14
+    with TestTiler() as testtiles:
+        tmp = testtiles.path
+        top = mercantile.tile(-122.4, 37.5, 13)
+        z14 = mercantile.children(top)[0]
+        z16 = mercantile.children(mercantile.children(mercantile.children(top)[3])[0])[0]
+        for t, img in ((top, testtiles.imgs[1]), (z14, testtiles.imgs[0]), (z16, testtiles.imgs[1])):
+            os.makedirs(os.path.join(tmp, 'jpg', str(t.z), str(t.x)))
+            shutil.copy(img, os.path.join(tmp, 'jpg', str(t.z), str(t.x), '%s.jpg' % t.y))
+
+        runner = CliRunner()
+        result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '13'])
+        assert result.exit_code == 0
+        with rio.open(os.path.join(tmp, '13-%s-%s-tile.tif' % (top.x, top.y))) as src:
+            assert src.shape == (2048, 2048)
+            ## no holes, and the z14 tile's quarter is filled from it rather than the (grey) z13 tile
+            assert src.read(4).min() == 255
+            red, green = src.read(1, window=((0, 1024), (0, 1024))), src.read(2, window=((0, 1024), (0, 1024)))
+            assert np.mean(red != green) > 0.5
+            assert np.array_equal(src.read(1, window=((1024, 2048), (0, 1024))), src.read(2, window=((1024, 2048), (0, 1024))))
+
+
+def test_cli_streamdir_bounds():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 18)
+        tmp = testtiles.path
+        runner = CliRunner()
+        tile = mercantile.tile(-122.4, 37.5, 15)
+        west, south, east, north = mercantile.bounds(tile)
+        result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '15', '--bounds',
+            str(west), str(south), str(east), str(north)])
+        assert result.exit_code == 0
+        assert result.output.rstrip() == os.path.join(tmp, '15-%s-%s-tile.tif' % (tile.x, tile.y))
+
+        result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '15', '--dry-run', '--bounds', '-180', '-90', '180', '90'])
+        assert result.exit_code == 0
+        assert '4 of 4 composites would be made' in result.output
+
+
+def test_tile_index_refresh():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 17)
+        tmp = testtiles.path
+        indexPath = os.path.join(tmp, 'index.npz')
+        template, _, separator = tile_utils.parse_template('%s/jpg/{z}/{x}/{y}.jpg' % tmp)
+
+        tiler = tile_utils.TileUtils()
+        scanned = tiler.scan_tiles(tiler.search_dir(tmp), template, separator)
+
+        tiles, mtimes, sizes = tile_index.TileIndex(indexPath).refresh(tmp, template)
+        assert sorted(tiles.tolist()) == sorted(scanned.tolist())
+        assert mtimes.shape == sizes.shape == (len(tiles),)
+        assert os.path.isfile(indexPath)
+
+        again, _, _ = tile_index.TileIndex(indexPath).refresh(tmp, template)
+        assert np.array_equal(again, tiles)
+
+        ## an unchanged index isn't rewritten
+        saved = os.stat(indexPath).st_mtime_ns
+        os.utime(indexPath, ns=(0, saved - 10 ** 9))
+        tile_index.TileIndex(indexPath).refresh(tmp, template)
+        assert os.stat(indexPath).st_mtime_ns == saved - 10 ** 9
+
+        z, x, y = tiles[0]
+        xdir = os.path.join(tmp, 'jpg', str(z), str(x))
+        shutil.copy(testtiles.imgs[0], os.path.join(xdir, '99999999.jpg'))
+        os.remove(os.path.join(xdir, '%s.jpg' % y))
+        os.utime(xdir, ns=(0, os.stat(xdir).st_mtime_ns + 10 ** 9))
+
+        refreshed, _, _ = tile_index.TileIndex(indexPath).refresh(tmp, template)
+        assert len(refreshed) == len(tiles)
+        assert [z, x, 99999999] in refreshed.tolist()
+        assert [z, x, y] not in refreshed.tolist()
+        assert [z, x, 99999999] in tile_index.TileIndex(indexPath).load(tmp, template)['tiles'].tolist()
+
+
+def test_cli_streamdir_index():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 18)
+        tmp = testtiles.path
+        runner = CliRunner()
+        for _ in range(2):
+            result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '14', '--index', os.path.join(tmp, 'index.npz')])
+            assert result.output.rstrip() == os.path.join(tmp, '14-2621-6348-tile.tif')
+
+
+def test_cli_streamtar():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 18)
+        tmp = testtiles.path
+        tarPath = os.path.join(tmp, 'tiles.tar')
+        with tarfile.open(tarPath, 'w') as tar:
+            tar.add(os.path.join(tmp, 'jpg'), arcname='3857_archive/jpg')
+
+        outdir = os.path.join(tmp, 'out')
+        os.mkdir(outdir)
+        runner = CliRunner()
+        result = runner.invoke(cli, ['streamtar', tarPath, outdir, '-c', '14'])
+        assert result.exit_code == 0
+        assert result.output.rstrip() == os.path.join(outdir, '14-2621-6348-tile.tif')
+
+        runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '14'])
+        with rio.open(os.path.join(outdir, '14-2621-6348-tile.tif')) as fromtar:
+            with rio.open(os.path.join(tmp, '14-2621-6348-tile.tif')) as fromdir:
+                assert np.array_equal(fromtar.read(), fromdir.read())
+
+
+def test_tar_source_fails():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 15)
+        tmp = testtiles.path
+        tarPath = os.path.join(tmp, 'tiles.tar.gz')
+        with tarfile.open(tarPath, 'w:gz') as tar:
+            tar.add(os.path.join(tmp, 'jpg'), arcname='jpg')
+
+        with pytest.raises(ValueError):
+            tile_sources.TarSource(tarPath, 'jpg/{z}/{x}/{y}.jpg').list_tiles()
+
+
+def test_cli_streamdir_pillow_decoder():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 18)
+        tmp = testtiles.path
+        runner = CliRunner()
+        result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '14', '--decoder', 'pillow', '--co', 'compress=lzw'])
+        assert result.output.rstrip() == os.path.join(tmp, '14-2621-6348-tile.tif')
+        with rio.open(result.output.rstrip()) as src:
+            assert src.shape == (4096, 4096)
+            assert src.read(4).min() == 255
+
+
+def test_cli_streamdir_buffered_matches():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        runner = CliRunner()
+        outputs = []
+        for bufferArgs in ([], ['--buffer-mb', '1'], ['--buffer-mb', '100']):
+            outdir = os.path.join(tmp, 'out%s' % len(outputs))
+            os.mkdir(outdir)
+            result = runner.invoke(cli, ['streamdir', tmp, outdir, '-c', '15', '--co', 'compress=lzw'] + bufferArgs)
+            assert result.exit_code == 0
+            outputs.append(outdir)
+
+        for name in untiler_outputs(outputs[0]):
+            with rio.open(os.path.join(outputs[0], name)) as src:
+                expected = src.read()
+            for outdir in outputs[1:]:
+                with rio.open(os.path.join(outdir, name)) as src:
+                    assert np.array_equal(src.read(), expected)
+
+
+def test_cli_streamdir_fills_uncovered_only():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 18)
+        tmp = testtiles.path
+
+        ## drop all of one z17 tile's children, and one child of another
+        parent = mercantile.tile(-122.4, 37.5, 17)
+        sibling = mercantile.Tile(parent.x + 1, parent.y, 17)
+        removed = list(mercantile.children(parent)) + [mercantile.children(sibling)[0]]
+        for t in removed:
+            os.remove(os.path.join(tmp, 'jpg', '18', str(t.x), '%s.jpg' % t.y))
+
+        runner = CliRunner()
+        outputs = []
+        for bufferArgs in ([], ['--buffer-mb', '1']):
+            outdir = os.path.join(tmp, 'out%s' % len(outputs))
+            os.mkdir(outdir)
+            result = runner.invoke(cli, ['streamdir', tmp, outdir, '-c', '14', '--co', 'compress=lzw'] + bufferArgs)
+            assert result.exit_code == 0
+            outputs.append(os.path.join(outdir, '14-2621-6348-tile.tif'))
+
+        with rio.open(outputs[0]) as src:
+            output = src.read()
+        with rio.open(outputs[1]) as src:
+            assert np.array_equal(src.read(), output)
+
+        baseX, baseY = tile_utils.TileUtils().get_sub_base_zoom(2621, 6348, 14, 18)
+
+        for t in removed:
+            fill = mercantile.parent(t)
+            with rio.open(os.path.join(tmp, 'jpg', '17', str(fill.x), '%s.jpg' % fill.y)) as src:
+                expected = untiler.upsample_array(untiler.make_image_array(src.read(), 256), 2)
+            row, col = (t.y - baseY) * 256, (t.x - baseX) * 256
+            fillRow, fillCol = (t.y - fill.y * 2) * 256, (t.x - fill.x * 2) * 256
+            assert np.array_equal(
+                output[:, row:row + 256, col:col + 256],
+                expected[:, fillRow:fillRow + 256, fillCol:fillCol + 256])
+
+        kept = mercantile.children(sibling)[1]
+        with rio.open(os.path.join(tmp, 'jpg', '18', str(kept.x), '%s.jpg' % kept.y)) as src:
+            expected = untiler.make_image_array(src.read(), 256)
+        row, col = (kept.y - baseY) * 256, (kept.x - baseX) * 256
+        assert np.array_equal(output[:, row:row + 256, col:col + 256], expected)
+
+
+def test_cli_streamdir_cascading_fill():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 18)
+        tmp = testtiles.path
+
+        ## one hole at z18 over a z17 tile, and one hole at z17 + z18 down to z16
+        parent = mercantile.tile(-122.4, 37.5, 17)
+        hole = mercantile.Tile(parent.x + 1, parent.y, 17)
+        for t in mercantile.children(parent) + mercantile.children(hole):
+            os.remove(os.path.join(tmp, 'jpg', '18', str(t.x), '%s.jpg' % t.y))
+        os.remove(os.path.join(tmp, 'jpg', '17', str(hole.x), '%s.jpg' % hole.y))
+
+        runner = CliRunner()
+        result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '14', '--co', 'compress=lzw'])
+        assert result.exit_code == 0
+
+        with rio.open(os.path.join(tmp, '14-2621-6348-tile.tif')) as src:
+            output = src.read()
+
+        baseX, baseY = tile_utils.TileUtils().get_sub_base_zoom(2621, 6348, 14, 18)
+
+        for t, fill in ((parent, parent), (hole, mercantile.parent(hole))):
+            up = 2 ** (18 - fill.z)
+            with rio.open(os.path.join(tmp, 'jpg', str(fill.z), str(fill.x), '%s.jpg' % fill.y)) as src:
+                expected = untiler.upsample_array(untiler.make_image_array(src.read(), 256), up)
+            row, col = (t.y * 2 - baseY) * 256, (t.x * 2 - baseX) * 256
+            fillRow, fillCol = (t.y * 2 - fill.y * up) * 256, (t.x * 2 - fill.x * up) * 256
+            assert np.array_equal(
+                output[:, row:row + 512, col:col + 512],
+                expected[:, fillRow:fillRow + 512, fillCol:fillCol + 512])
+
+
+def test_stream_dir_fill_cache():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 18)
+        tmp = testtiles.path
+
+        ## two sibling composites that must both fill a hole from their z16 parent
+        parent = mercantile.tile(-122.4, 37.5, 16)
+        holes = []
+        for t in mercantile.children(parent)[:2]:
+            os.remove(os.path.join(tmp, 'jpg', '17', str(t.x), '%s.jpg' % t.y))
+            hole = mercantile.children(t)[0]
+            os.remove(os.path.join(tmp, 'jpg', '18', str(hole.x), '%s.jpg' % hole.y))
+            holes.append(hole)
+
+        outputs = []
+        for cache_mb in (0, 64):
+            outdir = os.path.join(tmp, 'out%s' % cache_mb)
+            os.mkdir(outdir)
+            stats = untiler.stream_dir(tmp, outdir, 17, None, None, 'jpg/{z}/{x}/{y}.jpg', '{z}-{x}-{y}-tile.tif',
+                1, {'compress': 'lzw'}, False, cache_mb=cache_mb)
+            outputs.append(outdir)
+
+        assert stats == {'hits': 1, 'misses': 1}
+
+        for name in untiler_outputs(outputs[0]):
+            with rio.open(os.path.join(outputs[0], name)) as src:
+                expected = src.read()
+            with rio.open(os.path.join(outputs[1], name)) as src:
+                assert np.array_equal(src.read(), expected)
+
+        with rio.open(os.path.join(tmp, 'jpg', '16', str(parent.x), '%s.jpg' % parent.y)) as src:
+            fill = untiler.upsample_array(untiler.make_image_array(src.read(), 256), 4)
+
+        for hole in holes:
+            composite = mercantile.parent(hole)
+            with rio.open(os.path.join(outputs[1], '17-%s-%s-tile.tif' % composite[:2])) as src:
+                output = src.read()
+            row, col = (hole.y - composite.y * 2) * 256, (hole.x - composite.x * 2) * 256
+            fillRow, fillCol = (hole.y - parent.y * 4) * 256, (hole.x - parent.x * 4) * 256
+            assert np.array_equal(
+                output[:, row:row + 256, col:col + 256],
+                fill[:, fillRow:fillRow + 256, fillCol:fillCol + 256])
+
+
+def test_cli_streamdir_order_chunksize():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        runner = CliRunner()
+
+        expected = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '16', '--order', 'zxy'])
+        assert expected.exit_code == 0
+
+        for args in (['--order', 'hilbert', '--chunksize', '3'], ['--order', 'morton', '--cache-mb', '0', '--chunksize', '2']):
+            result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '16'] + args)
+            assert result.exit_code == 0
+            assert sorted(result.output.split()) == sorted(expected.output.split())
+            assert len(result.output.split()) == 16
+
+
+def test_cli_streamdir_schedule_report():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        report = os.path.join(tmp, 'schedule.jsonl')
+        runner = CliRunner()
+
+        result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '15', '-w', '1', '--schedule-report', report])
+        assert result.exit_code == 0
+
+        with open(report) as src:
+            rows = [json.loads(l) for l in src]
+
+        summary = rows.pop()['summary']
+        assert summary['jobs'] == len(rows) == 4
+        assert set('fitted predicted actual weights'.split()) <= set(summary)
+
+        ## the one composite with z18 children is dispatched first
+        assert result.output.split()[0] == os.path.join(tmp, '15-5242-12697-tile.tif')
+        heavy = [r for r in rows if r['tile'] == '15-5242-12697']
+        assert heavy[0]['cells'] == 64 and heavy[0]['predicted'] == max(r['predicted'] for r in rows)
+
+
+def test_cli_streamdir_split_matches():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+
+        for t in mercantile.children(mercantile.tile(-122.4, 37.5, 17)):
+            os.remove(os.path.join(tmp, 'jpg', '18', str(t.x), '%s.jpg' % t.y))
+
+        runner = CliRunner()
+        outputs = []
+        ## one worker fed chunks of bands bigger than its band slots mustn't stall
+        for splitArgs in (['--split-mb', '0'], ['--split-mb', '2'], ['--split-mb', '1', '-w', '1', '--chunksize', '3']):
+            outdir = os.path.join(tmp, 'out%s' % len(outputs))
+            os.mkdir(outdir)
+            result = runner.invoke(cli, ['streamdir', tmp, outdir, '-c', '15', '-l', outdir, '--co', 'compress=lzw'] + splitArgs)
+            assert result.exit_code == 0
+            assert len(result.output.split()) == 4
+            outputs.append(outdir)
+
+        for output in outputs[1:]:
+            for name in untiler_outputs(outputs[0]):
+                if name.endswith('.log'):
+                    with open(os.path.join(outputs[0], name)) as src:
+                        expected = src.read().splitlines()
+                    with open(os.path.join(output, name)) as src:
+                        logged = src.read().splitlines()
+                    assert logged[0] == expected[0].replace(outputs[0], output)
+                    assert sorted(logged[1:]) == sorted(expected[1:])
+                else:
+                    with rio.open(os.path.join(outputs[0], name)) as src:
+                        expected = src.read()
+                    with rio.open(os.path.join(output, name)) as src:
+                        assert np.array_equal(src.read(), expected)
+
+
+def test_cli_streamdir_prefetch_matches():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        runner = CliRunner()
+        outputs = []
+        for prefetchArgs in (['--prefetch', '0'], ['--prefetch', '8'], ['--prefetch', '3', '--buffer-mb', '1']):
+            outdir = os.path.join(tmp, 'out%s' % len(outputs))
+            os.mkdir(outdir)
+            result = runner.invoke(cli, ['streamdir', tmp, outdir, '-c', '15', '--co', 'compress=lzw'] + prefetchArgs)
+            assert result.exit_code == 0
+            outputs.append(outdir)
+
+        for name in untiler_outputs(outputs[0]):
+            with rio.open(os.path.join(outputs[0], name)) as src:
+                expected = src.read()
+            for outdir in outputs[1:]:
+                with rio.open(os.path.join(outdir, name)) as src:
+                    assert np.array_equal(src.read(), expected)
+
+        ## tar reads are positioned, so threads can share the archive's handle
+        tarPath = os.path.join(tmp, 'tiles.tar')
+        with tarfile.open(tarPath, 'w') as tar:
+            tar.add(os.path.join(tmp, 'jpg'), arcname='jpg')
+
+        source = tile_sources.TarSource(tarPath, 'jpg/{z}/{x}/{y}.jpg')
+        tiles = source.list_tiles().tolist()
+        with ThreadPoolExecutor(8) as pool:
+            for (z, x, y), data in zip(tiles, pool.map(lambda t: source.read(*t), tiles)):
+                with open(os.path.join(tmp, 'jpg', str(z), str(x), '%s.jpg' % y), 'rb') as src:
+                    assert data == src.read()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class TileServer:
+    """
+    A local HTTP/1.1 stand-in for a tile endpoint, serving a directory with
+    keep-alive, and byte ranges while `ranges` is set. The first `failures`
+    requests for each path get a 503
+    """
+    def __init__(self, directory, failures=0):
+        server = self
+        self.failures = failures
+        self.attempts = {}
+        self.connections = set()
+        self.ranges = True
+        self.ranged = 0
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def translate_path(self, path):
+                return os.path.join(directory, path.split('?')[0].lstrip('/'))
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.connections.add(self.client_address)
+                seen = server.attempts[self.path] = server.attempts.get(self.path, 0) + 1
+                if seen <= server.failures:
+                    self.send_error(503)
+                    return
+
+                if self.headers.get('Range') and server.ranges:
+                    start, end = [int(v) for v in self.headers['Range'].split('=')[1].split('-')]
+                    with open(self.translate_path(self.path), 'rb') as src:
+                        src.seek(start)
+                        body = src.read(end - start + 1)
+                    server.ranged += 1
+                    self.send_response(206)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.send_header('Content-Range', 'bytes %s-%s/*' % (start, end))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                return super(Handler, self).do_GET()
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.handle_error = lambda *args: None
+        self.url = 'http://127.0.0.1:%s' % self.httpd.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def test_async_fetcher():
+    with open('tests/fixtures/fill_img.jpg', 'rb') as src:
+        expected = src.read()
+
+    with TileServer('tests/fixtures', failures=2) as server:
+        url = server.url + '/fill_img.jpg'
+        fetcher = tile_fetch.AsyncFetcher(concurrency=4, retries=2, backoff=0.01)
+
+        ## the first two 503s are retried
+        bodies = list(fetcher.iter_fetch([url] * 20))
+        assert bodies == [expected] * 20
+        assert server.attempts['/fill_img.jpg'] == 22
+
+        ## connections are kept alive + reused (the 503s close theirs), across calls too
+        assert len(server.connections) <= 4 + 2
+        connections = len(server.connections)
+        assert fetcher.get(url) == expected
+        assert list(fetcher.iter_fetch([url] * 4)) == [expected] * 4
+        assert len(server.connections) == connections
+
+        ## byte ranges, and from servers that ignore them
+        for ranges in (True, False):
+            server.ranges = ranges
+            assert fetcher.get(url, (10, 20)) == expected[10:30]
+            assert list(fetcher.iter_fetch([(url, (0, 5)), url])) == [expected[:5], expected]
+        assert server.ranged == 2
+
+        ## not found fails straight away, and out of retries fails
+        server.failures = 0
+        with pytest.raises(tile_fetch.FetchError) as e:
+            list(fetcher.iter_fetch([url, server.url + '/nope.jpg', url]))
+        assert e.value.status == 404
+        assert server.attempts['/nope.jpg'] == 1
+
+        server.failures = 2
+        with pytest.raises(tile_fetch.FetchError) as e:
+            list(tile_fetch.AsyncFetcher(retries=1, backoff=0.01).iter_fetch([server.url + '/fill_img_grey.jpg']))
+        assert e.value.status == 503
+
+        ## stopping early cancels what's left
+        bodies = fetcher.iter_fetch([url] * 100)
+        assert next(bodies) == expected
+        bodies.close()
+        assert fetcher.requests < 100 + 25 + 24
+        fetcher.close()
+
+
+def test_cli_streamtar_http():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 18)
+        tmp = testtiles.path
+        tarPath = os.path.join(tmp, 'tiles.tar')
+        with tarfile.open(tarPath, 'w') as tar:
+            tar.add(os.path.join(tmp, 'jpg'), arcname='3857_archive/jpg')
+
+        runner = CliRunner()
+        outputs = []
+        with TileServer(tmp) as server:
+            for tar in (tarPath, server.url + '/tiles.tar'):
+                outdir = os.path.join(tmp, 'out%s' % len(outputs))
+                os.mkdir(outdir)
+                result = runner.invoke(cli, ['streamtar', tar, outdir, '-c', '14', '-w', '2', '--concurrency', '4'])
+                assert result.exit_code == 0
+                assert result.output.rstrip() == os.path.join(outdir, '14-2621-6348-tile.tif')
+                outputs.append(result.output.rstrip())
+
+            ## indexed from one pass over the archive, then every tile read with a range request
+            assert server.ranged > 0
+            assert server.attempts['/tiles.tar'] == server.ranged + 1
+
+        with rio.open(outputs[0]) as fromfile:
+            with rio.open(outputs[1]) as fromurl:
+                assert np.array_equal(fromfile.read(), fromurl.read())
+
+        result = runner.invoke(cli, ['streamtar', os.path.join(tmp, 'nope.tar'), tmp])
+        assert result.exit_code == 2
+
+
+def test_http_source_reuses_fetchers():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        tmp = testtiles.path
+        tiles = tile_sources.DirectorySource(tmp, 'jpg/{z}/{x}/{y}.jpg').list_tiles().tolist()
+        tileList = os.path.join(tmp, 'tiles.txt')
+        with open(tileList, 'w') as ofile:
+            for z, x, y in tiles:
+                ofile.write('%s\n' % [x, y, z])
+
+        with TileServer(tmp) as server:
+            source = tile_sources.HTTPSource(server.url + '/jpg/{z}/{x}/{y}.jpg', tileList)
+            for z, x, y in tiles:
+                with open(os.path.join(tmp, 'jpg', str(z), str(x), '%s.jpg' % y), 'rb') as src:
+                    assert source.read(z, x, y) == src.read()
+
+            ## one fetcher per thread, whose connection every read reuses
+            assert source.fetcher() is source.fetcher()
+            assert len(server.connections) == 1
+            with ThreadPoolExecutor(1) as pool:
+                assert pool.submit(source.fetcher).result() is not source.fetcher()
+
+            ## and none are pickled to workers
+            assert pickle.loads(pickle.dumps(source))._local is None
+
+
+def test_cli_streamhttp():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        runner = CliRunner()
+
+        tileList = os.path.join(tmp, 'tiles.txt')
+        with open(tileList, 'w') as ofile:
+            for z, x, y in tile_sources.DirectorySource(tmp, 'jpg/{z}/{x}/{y}.jpg').list_tiles():
+                ofile.write('%s\n' % [int(x), int(y), int(z)])
+
+        expected = os.path.join(tmp, 'fromdir')
+        os.mkdir(expected)
+        result = runner.invoke(cli, ['streamdir', tmp, expected, '-c', '15', '--co', 'compress=lzw'])
+        assert result.exit_code == 0
+
+        outdir = os.path.join(tmp, 'fromhttp')
+        os.mkdir(outdir)
+        with TileServer(tmp, failures=1) as server:
+            result = runner.invoke(cli, ['streamhttp', server.url + '/jpg/{z}/{x}/{y}.jpg', tileList, outdir,
+                '-c', '15', '--co', 'compress=lzw', '--concurrency', '4', '--retries', '1'])
+            assert result.exit_code == 0
+
+        assert untiler_outputs(outdir) == untiler_outputs(expected)
+        for name in untiler_outputs(expected):
+            with rio.open(os.path.join(expected, name)) as src:
+                fromdir = src.read()
+            with rio.open(os.path.join(outdir, name)) as src:
+                assert np.array_equal(src.read(), fromdir)
+
+
+def test_stream_dir_stops_workers_on_error():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        tmp = testtiles.path
+        outdir = os.path.join(tmp, 'out')
+        os.mkdir(outdir)
+
+        bad = mercantile.tile(-122.4, 37.5, 16)
+        with open(os.path.join(tmp, 'jpg', '16', str(bad.x), '%s.jpg' % bad.y), 'wb') as ofile:
+            ofile.write(b'not a jpg')
+
+        with pytest.raises(Exception):
+            untiler.stream_dir(tmp, outdir, 15, None, None, 'jpg/{z}/{x}/{y}.jpg', '{z}-{x}-{y}-tile.tif', 2, {}, False)
+
+        assert multiprocessing.active_children() == []
+        assert not [f for f in os.listdir(outdir) if f.endswith('.tmp')]
+
+
+def test_cli_streamdir_resume():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        outdir = os.path.join(tmp, 'out')
+        os.mkdir(outdir)
+        runner = CliRunner()
+
+        result = runner.invoke(cli, ['streamdir', tmp, outdir, '-c', '16', '--co', 'compress=lzw'])
+        assert result.exit_code == 0
+        outputs = untiler_outputs(outdir)
+        assert len(outputs) > 2
+        assert not [f for f in os.listdir(outdir) if f.endswith('.tmp')]
+
+        with open(os.path.join(outdir, untiler.MANIFEST_NAME)) as src:
+            assert sorted(os.path.basename(json.loads(line)['file']) for line in src) == outputs
+
+        mtimes = dict((f, os.stat(os.path.join(outdir, f)).st_mtime_ns) for f in outputs)
+
+        ## nothing changed: nothing is redone, but a killed worker's temp files are cleared
+        stale = [os.path.join(outdir, outputs[0] + '.12345.tmp'), os.path.join(outdir, outputs[1] + '.12345.tmp.0.raw')]
+        for path in stale + [os.path.join(outdir, 'other.tif.12345.tmp')]:
+            open(path, 'w').close()
+
+        result = runner.invoke(cli, ['streamdir', tmp, outdir, '-c', '16', '--co', 'compress=lzw', '--resume'])
+        assert result.exit_code == 0
+        assert [l for l in result.output.splitlines() if l.endswith('.tif')] == []
+        assert not any(os.path.exists(path) for path in stale)
+        assert os.path.exists(os.path.join(outdir, 'other.tif.12345.tmp'))
+        os.remove(os.path.join(outdir, 'other.tif.12345.tmp'))
+
+        ## a lost scenetif, and a composite whose tiles changed, are redone
+        child = mercantile.tile(-122.4, 37.5, 18)
+        os.remove(os.path.join(tmp, 'jpg', '18', str(child.x), '%s.jpg' % child.y))
+        changed = '16-%s-%s-tile.tif' % mercantile.parent(mercantile.parent(child))[:2]
+        lost = [f for f in outputs if f != changed][0]
+        os.remove(os.path.join(outdir, lost))
+
+        result = runner.invoke(cli, ['streamdir', tmp, outdir, '-c', '16', '--co', 'compress=lzw', '--resume'])
+        assert result.exit_code == 0
+        redone = sorted(os.path.basename(l) for l in result.output.splitlines() if l.endswith('.tif'))
+        assert redone == sorted([changed, lost])
+        for f in outputs:
+            if f not in redone:
+                assert os.stat(os.path.join(outdir, f)).st_mtime_ns == mtimes[f]
+
+        ## without --resume everything is redone
+        result = runner.invoke(cli, ['streamdir', tmp, outdir, '-c', '16', '--co', 'compress=lzw'])
+        assert sorted(os.path.basename(l) for l in result.output.splitlines() if l.endswith('.tif')) == outputs
+
+
+def test_cli_streamdir_incremental():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        outdir = os.path.join(tmp, 'out')
+        os.mkdir(outdir)
+        runner = CliRunner()
+        args = ['streamdir', tmp, outdir, '-c', '16', '--co', 'compress=lzw', '--incremental']
+
+        def made(result):
+            assert result.exit_code == 0
+            return sorted(os.path.basename(l) for l in result.output.splitlines() if l.endswith('.tif'))
+
+        outputs = made(runner.invoke(cli, args))
+        assert outputs == untiler_outputs(outdir) and len(outputs) == 16
+
+        assert made(runner.invoke(cli, args + ['--dry-run'])) == []
+        assert made(runner.invoke(cli, args)) == []
+
+        ## a rewritten z18 tile touches its composite
+        tile = mercantile.tile(-122.4, 37.5, 18)
+        shutil.copy('tests/fixtures/fill_img_grey.jpg', os.path.join(tmp, 'jpg', '18', str(tile.x), '%s.jpg' % tile.y))
+        parent = mercantile.parent(mercantile.parent(tile))
+        assert made(runner.invoke(cli, args + ['--dry-run'])) == ['16-%s-%s-tile.tif' % (parent.x, parent.y)]
+        assert made(runner.invoke(cli, args)) == ['16-%s-%s-tile.tif' % (parent.x, parent.y)]
+
+        ## a composite left with gaps (at every level) fills from z15, and lost scenetifs are remade
+        tilePath = lambda t: os.path.join(tmp, 'jpg', str(t.z), str(t.x), '%s.jpg' % t.y)
+        sub = [t for t in mercantile.children(parent) if os.path.exists(tilePath(t))][0]
+        for t in (parent, sub, mercantile.children(sub)[0]):
+            os.remove(tilePath(t))
+        os.remove(os.path.join(outdir, outputs[0]))
+        expected = sorted(set(['16-%s-%s-tile.tif' % (parent.x, parent.y)] + outputs[:1]))
+        assert made(runner.invoke(cli, args)) == expected
+
+        ## a removed z15 tile only touches the composites that filled from it, not the covered ones beneath it
+        tile = mercantile.parent(parent)
+        os.remove(tilePath(tile))
+        assert made(runner.invoke(cli, args + ['--dry-run'])) == ['16-%s-%s-tile.tif' % (parent.x, parent.y)]
+        assert made(runner.invoke(cli, args)) == ['16-%s-%s-tile.tif' % (parent.x, parent.y)]
+
+        assert made(runner.invoke(cli, args)) == []
+
+        ## with an index, a tile overwritten in place (its directory untouched) is still caught
+        args += ['-i', os.path.join(tmp, 'index.npz')]
+        assert made(runner.invoke(cli, args)) == []
+        tile = mercantile.tile(-122.4, 37.5, 18)
+        shutil.copy('tests/fixtures/fill_img.jpg', os.path.join(tmp, 'jpg', '18', str(tile.x), '%s.jpg' % tile.y))
+        assert made(runner.invoke(cli, args)) == ['16-%s-%s-tile.tif' % (parent.x, parent.y)]
+
+        ## a composite whose tiles are all removed has its scenetif removed
+        emptied = [t for t in outputs if t != '16-%s-%s-tile.tif' % (parent.x, parent.y)][0]
+        z, x, y = emptied.split('-')[:3]
+        os.remove(os.path.join(tmp, 'jpg', z, x, '%s.jpg' % y))
+        result = runner.invoke(cli, args + ['--dry-run'])
+        assert made(result) == [] and '%s would be removed' % os.path.join(outdir, emptied) in result.output
+        assert os.path.exists(os.path.join(outdir, emptied))
+
+        result = runner.invoke(cli, args)
+        assert made(result) == [] and 'Removed %s' % os.path.join(outdir, emptied) in result.output
+        assert untiler_outputs(outdir) == [f for f in outputs if f != emptied]
+        with open(os.path.join(outdir, untiler.MANIFEST_NAME)) as src:
+            assert emptied not in src.read()
+
+
+def test_cli_streamdir_metrics():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        runner = CliRunner()
+
+        for splitArgs in (['--split-mb', '0'], ['--split-mb', '2']):
+            metrics = os.path.join(tmp, 'metrics.jsonl')
+            result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '15', '--metrics', metrics] + splitArgs)
+            assert result.exit_code == 0
+
+            with open(metrics) as src:
+                lines = [json.loads(line) for line in src]
+
+            composites, summary = lines[:-1], lines[-1]['summary']
+            assert sorted(c['file'] for c in composites) == sorted(result.output.split())
+            assert summary['composites'] == len(composites)
+
+            for c in composites:
+                assert set(untiler.tile_metrics.STAGES) <= set(c)
+                assert c['read']['tiles'] == c['decode']['tiles'] > 0
+                assert c['read']['bytes'] > 0
+                ## every zMax cell of the output is written
+                zMax = 18 if c['tile'] == '15-%s-%s' % mercantile.tile(-122.4, 37.5, 15)[:2] else 16
+                assert c['write']['tiles'] == 4 ** (zMax - 15)
+
+            for stage in untiler.tile_metrics.STAGES:
+                assert summary['stages'][stage]['tiles'] == sum(c[stage]['tiles'] for c in composites)
+            assert summary['stages']['read']['tiles_per_second'] > 0
+            assert summary['seconds'] >= summary['discovery'] + summary['planning']
+            ## the z17 + z18 composite fills through the cache
+            assert summary['cache']['misses'] > 0 and summary['cache']['hits'] >= 0
+
+
+def test_cli_streamdir_cog():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        runner = CliRunner()
+
+        plain = os.path.join(tmp, 'plain')
+        os.mkdir(plain)
+        result = runner.invoke(cli, ['streamdir', tmp, plain, '-c', '15', '--co', 'compress=lzw'])
+        assert result.exit_code == 0
+
+        for splitArgs in (['--split-mb', '0'], ['--split-mb', '2']):
+            cogs = os.path.join(tmp, 'cog-%s' % splitArgs[1])
+            os.mkdir(cogs)
+            result = runner.invoke(cli, ['streamdir', tmp, cogs, '-c', '15', '--co', 'compress=lzw', '--cog'] + splitArgs)
+            assert result.exit_code == 0
+            assert untiler_outputs(cogs) == untiler_outputs(plain)
+            assert not [f for f in os.listdir(cogs) if f.endswith('.raw') or f.endswith('.vrt')]
+
+            for f in untiler_outputs(cogs):
+                with rio.open(os.path.join(cogs, f)) as src, rio.open(os.path.join(plain, f)) as expected:
+                    assert src.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+                    assert src.count == 4
+                    ## overviews halve down to one block
+                    assert src.overviews(1) == [2 ** k for k in range(1, len(src.overviews(1)) + 1)]
+                    assert src.width // 2 ** len(src.overviews(1)) == 256
+                    imdata = src.read()
+                    assert np.array_equal(imdata, expected.read())
+
+                with rio.open(os.path.join(cogs, f), overview_level=0) as ovr:
+                    assert np.array_equal(ovr.read(), untiler.tile_cog.downsample_band(imdata))
+
+        ## JPEG COGs keep alpha as a mask
+        cogs = os.path.join(tmp, 'cog-jpeg')
+        os.mkdir(cogs)
+        result = runner.invoke(cli, ['streamdir', tmp, cogs, '-c', '15', '--cog'])
+        assert result.exit_code == 0
+        f = '15-%s-%s-tile.tif' % mercantile.tile(-122.4, 37.5, 15)[:2]
+        with rio.open(os.path.join(cogs, f)) as src:
+            assert src.count == 3
+            assert src.overviews(1) == [2, 4, 8]
+            assert src.mask_flag_enums[0] == [rio.enums.MaskFlags.per_dataset]
+            with rio.open(os.path.join(plain, f)) as expected:
+                assert np.array_equal(src.read_masks(1) > 0, expected.read(4) > 0)
+
+
+def test_cli_bench():
+    runner = CliRunner()
+    result = runner.invoke(cli, ['bench', '-c', '15', '-z', '16', '--side', '1', '-w', '1', '-w', '2', '--repeat', '1'])
+    assert result.exit_code == 0
+
+    results = json.loads(result.output)
+    assert results['tiles'] == 1 + 4 + 1 and results['composites'] == 1
+    for stage in ('discovery', 'planning', 'upsample', 'worker'):
+        assert results['results'][stage]['seconds'] > 0
+    assert [r['workers'] for r in results['results']['end_to_end']] == [1, 2]
+
+    result = runner.invoke(cli, ['bench', '-c', '15', '-z', '14'])
+    assert result.exit_code == 2
+
+
+def test_cli_streamdir_profile():
+    with TestTiler() as testtiles:
+        testtiles.add_tiles(15, 16)
+        testtiles.add_tiles(17, 18)
+        tmp = testtiles.path
+        profile = os.path.join(tmp, 'profile')
+        runner = CliRunner()
+
+        result = runner.invoke(cli, ['streamdir', tmp, tmp, '-c', '15', '-w', '2', '--profile-dir', profile])
+        assert result.exit_code == 0
+
+        saved = sorted(os.listdir(profile))
+        assert 'untiler.pstats' in saved
+        assert len([p for p in saved if p.startswith('main-')]) == 1
+        assert len([p for p in saved if p.startswith('worker-')]) >= 1
+
+        functions = set(f[2] for f in pstats.Stats(os.path.join(profile, 'untiler.pstats')).stats)
+        assert 'get_sub_tiles' in functions
+        assert 'streaming_tile_worker' in functions
@@ -7,10 +7,14 @@ import pytest
 import numpy as np
 import mercantile as merc
 import inspect
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import rasterio
 
 import untiler
-from untiler.scripts import tile_utils
+from untiler.scripts import tile_utils, tile_sources, tile_cache, tile_manifest, tile_metrics, tile_bench, tile_cog
 
 
 def test_templating_good_jpg():
@@ -429,3 +433,694 @@ def test_logger():
 
     os.remove(rfile)
     print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_pack_tiles_sort_order(expectedTileList):
+    tiler = tile_utils.TileUtils()
+    keys = tiler.pack_tiles(expectedTileList)
+
+    assert np.array_equal(np.argsort(keys, kind='stable'), np.lexsort(expectedTileList.T[::-1]))
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_sub_tiles_match_zoom_tiles(expectedTileList):
+    tiler = tile_utils.TileUtils()
+
+    for zoom in (12, 13, 14):
+        superTiles = tiler.get_super_tiles(expectedTileList, zoom)
+        uniqueTiles = tiler.get_unique_tiles(superTiles)
+        jobs = list(tiler.get_sub_tiles(expectedTileList, superTiles))
+
+        assert len(jobs) == len(uniqueTiles)
+
+        for job, t in zip(jobs, uniqueTiles):
+            maxZ, maxZcoverage = tiler.get_zoom_tiles(expectedTileList, superTiles, t)
+
+            assert [job['z'], job['x'], job['y']] == list(t)
+            assert np.array_equal(job['zMaxTiles'], maxZ)
+            assert job['zMax'] == maxZ[0][0]
+
+            if maxZcoverage is False:
+                assert job['maxCovTiles'] is False and job['zMaxCov'] is False
+            else:
+                assert np.array_equal(job['maxCovTiles'], maxZcoverage)
+
+        ## tiles already sorted by get_tile_runs plan the same without sorting again
+        tiles, sortedSuper, runStarts, runEnds = tiler.get_tile_runs(expectedTileList, superTiles)
+        for job, presorted in zip(jobs, tiler.get_sub_tiles(tiles, sortedSuper, runs=(runStarts, runEnds))):
+            assert job['slices'] == presorted['slices']
+            assert np.array_equal(job['zMaxTiles'], presorted['zMaxTiles'])
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_sub_tiles_floor_fail(expectedTileList):
+    tiles = expectedTileList[:1000]
+
+    tiler = tile_utils.TileUtils()
+    superTiles = tiler.get_super_tiles(tiles, 12)
+    with pytest.raises(ValueError):
+        list(tiler.get_sub_tiles(tiles, superTiles, 20))
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_fill_super_tiles():
+    tiler = tile_utils.TileUtils()
+    zMaxTiles = np.array([[17, x, y] for x in range(8) for y in range(8) if not (x < 2 and y < 1)])
+    fillTiles = np.array([[16, x, y] for x in range(4) for y in range(4)] + [[16, 9, 9]])
+
+    superTiles = tiler.get_super_tiles(zMaxTiles, 16)
+    fills = np.array(list(tiler.get_fill_super_tiles(superTiles, fillTiles, 4)))
+
+    assert np.array_equal(fills, np.array([[16, 0, 0], [16, 9, 9]]))
+
+    assert list(tiler.get_fill_super_tiles(superTiles, fillTiles[:0], 4)) == []
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_scan_tiles(inputTilenames, expectedTileList):
+    matchTemplate = r'3857_9_83_202_20130517_242834/jpg/\d+/\d+/\d+.jpg'
+
+    tiler = tile_utils.TileUtils()
+
+    output_tiles = tiler.scan_tiles(iter(inputTilenames), matchTemplate, '/', chunksize=1000)
+
+    assert output_tiles.dtype == np.int32
+    assert np.array_equal(output_tiles, expectedTileList)
+
+    tweakedTilenames = [f.replace('/', '?') for f in inputTilenames]
+
+    output_tiles = tiler.scan_tiles(tweakedTilenames, matchTemplate, '/')
+
+    assert output_tiles.shape == (0, 3)
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_bounds_range():
+    bounds = merc.bounds(10, 12, 5)
+
+    assert tile_utils.get_bounds_range(bounds, 5) == (10, 12, 10, 12)
+    assert tile_utils.get_bounds_range(bounds, 7) == (40, 48, 43, 51)
+    ## the whole world's bounds are clamped to Web Mercator's
+    assert tile_utils.get_bounds_range((-180, -90, 180, 90), 3) == (0, 0, 7, 7)
+    assert tile_utils.get_bounds_range((-200, -90, 10, 85.06), 0) == (0, 0, 0, 0)
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_filter_bounds(expectedTileList):
+    tiler = tile_utils.TileUtils()
+    t = expectedTileList[0]
+    bounds = merc.bounds(int(t[1]), int(t[2]), int(t[0]))
+
+    tiles = tiler.filter_bounds(expectedTileList, bounds)
+
+    superTiles = tiler.get_super_tiles(tiles[tiles[:, 0] >= t[0]], t[0])
+    assert np.all(superTiles == t)
+    assert tiles.shape[0] < expectedTileList.shape[0]
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_mbtiles_source():
+    source = tile_sources.MBTilesSource('tests/fixtures/testtiles.mbtiles')
+    tiles = source.list_tiles()
+
+    assert tiles.shape == (17, 3)
+    assert tiles.dtype == np.int32
+    assert np.array_equal(np.unique(tiles[:, 0]), [13, 14, 15, 16])
+
+    z, x, y = [int(i) for i in tiles[0]]
+    tmsRow = source.connect().execute(
+        'SELECT tile_row FROM tiles WHERE zoom_level = ? AND tile_column = ?', (z, x)).fetchall()
+    assert (2 ** z - 1 - y,) in tmsRow
+
+    imdata = untiler.decode_tile(source.read(z, x, y))
+    assert imdata.shape[1:] == (256, 256)
+
+    with pytest.raises(IOError):
+        source.read(z, x, 2 ** z - 1)
+
+    clone = pickle.loads(pickle.dumps(source))
+    assert clone._local is None
+    assert np.array_equal(clone.list_tiles(), tiles)
+
+    ## each reading thread gets its own connection
+    with ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(lambda t: clone.read(*t), tiles.tolist())) == [source.read(*t) for t in tiles.tolist()]
+
+    ## a forked worker inherits the source unpickled, but opens its own connection
+    if 'fork' in multiprocessing.get_all_start_methods():
+        conn = source.connect()
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        child = ctx.Process(target=lambda: results.put((source.connect() is conn, source.read(z, x, y))))
+        child.start()
+        assert results.get(timeout=30) == (False, source.read(z, x, y))
+        child.join()
+        assert source.connect() is conn
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_decode_tile_pillow():
+    for f in ['tests/fixtures/fill_img.jpg', 'tests/fixtures/fill_img_grey.jpg']:
+        with open(f, 'rb') as src:
+            data = src.read()
+
+        expected = untiler.make_image_array(untiler.decode_tile(data), 256)
+        out = np.empty((4, 256, 256), dtype=np.uint8)
+
+        imdata = untiler.decode_tile_pillow(data, out)
+
+        assert imdata is out
+        assert imdata.shape == expected.shape
+        assert np.array_equal(imdata[3], expected[3])
+        # jpeg decoders can differ slightly on chroma upsampling
+        assert np.abs(imdata.astype(int) - expected).mean() < 1.0
+
+    source = tile_sources.MBTilesSource('tests/fixtures/testtiles.mbtiles')
+    for t in source.list_tiles():
+        data = source.read(*[int(i) for i in t])
+        assert untiler.decode_tile_pillow(data, np.empty((4, 256, 256), dtype=np.uint8)) is None
+
+    ## tiles that aren't tile_resolution are left to GDAL
+    with open('tests/fixtures/fill_img.jpg', 'rb') as src:
+        assert untiler.decode_tile_pillow(src.read(), np.empty((4, 512, 512), dtype=np.uint8)) is None
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_limit_bands():
+    slots = threading.Semaphore(2)
+    stopping = threading.Event()
+    tasks = [('band', 0), ('batch', 1), ('band', 2), ('band', 3), ('batch', 4)]
+    fed = untiler.limit_bands(tasks, slots, stopping)
+
+    assert [next(fed) for _ in range(3)] == tasks[:3]
+    ## both slots are taken until the parent writes a band
+    assert not slots.acquire(blocking=False)
+    slots.release()
+    assert next(fed) == tasks[3]
+
+    stopping.set()
+    slots.release()
+    assert list(untiler.limit_bands(tasks[3:], slots, stopping)) == []
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_get_band_rows():
+    assert untiler.get_band_rows(4096, 256, 256, 1) == 256
+    assert untiler.get_band_rows(4096, 256, 256, 4096 * 4 * 1000) == 768
+    assert untiler.get_band_rows(4096, 512, 256, 4096 * 4 * 1000) == 512
+    assert untiler.get_band_rows(4096, 256, 256, 2 ** 30) == 4096
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def reproject_upsample(imdata, up, resampling):
+    from rasterio.warp import reproject, Resampling
+    size = imdata.shape[1] * up
+    out = np.zeros((imdata.shape[0], size, size), dtype=imdata.dtype)
+    reproject(
+        imdata, out,
+        src_transform=rasterio.Affine(up, 0, 0, 0, -up, size),
+        dst_transform=rasterio.Affine(1, 0, 0, 0, -1, size),
+        src_crs="EPSG:3857",
+        dst_crs="EPSG:3857",
+        resampling=getattr(Resampling, resampling))
+    return out
+
+def test_upsample_array_matches_reproject():
+    with open('tests/fixtures/fill_img.jpg', 'rb') as src:
+        imdata = untiler.make_image_array(untiler.decode_tile(src.read()), 256)
+
+    for up in (2, 8):
+        for resampling, tolerance in (('nearest', 0), ('bilinear', 1), ('cubic', 8)):
+            expected = reproject_upsample(imdata, up, resampling)
+            outputUp = untiler.upsample_array(imdata, up, resampling)
+
+            assert outputUp.shape == expected.shape
+            diff = np.abs(outputUp.astype(int) - expected)
+            assert diff.max() <= tolerance
+            assert diff.mean() < 0.05
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_upsample_array_window():
+    imdata = (np.random.rand(4, 64, 64) * 255).astype(np.uint8)
+    up = 4
+    full = untiler.upsample_array(imdata, up, 'cubic')
+
+    out = np.empty((4, 32, 64), dtype=np.uint8)
+    window = untiler.upsample_array(imdata, up, 'cubic', out=out, window=((96, 128), (192, 256)))
+
+    assert window is out
+    assert np.array_equal(window, full[:, 96:128, 192:256])
+
+    with pytest.raises(ValueError):
+        untiler.upsample_array(imdata, up, window=((1, 5), (0, 4)))
+
+    with pytest.raises(ValueError):
+        untiler.upsample_array(imdata, up, 'lanczos')
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_get_uncovered_windows():
+    covered = np.array([
+        [1, 0, 0, 1],
+        [1, 0, 0, 1],
+        [1, 1, 1, 1],
+        [0, 0, 1, 0]], dtype=bool)
+
+    assert untiler.get_uncovered_windows(covered, 256) == [
+        ((0, 512), (256, 768)),
+        ((768, 1024), (0, 512)),
+        ((768, 1024), (768, 1024))]
+
+    assert untiler.get_uncovered_windows(np.ones((2, 2), dtype=bool), 256) == []
+    assert untiler.get_uncovered_windows(np.zeros((2, 2), dtype=bool), 256) == [((0, 512), (0, 512))]
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_sub_tiles_fill_levels():
+    tiler = tile_utils.TileUtils()
+    tiles = np.array(
+        [[15, 0, 0]] +
+        [[16, x, y] for x in range(2) for y in range(2)] +
+        [[17, 0, 0], [17, 1, 1]] +
+        [[18, 0, 0]])
+
+    job, = tiler.get_sub_tiles(tiles, tiler.get_super_tiles(tiles, 15))
+
+    assert job['zMaxCov'] == 16
+    assert np.array_equal(job['fillTiles'], tiles[1:7])
+
+    complete = tiles[1:5]
+    job, = tiler.get_sub_tiles(complete, tiler.get_super_tiles(complete, 15))
+
+    assert job['zMaxCov'] is False
+    assert len(job['fillTiles']) == 0
+
+    ## levels above the zMaxCov floor (z15) fill too, eg in a composite at z13
+    tiles = np.array([[13, 20, 20], [14, 40, 40], [18, 640, 640], [18, 641, 641]])
+    job, = tiler.get_sub_tiles(tiles, tiler.get_super_tiles(tiles, 13))
+    assert job['fillTiles'].tolist() == [[13, 20, 20], [14, 40, 40]]
+
+    ## with no complete level, from the coarsest
+    job, = tiler.get_sub_tiles(tiles[1:], tiler.get_super_tiles(tiles[1:], 13))
+    assert job['fillTiles'].tolist() == [[14, 40, 40]]
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_get_fill_sources():
+    fillTiles = np.array([[16, 0, 0], [17, 1, 0], [17, 0, 1]])
+    covered = np.zeros((4, 4), dtype=bool)
+    covered[0, 0] = True
+
+    sources = untiler.get_fill_sources(fillTiles, covered, 16, 0, 0, 18)
+
+    assert np.array_equal(sources, np.array([
+        [-1, 0, 1, 1],
+        [0, 0, 1, 1],
+        [2, 2, 0, 0],
+        [2, 2, 0, 0]]))
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_tile_cache():
+    cache = tile_cache.TileCache(3 * 1024)
+
+    for i in range(3):
+        cache.put(i, np.zeros(1024, dtype=np.uint8))
+
+    assert cache.get(0) is not None
+    cache.put(3, np.zeros(1024, dtype=np.uint8))
+
+    assert cache.get(1) is None
+    assert cache.get(0) is not None and cache.get(3) is not None
+    assert len(cache) == 3 and cache.nbytes == 3 * 1024
+    assert cache.stats() == {'hits': 3, 'misses': 1}
+
+    with pytest.raises(ValueError):
+        cache.get(0)[0] = 1
+
+    cache.put(4, np.zeros(4096, dtype=np.uint8))
+    assert cache.get(4) is None
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_get_fill_batches():
+    tiler = tile_utils.TileUtils()
+    ancestorTiles = np.array([[0, 0, 0], [15, 0, 0], [15, 1, 0]])
+    ## each composite has half its z17 tiles, so fills from its finest ancestor
+    tiles = np.array([[17, x, 0] for x in range(8)])
+
+    jobs = list(tiler.get_ancestor_fill(tiler.get_sub_tiles(tiles, tiler.get_super_tiles(tiles, 16)), ancestorTiles))
+
+    assert np.array_equal(jobs[0]['fillTiles'], [[15, 0, 0]])
+    assert np.array_equal(jobs[3]['fillTiles'], [[15, 1, 0]])
+
+    batches = tiler.get_fill_batches(jobs)
+
+    assert [[(j['x'], j['y']) for j in b] for b in batches] == [
+        [(0, 0), (1, 0)],
+        [(2, 0), (3, 0)]]
+
+    ## batches are split so each worker gets a task
+    assert [len(b) for b in tiler.get_fill_batches(jobs, 4)] == [1, 1, 1, 1]
+
+    ## covered composites never show (so don't read) an ancestor, even z0 over all of them
+    tiles = np.array([[17, x, y] for x in range(8) for y in range(2)])
+    jobs = list(tiler.get_ancestor_fill(tiler.get_sub_tiles(tiles, tiler.get_super_tiles(tiles, 16)), ancestorTiles))
+    assert all(len(j['ancestorTiles']) == 0 and len(j['fillTiles']) == 0 for j in jobs)
+    assert [len(b) for b in tiler.get_fill_batches(jobs)] == [1, 1, 1, 1]
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_curve_keys():
+    xs, ys = np.meshgrid(np.arange(16), np.arange(16))
+    xs, ys = xs.ravel(), ys.ravel()
+
+    for keys in (tile_utils.hilbert_keys(xs, ys, 4), tile_utils.morton_keys(xs, ys, 4)):
+        assert np.array_equal(np.sort(keys), np.arange(256))
+
+    ## every step along the hilbert curve moves to a neighbouring tile
+    order = np.argsort(tile_utils.hilbert_keys(xs, ys, 4))
+    assert np.all(np.abs(np.diff(xs[order])) + np.abs(np.diff(ys[order])) == 1)
+
+    assert list(tile_utils.morton_keys([0, 1, 0, 1, 2], [0, 0, 1, 1, 0], 2)) == [0, 1, 2, 3, 4]
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_order_jobs():
+    tiler = tile_utils.TileUtils()
+    tiles = np.array([[16, x, y] for x in range(4) for y in range(4)])
+    jobs = list(tiler.get_sub_tiles(tiles, tiler.get_super_tiles(tiles, 16)))
+
+    assert tiler.order_jobs(jobs, 'zxy') == jobs
+
+    ordered = tiler.order_jobs(jobs, 'hilbert')
+    assert sorted((j['x'], j['y']) for j in ordered[:4]) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert len(ordered) == len(jobs)
+
+    ordered = tiler.order_jobs(iter(jobs), 'morton')
+    assert [(j['x'], j['y']) for j in ordered[:4]] == [(0, 0), (1, 0), (0, 1), (1, 1)]
+
+    with pytest.raises(ValueError):
+        tiler.order_jobs(jobs, 'peano')
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_estimate_cost():
+    tiler = tile_utils.TileUtils()
+    sparse = {'z': 13, 'zMax': 15, 'zMaxTiles': np.zeros((3, 3)), 'fillTiles': np.zeros((1, 3))}
+    dense = {'z': 13, 'zMax': 20, 'zMaxTiles': np.zeros((16384, 3)), 'fillTiles': np.zeros((0, 3))}
+
+    assert tiler.get_job_features(sparse) == (4, 16)
+    assert tiler.estimate_cost(sparse, {'read': 1, 'cell': 0.5}) == 12
+    assert tiler.estimate_cost(dense) > 1000 * tiler.estimate_cost(sparse)
+
+    batches = ['a', 'b', 'c', 'd']
+    assert tiler.order_by_cost(batches, [1, 10, 1.5, 9]) == ['b', 'd', 'a', 'c']
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_job_payload_roundtrip(expectedTileList):
+    tiler = tile_utils.TileUtils()
+
+    ## every composite of the full list is covered; the sparse z17+ ones fill from ancestors
+    for tileList in (expectedTileList, expectedTileList[expectedTileList[:, 0] >= 17]):
+        superTiles = tiler.get_super_tiles(tileList, 13)
+        tiles, superTiles, _, _ = tiler.get_tile_runs(tileList, superTiles)
+
+        ancestorTiles = np.array([[12, 0, 0]] + [[12, int(t[1]) // 2, int(t[2]) // 2] for t in superTiles[:1]])
+        jobs = list(tiler.get_ancestor_fill(tiler.get_sub_tiles(tiles, superTiles), ancestorTiles))
+
+        for job in jobs:
+            payload = tiler.get_job_payload(job)
+            assert len(pickle.dumps(payload)) < 1024
+
+            loaded = tiler.load_job(pickle.loads(pickle.dumps(payload)), tiles)
+            for k in ('z', 'x', 'y', 'zMax', 'zMaxCov'):
+                assert loaded[k] == job[k]
+            for k in ('zMaxTiles', 'fillTiles', 'ancestorTiles'):
+                assert np.array_equal(loaded[k], job[k])
+            if job['maxCovTiles'] is False:
+                assert loaded['maxCovTiles'] is False
+            else:
+                assert np.array_equal(loaded['maxCovTiles'], job['maxCovTiles'])
+
+        assert len(jobs[0]['ancestorTiles']) == (0 if tiler.is_covered(jobs[0]) else 1)
+
+    assert not tiler.is_covered(jobs[0])
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+
+def test_job_hash(expectedTileList):
+    tiler = tile_utils.TileUtils()
+    superTiles = tiler.get_super_tiles(expectedTileList, 13)
+    tiles, superTiles, _, _ = tiler.get_tile_runs(expectedTileList, superTiles)
+    job = next(iter(tiler.get_sub_tiles(tiles, superTiles)))
+
+    inputHash = tiler.get_job_hash(job, {'resampling': 'bilinear'})
+    assert inputHash == tiler.get_job_hash(tiler.load_job(tiler.get_job_payload(job), tiles), {'resampling': 'bilinear'})
+    assert inputHash != tiler.get_job_hash(job, {'resampling': 'cubic'})
+
+    job['zMaxTiles'] = job['zMaxTiles'][::-1]
+    assert inputHash == tiler.get_job_hash(job, {'resampling': 'bilinear'})
+
+    job['zMaxTiles'] = job['zMaxTiles'][1:]
+    assert inputHash != tiler.get_job_hash(job, {'resampling': 'bilinear'})
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+
+def test_remove_temp_files(tmpdir, monkeypatch):
+    names = ['13-1-2-tile.tif', '13-1-2-tile.tif.12.tmp', '13-1-2-tile.tif.34.tmp.0.raw', '13-1-2-tile.tif.34.tmp.vrt',
+        '13-1-3-tile.tif.5.tmp', '13-1-2-tile.tif.tmp', '13-9-9-tile.tif.5.tmp']
+    for name in names:
+        tmpdir.join(name).write('')
+
+    listings = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda path: listings.append(path) or listdir(path))
+
+    planned = [str(tmpdir.join('13-1-2-tile.tif')), str(tmpdir.join('13-1-3-tile.tif'))]
+    assert untiler.remove_temp_files(iter(planned)) == 4
+    ## the directory is listed once for every scenetif in it
+    assert listings == [str(tmpdir)]
+    assert sorted(os.listdir(str(tmpdir))) == ['13-1-2-tile.tif', '13-1-2-tile.tif.tmp', '13-9-9-tile.tif.5.tmp']
+
+    assert untiler.remove_temp_files([str(tmpdir.join('nope', 'x.tif'))]) == 0
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+def test_tile_manifest(tmpdir):
+    path = str(tmpdir.join('manifest.jsonl'))
+    scene = str(tmpdir.join('13-1-2-tile.tif'))
+    open(scene, 'w').close()
+
+    manifest = tile_manifest.TileManifest(path).open()
+    manifest.record((13, 1, 2), scene, 'a')
+    manifest.record((13, 1, 3), str(tmpdir.join('missing.tif')), 'a')
+    manifest.record((13, 1, 2), scene, 'b')
+    manifest.close()
+
+    ## a line cut short by a crash
+    with open(path, 'a') as ofile:
+        ofile.write('{"tile": "13-1-4", "fi')
+
+    manifest = tile_manifest.TileManifest(path)
+    assert sorted(manifest.load()) == ['13-1-2', '13-1-3']
+    assert manifest.is_done((13, 1, 2), scene, 'b')
+    assert not manifest.is_done((13, 1, 2), scene, 'a')
+    assert not manifest.is_done((13, 1, 3), str(tmpdir.join('missing.tif')), 'a')
+    assert not manifest.is_done((13, 1, 4), scene, 'a')
+
+    manifest.open(resume=True).close()
+    with open(path) as src:
+        assert len(src.readlines()) == 2
+
+    manifest.open().close()
+    assert tile_manifest.TileManifest(path).load() == {}
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+
+def test_get_changed_tiles():
+    tiler = tile_utils.TileUtils()
+    oldTiles = np.array([[18, 1, 1], [18, 1, 2], [18, 1, 3], [17, 0, 0]])
+    oldStamps = np.array([[1, 10], [1, 10], [1, 10], [1, 10]])
+    tiles = np.array([[17, 0, 0], [18, 1, 3], [18, 1, 1], [18, 1, 4]])
+    stamps = np.array([[1, 10], [1, 11], [1, 10], [1, 10]])
+
+    added, removed, changed = tiler.get_changed_tiles(oldTiles, oldStamps, tiles, stamps)
+    assert added.tolist() == [[18, 1, 4]]
+    assert removed.tolist() == [[18, 1, 2]]
+    assert changed.tolist() == [[18, 1, 3]]
+
+    assert tiler.find_tiles(oldTiles, tiles).tolist() == [3, 2, 0, -1]
+    assert tiler.find_tiles(np.empty((0, 3)), tiles).tolist() == [-1] * 4
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+
+def test_get_affected_jobs():
+    tiler = tile_utils.TileUtils()
+    jobs = [{'z': 16, 'x': x, 'y': y} for x in range(4) for y in range(4)]
+
+    affected = tiler.get_affected_jobs(jobs, [[18, 5, 5], [16, 3, 3], [20, 0, 0]], 16)
+    assert [(j['x'], j['y']) for j in affected] == [(0, 0), (1, 1), (3, 3)]
+
+    ## (0, 0) is covered at z17, (1, 0) fills from z15, and (2, 0) and (3, 0) from z12
+    tiles = np.array([[17, 0, 0], [17, 1, 0], [17, 0, 1], [17, 1, 1], [17, 2, 0], [17, 4, 0], [17, 6, 0]])
+    ancestorTiles = np.array([[12, 0, 0], [15, 0, 0]])
+    fillJobs = list(tiler.get_ancestor_fill(tiler.get_sub_tiles(tiles, tiler.get_super_tiles(tiles, 16)), ancestorTiles))
+
+    ## a tile above the composite zoom only touches the composites that fill from it
+    assert [(j['x'], j['y']) for j in tiler.get_affected_jobs(fillJobs, [[12, 0, 0]], 16)] == [(2, 0), (3, 0)]
+    assert [(j['x'], j['y']) for j in tiler.get_affected_jobs(fillJobs, [[15, 0, 0]], 16)] == [(1, 0)]
+    assert tiler.get_affected_jobs(fillJobs, [[13, 0, 0], [15, 1, 0]], 16) == []
+
+    ## a removed tile above was what uncovered composites beneath it filled from, if finer than their fill now
+    affected = tiler.get_affected_jobs(fillJobs, np.empty((0, 3)), 16, [[13, 0, 0]])
+    assert [(j['x'], j['y']) for j in affected] == [(2, 0), (3, 0)]
+    affected = tiler.get_affected_jobs(fillJobs, np.empty((0, 3)), 16, [[15, 1, 0], [14, 0, 0]])
+    assert [(j['x'], j['y']) for j in affected] == [(2, 0), (3, 0)]
+    affected = tiler.get_affected_jobs(fillJobs, np.empty((0, 3)), 16, [[17, 1, 1]])
+    assert [(j['x'], j['y']) for j in affected] == [(0, 0)]
+
+    ## fully covered composites never read what's above them
+    tiles = np.array([[17, x, y] for x in range(8) for y in range(2)])
+    fillJobs = list(tiler.get_ancestor_fill(tiler.get_sub_tiles(tiles, tiler.get_super_tiles(tiles, 16)), ancestorTiles))
+    assert tiler.get_affected_jobs(fillJobs, [[12, 0, 0], [15, 0, 0]], 16, [[14, 0, 0]]) == []
+
+    assert tiler.get_affected_jobs(jobs, np.empty((0, 3)), 16) == []
+
+    ## composites whose tiles were all removed have no job left
+    removed = [[18, 5, 5], [17, 20, 20], [18, 80, 80], [18, 81, 81], [15, 0, 0]]
+    assert tiler.get_emptied_composites(jobs, removed, 16).tolist() == [[16, 10, 10], [16, 20, 20]]
+    assert tiler.get_emptied_composites(jobs, np.empty((0, 3)), 16).tolist() == []
+    assert tiler.get_emptied_composites([], [[18, 5, 5]], 16).tolist() == [[16, 1, 1]]
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+
+def test_tile_inventory(tmpdir):
+    inventory = tile_manifest.TileInventory(str(tmpdir.join('inventory.npz')))
+    assert inventory.load({'compositezoom': 13}) is None
+
+    inventory.save([[18, 1, 2]], [[100, 2000]], {'compositezoom': 13})
+    tiles, stamps = inventory.load({'compositezoom': 13})
+    assert tiles.tolist() == [[18, 1, 2]] and stamps.tolist() == [[100, 2000]]
+    assert inventory.load({'compositezoom': 14}) is None
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+
+def test_stage_timer():
+    timer = tile_metrics.StageTimer()
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda i: timer.add('read', time.perf_counter(), 1, 100), range(40)))
+    timer.add('write', time.perf_counter() - 2, 16, 4096)
+
+    stages = timer.collect()
+    assert sorted(stages) == sorted(tile_metrics.STAGES)
+    assert stages['read']['tiles'] == 40 and stages['read']['bytes'] == 4000
+    assert stages['write']['seconds'] >= 2
+    assert timer.collect()['read'] == {'seconds': 0.0, 'tiles': 0, 'bytes': 0}
+
+    totals = tile_metrics.merge_stages(tile_metrics.merge_stages({}, stages), stages)
+    assert totals['read']['tiles'] == 80
+
+    summary = tile_metrics.summarize_stages(totals)
+    assert summary['write']['tiles_per_second'] <= 8
+    assert summary['fill']['mb_per_second'] is None
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+
+def test_bench_make_pyramid(tmpdir):
+    path = str(tmpdir.join('tiles'))
+    tiles = tile_bench.make_pyramid(path, 15, 17, 4, 2, 1.0, 'png', 64)
+
+    ## a full pyramid from z14 (above the composite zoom) to z17
+    assert sorted(np.unique(tiles[:, 0]).tolist()) == [14, 15, 16, 17]
+    assert (tiles[:, 0] == 17).sum() == 4 * 16
+    assert 1 <= (tiles[:, 0] == 14).sum() <= 4
+
+    listed = tile_sources.DirectorySource(path, '{z}/{x}/{y}.png').list_tiles()
+    assert len(listed) == len(tiles)
+
+    with rasterio.open(os.path.join(path, *[str(i) for i in tiles[-1]]) + '.png') as src:
+        assert src.shape == (64, 64) and src.count == 3
+
+    ragged = tile_bench.make_pyramid(str(tmpdir.join('ragged')), 15, 17, 3, 2, 0.5, 'jpg', 64)
+    assert (ragged[:, 0] == 15).sum() == 4
+    assert (ragged[:, 0] == 17).sum() < (ragged[:, 0] == 16).sum() * 4
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+
+def test_cog_overviews(tmpdir):
+    assert tile_cog.get_overview_sizes(2048, 2048) == [(1024, 1024), (512, 512), (256, 256)]
+    assert tile_cog.get_overview_sizes(256, 256) == []
+
+    options = tile_cog.get_cog_options(untiler.make_src_meta(merc.bounds(10, 10, 5), 512, {'jpeg_quality': 90}))
+    assert options == {'BLOCKSIZE': 256, 'OVERVIEWS': 'FORCE_USE_EXISTING', 'COMPRESS': 'JPEG', 'QUALITY': 90}
+
+    ## colour is weighted by alpha, so a half empty block keeps its colour
+    band = np.zeros((4, 2, 4), dtype=np.uint8)
+    band[:, 0, :2] = [[100, 100], [50, 50], [200, 200], [255, 255]]
+    band[:, :, 2:] = 255
+    assert tile_cog.downsample_band(band)[:, 0].tolist() == [[100, 255], [50, 255], [200, 255], [128, 255]]
+
+    meta = untiler.make_src_meta(merc.bounds(10, 10, 5), 1024, {'compress': 'deflate'})
+    filename = str(tmpdir.join('cog.tif'))
+    with tile_cog.COGWriter(filename, meta) as dst:
+        assert dst.align == 4
+        with pytest.raises(ValueError):
+            dst.write(np.zeros((4, 256, 512), dtype=np.uint8), ((0, 256), (0, 512)))
+        with pytest.raises(ValueError):
+            dst.write(np.zeros((4, 2, 1024), dtype=np.uint8), ((2, 4), (0, 1024)))
+        dst.write(np.full((4, 256, 1024), 255, dtype=np.uint8), ((256, 512), (0, 1024)))
+        ## the intermediates are losslessly compressed
+        for d in dst._dsts:
+            d.close()
+            with rasterio.open(d.name) as raw:
+                assert raw.compression.value == 'ZSTD'
+
+    assert os.listdir(str(tmpdir)) == ['cog.tif']
+    with rasterio.open(filename) as src:
+        assert src.overviews(1) == [2, 4]
+        assert np.allclose(src.bounds, merc.xy_bounds(10, 10, 5))
+        with rasterio.open(filename, overview_level=1) as ovr:
+            assert ovr.read(4)[:, 0].tolist() == [0] * 64 + [255] * 64 + [0] * 128
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
+
+
+def test_prefetch_pool_and_dedup():
+    source = tile_sources.MBTilesSource('tests/fixtures/testtiles.mbtiles')
+    reads = []
+    read = source.read
+
+    def counting_read(z, x, y):
+        reads.append((z, x, y))
+        return read(z, x, y)
+
+    source.read = counting_read
+    args = {'source': source, 'tileResolution': 256, 'decoder': 'gdal', 'cache_bytes': 2 ** 24}
+
+    try:
+        untiler.global_setup(source.path, dict(args, prefetch=2))
+        pool = untiler.prefetchPool
+        untiler.global_setup(source.path, dict(args, prefetch=2))
+        assert untiler.prefetchPool is pool
+
+        ## a setup with another depth gets a pool of that size
+        untiler.global_setup(source.path, dict(args, prefetch=4))
+        assert untiler.prefetchPool is not pool and untiler.prefetchDepth == 4
+
+        ## a fill tile queued twice before it's cached is read once
+        z, x, y = [int(i) for i in source.list_tiles()[0]]
+        paintTiles = [(z, x, y, 2, 0, 0, []), (z, x, y, 2, 0, 0, []), (z, x, y, 1, 0, 0, [])]
+        loaded = list(untiler.load_paint_tiles(paintTiles, range(3)))
+        assert [i for i, _ in loaded] == [0, 1, 2]
+        assert np.array_equal(loaded[0][1], loaded[1][1])
+        assert reads == [(z, x, y)] * 2
+
+        untiler.global_setup(source.path, dict(args, prefetch=0))
+        assert untiler.prefetchPool is None
+    finally:
+        untiler.global_setup(source.path, dict(args, prefetch=0, cache_bytes=None))
+
+    print("# OK - %s " % (inspect.stack()[0][3]))
@@ -2,7 +2,19 @@
 from __future__ import with_statement
 from __future__ import print_function
 from __future__ import division
+import cProfile
+import glob
 import os
+import json
+import pstats
+import re
+import shutil
+import tempfile
+import threading
+import time
+from io import BytesIO
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 
 import click
@@ -10,13 +22,27 @@ import mercantile as merc
 import numpy as np
 import rasterio
 from rasterio import Affine
-from rasterio.warp import reproject
+from rasterio.io import MemoryFile
 try:
-    from rasterio.warp import RESAMPLING as Resampling  # pre-1.0
+    from PIL import Image
 except ImportError:
-    from rasterio.warp import Resampling
+    Image = None
 
 import untiler.scripts.tile_utils as tile_utils
+import untiler.scripts.tile_sources as tile_sources
+import untiler.scripts.tile_cache as tile_cache
+import untiler.scripts.tile_manifest as tile_manifest
+import untiler.scripts.tile_metrics as tile_metrics
+import untiler.scripts.tile_cog as tile_cog
+
+## the manifest of finished composites, and the inventory of tiles incremental
+## runs diff against, kept in the output directory
+MANIFEST_NAME = '.untiler-manifest.jsonl'
+INVENTORY_NAME = '.untiler-inventory.npz'
+## COG scenetifs are assembled in row bands; the buffer for them when --buffer-mb isn't given
+COG_BUFFER_MB = 64
+## a scenetif's temp file (<scenetif>.<pid>.tmp, see get_temp_filename), and anything written alongside it
+TEMP_PATTERN = re.compile(r'^(.+)\.\d+\.tmp(\..+)?$')
 
 
 def make_affine(height, width, ul, lr):
@@ -33,18 +59,108 @@ def affaux(up):
     return Affine(1, 0, 0, 0, -1, 0), Affine(up, 0, 0, 0, -up, 0)
 
 
-def upsample(rgb, up, fr, to):
-    up_rgb = np.empty((rgb.shape[0], rgb.shape[1] * up, rgb.shape[2] * up), dtype=rgb.dtype)
+def cubic_weight(t, a=-0.5):
+    """
+    Keys cubic convolution kernel (the same a=-0.5 kernel GDAL uses)
+    """
+    t = abs(t)
+    if t <= 1:
+        return (a + 2) * t ** 3 - (a + 3) * t ** 2 + 1
+    elif t < 2:
+        return a * t ** 3 - 5 * a * t ** 2 + 8 * a * t - 4 * a
+    return 0.0
+
+
+def get_phase_taps(up, resampling):
+    """
+    For each of the up output pixels covering a source pixel, get the
+    source offsets + weights to interpolate it from (pixel centers aligned)
+    """
+    if resampling == 'nearest':
+        return [([0], [1.0])] * up
+
+    taps = []
+    for p in range(up):
+        c = (p + 0.5) / up - 0.5
+        f = int(np.floor(c))
+        t = c - f
+        if resampling == 'bilinear':
+            taps.append(([f, f + 1], [1 - t, t]))
+        elif resampling == 'cubic':
+            taps.append(([f - 1, f, f + 1, f + 2],
+                [cubic_weight(t + 1), cubic_weight(t), cubic_weight(1 - t), cubic_weight(2 - t)]))
+        else:
+            raise ValueError("Unknown resampling %s" % (resampling))
+
+    return taps
 
-    reproject(
-        rgb, up_rgb,
-        src_transform=fr,
-        dst_transform=to,
-        src_crs="EPSG:3857",
-        dst_crs="EPSG:3857",
-        resampling=Resampling.bilinear)
 
-    return up_rgb
+def upsample_array(imdata, up, resampling='bilinear', out=None, window=None):
+    """
+    Upsample a (bands, rows, cols) array by an integer factor of up.
+    Separable, with weights that repeat every up pixels, so each pass is
+    a handful of whole-array multiply-adds. Edges are clamped. window
+    ((row start, row stop), (col start, col stop)) in output pixels, each a
+    multiple of up, limits the output to that sub-block; out is an optional
+    output buffer of the window's shape
+    """
+    bands, h, w = imdata.shape
+    (r0, r1), (c0, c1) = window or ((0, h * up), (0, w * up))
+
+    if r0 % up or r1 % up or c0 % up or c1 % up:
+        raise ValueError("Upsample window must align to multiples of %s" % (up))
+
+    sr0, sr1, sc0, sc1 = r0 // up, r1 // up, c0 // up, c1 // up
+    nr, nc = sr1 - sr0, sc1 - sc0
+
+    if out is None:
+        out = np.empty((bands, nr * up, nc * up), dtype=imdata.dtype)
+
+    if resampling == 'nearest':
+        out.reshape(bands, nr, up, nc, up)[:] = imdata[:, sr0:sr1, None, sc0:sc1, None]
+        return out
+
+    taps = get_phase_taps(up, resampling)
+
+    ## source window, padded by 2 pixels of real neighbours or clamped edges
+    pad = 2
+    lr, hr, lc, hc = max(sr0 - pad, 0), min(sr1 + pad, h), max(sc0 - pad, 0), min(sc1 + pad, w)
+    src = np.pad(imdata[:, lr:hr, lc:hc].astype(np.float32),
+        ((0, 0), (pad - (sr0 - lr), pad - (hr - sr1)), (pad - (sc0 - lc), pad - (hc - sc1))),
+        mode='edge')
+
+    ## interpolate columns at source row count first ...
+    cols = np.empty((bands, nr + 2 * pad, nc, up), dtype=np.float32)
+    for q, (offsets, weights) in enumerate(taps):
+        acc = cols[:, :, :, q]
+        acc[:] = 0
+        for o, wt in zip(offsets, weights):
+            acc += np.float32(wt) * src[:, :, pad + o:pad + o + nc]
+    cols = cols.reshape(bands, nr + 2 * pad, nc * up)
+
+    ## ... then rows, so each output phase is written as whole rows
+    integer = np.issubdtype(out.dtype, np.integer)
+    outRows = out.reshape(bands, nr, up, nc * up)
+    acc = np.empty((bands, nr, nc * up), dtype=np.float32)
+    for p, (offsets, weights) in enumerate(taps):
+        acc[:] = 0
+        for o, wt in zip(offsets, weights):
+            acc += np.float32(wt) * cols[:, pad + o:pad + o + nr]
+        if integer:
+            acc += 0.5
+            np.floor(acc, out=acc)
+            np.clip(acc, np.iinfo(out.dtype).min, np.iinfo(out.dtype).max, out=acc)
+        outRows[:, :, p] = acc
+
+    return out
+
+
+def upsample(rgb, up, fr=None, to=None, resampling='bilinear'):
+    """
+    Upsample an image array by an integer factor. fr + to (see affaux)
+    are no longer needed, and kept for compatibility
+    """
+    return upsample_array(rgb, up, resampling)
 
 
 def make_src_meta(bounds, size, creation_opts={}):
@@ -78,6 +194,43 @@ def make_src_meta(bounds, size, creation_opts={}):
     return src_meta
 
 
+def get_temp_filename(filename):
+    """
+    Where a scenetif is written before it's renamed into place, so a run that
+    dies never leaves a partial scenetif under its final name
+    """
+    return '%s.%s.tmp' % (filename, os.getpid())
+
+
+def remove_temp_files(filenames):
+    """
+    Remove the temp files any process left writing these scenetifs (and
+    anything written alongside them), listing each directory once however
+    many scenetifs it holds. Returns how many were removed
+    """
+    names = defaultdict(set)
+    for filename in filenames:
+        names[os.path.dirname(filename)].add(os.path.basename(filename))
+
+    removed = 0
+    for directory, scenes in names.items():
+        try:
+            entries = os.listdir(directory or '.')
+        except OSError:
+            continue
+        for entry in entries:
+            match = TEMP_PATTERN.match(entry)
+            if match and match.group(1) in scenes:
+                os.remove(os.path.join(directory, entry))
+                removed += 1
+
+    return removed
+
+
+def is_url(path):
+    return path.startswith(('http://', 'https://'))
+
+
 def make_window(x, y, xmin, ymin, windowsize):
     """
     Create a window for writing a child tile to a parent output tif
@@ -94,6 +247,12 @@ def make_window(x, y, xmin, ymin, windowsize):
 
 
 globalArgs = None
+tileCache = None
+sharedTiles = None
+prefetchPool = None
+prefetchDepth = 0
+stageTimer = tile_metrics.StageTimer()
+profiler = None
 
 
 def make_image_array(imdata, outputSize):
@@ -125,8 +284,18 @@ def load_image_data(imdata, outputSize):
 
 
 def global_setup(inputDir, args):
-    global globalArgs
+    global globalArgs, tileCache, sharedTiles, profiler, prefetchPool, prefetchDepth
     globalArgs = args
+    ## a setup with another prefetch depth (eg bench's runs in one process) gets its own pool
+    if prefetchPool is not None and prefetchDepth != (args.get('prefetch') or 0):
+        prefetchPool.shutdown(wait=False)
+        prefetchPool = None
+    prefetchDepth = args.get('prefetch') or 0
+    if prefetchPool is None and prefetchDepth > 0:
+        prefetchPool = ThreadPoolExecutor(prefetchDepth)
+    tileCache = tile_cache.TileCache(args['cache_bytes']) if args.get('cache_bytes') else None
+    sharedTiles = np.load(args['tiles'], mmap_mode='r') if args.get('tiles') else None
+    profiler = cProfile.Profile() if args.get('profile') else None
 
 
 def logwriter(openLogFile, writeObj):
@@ -135,61 +304,413 @@ def logwriter(openLogFile, writeObj):
         return
 
 
-def streaming_tile_worker(data):
-    size = 2 ** (data['zMax'] - globalArgs['compositezoom']) * globalArgs['tileResolution']
-    out_meta = make_src_meta(merc.bounds(data['x'], data['y'], data['z']), size, globalArgs['creation_opts'])
-    z, x, y = [int(i) for i in (data['z'], data['x'], data['y'])]
-    filename = globalArgs['sceneTemplate'] % (z, x, y)
-    subtiler = tile_utils.TileUtils()
-    log = 'FILE: %s\n' % filename
+def decode_tile(data):
+    """
+    Decode an encoded (jpg / png / tif) tile from memory
+    """
+    with MemoryFile(data) as memfile:
+        with memfile.open() as src:
+            return src.read()
+
+
+def decode_tile_pillow(data, out):
+    """
+    Decode a jpg tile with Pillow, and copy its pixels into a (4, size, size)
+    uint8 RGBA buffer, matching make_image_array. Pillow can't decode into a
+    buffer it doesn't own, so the pixels are copied once out of Pillow's
+    interleaved image. Returns None for anything left to GDAL: pngs (GDAL's
+    png decoding outpaces Pillow's), other modes, and tiles of another size
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    img = Image.open(BytesIO(data))
+
+    ## the header is read lazily on open, so this is checked before decoding
+    if img.mode not in ('L', 'RGB', 'RGBA') or img.size != (out.shape[2], out.shape[1]):
+        return None
+
+    imdata = np.asarray(img)
+
+    if img.mode == 'L':
+        out[:3] = imdata
+    else:
+        out[:imdata.shape[2]] = np.moveaxis(imdata, 2, 0)
+
+    if img.mode != 'RGBA':
+        out[3] = 255
+
+    return out
+
+
+def load_tile(z, x, y, out=None):
+    """
+    Read a tile from the worker's source as a (4, size, size) RGBA array
+    """
+    start = time.perf_counter()
+    data = globalArgs['source'].read(z, x, y)
+    stageTimer.add('read', start, 1, len(data))
+
+    return decode_image(data, out)
+
+
+def decode_image(data, out=None):
+    """
+    Decode a tile to a (4, size, size) RGBA array, with Pillow into out
+    when that decoder is selected and falling back to GDAL
+    """
+    start = time.perf_counter()
+
+    if globalArgs.get('decoder') == 'pillow':
+        if out is None:
+            out = np.empty((4, globalArgs['tileResolution'], globalArgs['tileResolution']), dtype=np.uint8)
+        if decode_tile_pillow(data, out) is not None:
+            stageTimer.add('decode', start, 1, len(data))
+            return out
+
+    imdata = make_image_array(decode_tile(data), globalArgs['tileResolution'])
+    stageTimer.add('decode', start, 1, len(data))
+    return imdata
+
+
+def load_fill_tile(z, x, y, out=None):
+    """
+    Load a fill tile through the worker's tile cache, so neighbouring
+    composites filling from the same ancestor decode it once
+    """
+    if tileCache is None:
+        return load_tile(z, x, y, out)
+
+    imdata = tileCache.get((z, x, y))
+    if imdata is None:
+        imdata = tileCache.put((z, x, y), load_tile(z, x, y))
+
+    return imdata
+
+
+def load_paint_tiles(paintTiles, indices, tileBuffer=None):
+    """
+    Yield (index, image array) for paintTiles[index] in the order of indices.
+    With globalArgs['prefetch'] set, up to that many upcoming tiles are read and
+    decoded on a per-process thread pool while the current one is painted,
+    which hides per-file latency on network tile stores. Memory stays bounded
+    at one decoded tile per queued read
+    """
+    if getattr(globalArgs['source'], 'fetch_many', None) is not None:
+        for loaded in fetch_paint_tiles(paintTiles, indices, tileBuffer):
+            yield loaded
+        return
+
+    depth = globalArgs.get('prefetch') or 0
+
+    if depth < 1 or prefetchPool is None:
+        for i in indices:
+            z, x, y, up = paintTiles[i][:4]
+            try:
+                yield i, load_fill_tile(z, x, y, tileBuffer) if up > 1 else load_tile(z, x, y, tileBuffer)
+            except Exception as e:
+                click.echo("%s errored" % (globalArgs['source'].describe(z, x, y)), err=True)
+                raise e
+        return
+
+    pending = deque()
+    indices = iter(indices)
+    ## fill tiles queued but not yet cached, so a repeat shares the first read
+    inflight = {}
+
+    def submit():
+        for i in indices:
+            z, x, y, up = paintTiles[i][:4]
+            if up > 1 and tileCache is not None:
+                loaded = tileCache.get((z, x, y))
+                if loaded is None:
+                    loaded = inflight.get((z, x, y))
+                if loaded is None:
+                    loaded = inflight[(z, x, y)] = prefetchPool.submit(load_tile, z, x, y)
+            else:
+                loaded = prefetchPool.submit(load_tile, z, x, y)
+            pending.append((i, loaded))
+            return
+
+    for _ in range(depth):
+        submit()
+
+    while pending:
+        i, loaded = pending.popleft()
+        submit()
+        z, x, y, up = paintTiles[i][:4]
+
+        if isinstance(loaded, np.ndarray):
+            yield i, loaded
+            continue
+
+        try:
+            imdata = loaded.result()
+        except Exception as e:
+            for _, f in pending:
+                if not isinstance(f, np.ndarray):
+                    f.cancel()
+            click.echo("%s errored" % (globalArgs['source'].describe(z, x, y)), err=True)
+            raise e
+
+        if up > 1 and tileCache is not None:
+            imdata = tileCache.put((z, x, y), imdata)
+            inflight.pop((z, x, y), None)
+
+        yield i, imdata
+
+
+def fetch_paint_tiles(paintTiles, indices, tileBuffer=None):
+    """
+    Like load_paint_tiles, for sources that fetch many tiles at once (eg over
+    HTTP): every uncached tile is requested up front and streamed back in
+    order, while this thread decodes + paints
+    """
+    indices = list(indices)
+    cached = {}
+    if tileCache is not None:
+        for i in indices:
+            z, x, y, up = paintTiles[i][:4]
+            imdata = tileCache.get((z, x, y)) if up > 1 else None
+            if imdata is not None:
+                cached[i] = imdata
+
+    bodies = globalArgs['source'].fetch_many([paintTiles[i][:3] for i in indices if i not in cached])
+
     try:
-        with rasterio.open(filename, 'w', **out_meta) as dst:
-            if data['zMaxCov']:
-                superTiles = subtiler.get_super_tiles(data['zMaxTiles'], data['zMaxCov'])
+        for i in indices:
+            if i in cached:
+                yield i, cached[i]
+                continue
+
+            z, x, y, up = paintTiles[i][:4]
+            keep = up > 1 and tileCache is not None
+            try:
+                start = time.perf_counter()
+                body = next(bodies)
+                stageTimer.add('read', start, 1, len(body))
+                imdata = decode_image(body, None if keep else tileBuffer)
+            except Exception as e:
+                click.echo("%s errored" % (globalArgs['source'].describe(z, x, y)), err=True)
+                raise e
+
+            yield i, tileCache.put((z, x, y), imdata) if keep else imdata
+    finally:
+        bodies.close()
+
+
+def get_uncovered_windows(covered, res):
+    """
+    Get the windows of an upsampled fill tile that no zMax tile paints over, as a
+    list of ((row start, row stop), (col start, col stop)) in the upsampled tile's
+    pixels. covered is the fill tile's (up, up) block of the coverage bitmap; each
+    row of cells is split into runs of uncovered cells, and identical runs in
+    consecutive rows are merged
+    """
+    windows = []
+    open_runs = {}
+
+    for r in range(covered.shape[0] + 1):
+        runs = set()
+        if r < covered.shape[0]:
+            edges = np.flatnonzero(np.diff(np.concatenate(([1], covered[r], [1])).astype(np.int8)))
+            runs = set(zip(edges[::2], edges[1::2]))
+
+        for run in list(open_runs):
+            if run not in runs:
+                c0, c1 = run
+                windows.append(((open_runs.pop(run) * res, r * res), (c0 * res, c1 * res)))
 
-                fillbaseX, fillbaseY = subtiler.get_sub_base_zoom(data['x'], data['y'], data['z'], data['zMaxCov'])
+        for run in runs:
+            open_runs.setdefault(run, r)
 
-                ## fill thresh == the number of sub tiles that would need to occur in a fill tile to not fill (eg completely covered)
-                fThresh = 4 ** (data['zMax'] - data['zMaxCov'])
+    return sorted(windows)
 
-                fDiff = 2 ** (data['zMax'] - data['zMaxCov'])
 
-                toFaux, frFaux = affaux(fDiff)
+def get_fill_sources(fillTiles, covered, z, x, y, zMax):
+    """
+    Map each zMax cell of a composite to the finest fill tile beneath it:
+    the index into fillTiles (coarsest first) to fill the cell from, or -1
+    where a zMax tile covers the cell or there is nothing to fill from.
+    Fill tiles may be ancestors that extend past the composite
+    """
+    subtiler = tile_utils.TileUtils()
+    baseX, baseY = subtiler.get_sub_base_zoom(x, y, z, zMax)
+    cells = covered.shape[0]
+    sources = np.full((cells, cells), -1, dtype=np.int64)
 
-                if not globalArgs['no_fill']:
-                    print('filling')
-                    ## Read and write the fill tiles first
-                    for t in subtiler.get_fill_super_tiles(superTiles, data['maxCovTiles'], fThresh):
-                        z, x, y = [int(i) for i in t]
-                        path = globalArgs['readTemplate'] % (z, x, y)
-                        log += '%s %s %s\n' % (z, x, y)
+    for i, (tz, tx, ty) in enumerate(fillTiles):
+        d = 2 ** (zMax - int(tz))
+        row, col = int(ty) * d - baseY, int(tx) * d - baseX
+        sources[max(row, 0):max(row + d, 0), max(col, 0):max(col + d, 0)] = i
 
-                        with rasterio.open(path) as src:
-                            imdata = src.read()
+    sources[covered] = -1
 
-                        imdata = make_image_array(imdata, globalArgs['tileResolution'])
+    return sources
 
-                        imdata = upsample(imdata, fDiff, frFaux, toFaux)
 
-                        window = make_window(x, y, fillbaseX, fillbaseY, globalArgs['tileResolution'] * fDiff)
-                        dst.write(imdata, window=window)
+def get_paint_tiles(data):
+    """
+    Plan the tiles to paint into a composite, in paint order (fill tiles first),
+    as a list of (z, x, y, upsample factor, row, col, windows). windows are the
+    parts of the upsampled tile to paint. Fill cascades through every level from
+    the finest complete one up to zMax: each zMax cell without a zMax tile is filled from the
+    finest tile above it, so each fill tile is read once, and only for the
+    blocks that no finer tile covers
+    """
+    subtiler = tile_utils.TileUtils()
+    res = globalArgs['tileResolution']
+    paintTiles = []
 
+    baseX, baseY = subtiler.get_sub_base_zoom(data['x'], data['y'], data['z'], data['zMax'])
 
-            baseX, baseY = subtiler.get_sub_base_zoom(data['x'], data['y'], data['z'], data['zMax'])
+    fillTiles = data.get('fillTiles')
+    if fillTiles is None:
+        fillTiles = data['maxCovTiles'] if data['zMaxCov'] else []
 
-            for t in data['zMaxTiles']:
-                z, x, y = [int(i) for i in t]
-                path = globalArgs['readTemplate'] % (z, x, y)
-                log += '%s %s %s\n' % (z, x, y)
+    if len(fillTiles) and not globalArgs['no_fill']:
+        print('filling')
+        ## zMax coverage of the composite, one cell per zMax tile
+        cells = 2 ** (data['zMax'] - data['z'])
+        covered = np.zeros((cells, cells), dtype=bool)
+        zMaxTiles = np.asarray(data['zMaxTiles'], dtype=np.int64).reshape(-1, 3)
+        covered[zMaxTiles[:, 2] - baseY, zMaxTiles[:, 1] - baseX] = True
 
-                with rasterio.open(path) as src:
-                    imdata = src.read()
+        sources = get_fill_sources(fillTiles, covered, data['z'], data['x'], data['y'], data['zMax'])
 
-                imdata = make_image_array(imdata, globalArgs['tileResolution'])
+        for i, t in enumerate(fillTiles):
+            z, x, y = [int(v) for v in t]
+            fDiff = 2 ** (data['zMax'] - z)
+            ## the fill tile's cells, clipped to the composite (ancestor tiles start outside it)
+            cellRow, cellCol = y * fDiff - baseY, x * fDiff - baseX
+            r0, c0 = max(cellRow, 0), max(cellCol, 0)
+            windows = [((w0 + (r0 - cellRow) * res, w1 + (r0 - cellRow) * res), (v0 + (c0 - cellCol) * res, v1 + (c0 - cellCol) * res))
+                for (w0, w1), (v0, v1) in get_uncovered_windows(sources[r0:cellRow + fDiff, c0:cellCol + fDiff] != i, res)]
+            if windows:
+                paintTiles.append((z, x, y, fDiff, cellRow * res, cellCol * res, windows))
+
+    for t in data['zMaxTiles']:
+        z, x, y = [int(i) for i in t]
+        (row, _), (col, _) = make_window(x, y, baseX, baseY, res)
+        paintTiles.append((z, x, y, 1, row, col, [((0, res), (0, res))]))
+
+    return paintTiles
+
+
+def upsample_window(imdata, up, window):
+    """
+    Upsample one window of a tile, widening it to a multiple of up as
+    upsample_array needs and trimming the result back
+    """
+    if up == 1:
+        (r0, r1), (c0, c1) = window
+        return imdata[:, r0:r1, c0:c1]
+
+    start = time.perf_counter()
+    (r0, r1), (c0, c1) = window
+    a0, a1, b0, b1 = r0 // up * up, -(-r1 // up) * up, c0 // up * up, -(-c1 // up) * up
+    out = upsample_array(imdata, up, globalArgs.get('resampling', 'bilinear'), window=((a0, a1), (b0, b1)))
+    out = out[:, r0 - a0:r1 - a0, c0 - b0:c1 - b0]
+    stageTimer.add('fill', start, 1, out.nbytes)
+    return out
+
+
+def get_band_rows(size, tileResolution, blockysize, bufferBytes):
+    """
+    Get the height of the row bands to assemble a composite in: as many rows
+    as fit in bufferBytes, aligned to both output blocks and input tiles
+    (and at least one of each)
+    """
+    unit = int(np.lcm(tileResolution, blockysize))
+    bandRows = (bufferBytes // (4 * size)) // unit * unit
+    return int(min(size, max(unit, bandRows)))
 
-                window = make_window(x, y, baseX, baseY, globalArgs['tileResolution'])
 
-                dst.write(imdata, window=window)
+def paint_rows(paintTiles, r0, r1, band, tileBuffer=None):
+    """
+    Paint the rows r0:r1 of a composite into band (zeroed first), returning
+    the indices of the paint tiles that landed in it
+    """
+    res = globalArgs['tileResolution']
+    band.fill(0)
+
+    bandWindows = {}
+    for i, (z, x, y, up, row, col, windows) in enumerate(paintTiles):
+        if row >= r1 or row + res * up <= r0:
+            continue
+
+        windows = [((max(w0, r0 - row), min(w1, r1 - row)), cols) for (w0, w1), cols in windows]
+        windows = [w for w in windows if w[0][0] < w[0][1]]
+        if windows:
+            bandWindows[i] = windows
+
+    painted = sorted(bandWindows)
+
+    for i, imdata in load_paint_tiles(paintTiles, painted, tileBuffer):
+        z, x, y, up, row, col, _ = paintTiles[i]
+        for (w0, w1), (c0, c1) in bandWindows[i]:
+            band[:, row + w0 - r0:row + w1 - r0, col + c0:col + c1] = upsample_window(imdata, up, ((w0, w1), (c0, c1)))
+
+    return painted
+
+
+def get_composite_size(data):
+    return 2 ** (int(data['zMax']) - globalArgs['compositezoom']) * globalArgs['tileResolution']
+
+
+def streaming_tile_worker(data):
+    if 'zMaxTiles' not in data:
+        data = tile_utils.TileUtils().load_job(data, sharedTiles)
+
+    size = get_composite_size(data)
+    out_meta = make_src_meta(merc.bounds(data['x'], data['y'], data['z']), size, globalArgs['creation_opts'])
+    z, x, y = [int(i) for i in (data['z'], data['x'], data['y'])]
+    filename = globalArgs['sceneTemplate'] % (z, x, y)
+    res = globalArgs['tileResolution']
+    log = 'FILE: %s\n' % filename
+    path = filename
+    tileBuffer = np.empty((4, res, res), dtype=np.uint8)
+    tmpname = get_temp_filename(filename)
+    cog = globalArgs.get('cog')
+    try:
+        paintTiles = get_paint_tiles(data)
+
+        with (tile_cog.COGWriter(tmpname, out_meta) if cog else rasterio.open(tmpname, 'w', **out_meta)) as dst:
+            if not globalArgs.get('buffer_bytes'):
+                ## Write tile by tile
+                for i, imdata in load_paint_tiles(paintTiles, range(len(paintTiles)), tileBuffer):
+                    z, x, y, up, row, col, windows = paintTiles[i]
+                    path = globalArgs['source'].describe(z, x, y)
+                    log += '%s %s %s\n' % (z, x, y)
+
+                    for (r0, r1), (c0, c1) in windows:
+                        painted = upsample_window(imdata, up, ((r0, r1), (c0, c1)))
+                        start = time.perf_counter()
+                        dst.write(painted, window=((row + r0, row + r1), (col + c0, col + c1)))
+                        stageTimer.add('write', start, 0, painted.nbytes)
+            else:
+                ## Assemble block-aligned row bands in memory, and write each in one call
+                log += ''.join('%s %s %s\n' % t[:3] for t in paintTiles)
+
+                rowAlign = int(out_meta.get('blockysize', 256))
+                if cog:
+                    rowAlign = int(np.lcm(rowAlign, dst.align))
+                bandRows = get_band_rows(size, res, rowAlign, globalArgs['buffer_bytes'])
+                band = np.empty((4, bandRows, size), dtype=np.uint8)
+
+                for r0 in range(0, size, bandRows):
+                    r1 = min(r0 + bandRows, size)
+                    if paint_rows(paintTiles, r0, r1, band[:, :r1 - r0], tileBuffer):
+                        start = time.perf_counter()
+                        dst.write(band[:, :r1 - r0], window=((r0, r1), (0, size)))
+                        stageTimer.add('write', start, 0, band[:, :r1 - r0].nbytes)
+
+            ## closing flushes (+ encodes) the last blocks
+            start = time.perf_counter()
+
+        stageTimer.add('write', start, (size // res) ** 2)
+        os.replace(tmpname, filename)
+
         if globalArgs['logdir']:
             with open(os.path.join(globalArgs['logdir'], '%s.log' % os.path.basename(filename)), 'w') as logger:
                 logwriter(logger, log)
@@ -198,33 +719,211 @@ def streaming_tile_worker(data):
 
     except Exception as e:
         click.echo("%s errored" % (path), err=True)
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
         raise e
 
 
-def inspect_dir(inputDir, zoom, read_template):
-    tiler = tile_utils.TileUtils()
+def streaming_tile_batch(jobs):
+    """
+    Make a batch of composites (eg that share fill ancestors, so the tile cache
+    gets hits) in one worker. Returns a ((z, x, y), filename, seconds, stage
+    metrics) per composite, and the cache hits + misses the batch added
+    """
+    before = tileCache.stats() if tileCache else {'hits': 0, 'misses': 0}
+
+    results = []
+    for data in jobs:
+        start = time.time()
+        stageTimer.reset()
+        filename = streaming_tile_worker(data)
+        results.append(((int(data['z']), int(data['x']), int(data['y'])), filename, time.time() - start, stageTimer.collect()))
+
+    after = tileCache.stats() if tileCache else {'hits': 0, 'misses': 0}
+
+    return results, dict((k, after[k] - before[k]) for k in after)
+
+
+def streaming_band_worker(task):
+    """
+    Render rows r0:r1 of a composite too big for one worker, for the parent
+    process (the only writer) to write. Returns the composite's (z, x, y), the
+    rows, the band (None when nothing landed in it), the [z, x, y]s painted,
+    seconds taken, stage metrics and the cache hits + misses added
+    """
+    data, r0, r1 = task
+    start = time.time()
+    stageTimer.reset()
+    before = tileCache.stats() if tileCache else {'hits': 0, 'misses': 0}
+
+    if 'zMaxTiles' not in data:
+        data = tile_utils.TileUtils().load_job(data, sharedTiles)
+
+    paintTiles = get_paint_tiles(data)
+    band = np.empty((4, r1 - r0, get_composite_size(data)), dtype=np.uint8)
+    painted = paint_rows(paintTiles, r0, r1, band, np.empty((4, globalArgs['tileResolution'], globalArgs['tileResolution']), dtype=np.uint8))
+
+    after = tileCache.stats() if tileCache else {'hits': 0, 'misses': 0}
+
+    return ((int(data['z']), int(data['x']), int(data['y'])), r0, r1,
+        band if painted else None, [paintTiles[i][:3] for i in painted],
+        time.time() - start, stageTimer.collect(), dict((k, after[k] - before[k]) for k in after))
+
+
+def streaming_task(task):
+    """
+    Run a scheduled task: ('batch', jobs) or ('band', (job, r0, r1)). With
+    profiling on, the worker's profile so far is saved after each task
+    """
+    kind, args = task
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if kind == 'band':
+            return kind, streaming_band_worker(args)
+        return kind, streaming_tile_batch(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(globalArgs['profile'], 'worker-%s.pstats' % os.getpid()))
+
+
+def limit_bands(tasks, slots, stopping):
+    """
+    Yield tasks, taking one of slots (a semaphore, released as the parent
+    writes each band) before each band task, so at most that many rendered
+    bands are ever queued up for the parent. Pool feeds tasks from its own
+    thread, so only that thread waits. Stops when stopping is set
+    """
+    for task in tasks:
+        if task[0] == 'band':
+            slots.acquire()
+            if stopping.is_set():
+                return
+        yield task
+
+
+def merge_profiles(profileDir, since):
+    """
+    Merge the per process profiles saved in profileDir since a time into one
+    untiler.pstats, returning its path (or None if there were none)
+    """
+    paths = [p for p in glob.glob(os.path.join(profileDir, '*-*.pstats')) if os.path.getmtime(p) >= since]
+    if not paths:
+        return None
 
-    allFiles = tiler.search_dir(inputDir)
+    merged = os.path.join(profileDir, 'untiler.pstats')
+    pstats.Stats(*sorted(paths)).dump_stats(merged)
+    return merged
 
-    template, readTemplate, separator = tile_utils.parse_template("%s/%s" % (inputDir, read_template))
 
-    allTiles = np.array([i for i in tiler.get_tiles(allFiles, template, separator)])
+def write_schedule_report(path, rows):
+    """
+    Write each composite's cost model features, predicted + actual seconds as
+    JSON lines, then a summary with the cost weights refit to the actual times
+    """
+    with open(path, 'w') as ofile:
+        for row in rows:
+            ofile.write(json.dumps(row) + '\n')
+
+        summary = {
+            'jobs': len(rows),
+            'predicted': sum(r['predicted'] for r in rows),
+            'actual': sum(r['actual'] for r in rows),
+            'weights': tile_utils.COST_WEIGHTS
+        }
+
+        if len(rows) > 1:
+            features = np.array([[r['reads'], r['cells']] for r in rows], dtype=np.float64)
+            fitted, _, _, _ = np.linalg.lstsq(features, np.array([r['actual'] for r in rows]), rcond=None)
+            summary['fitted'] = {'read': float(fitted[0]), 'cell': float(fitted[1])}
+
+        ofile.write(json.dumps({'summary': summary}) + '\n')
+
+
+def inspect_dir(inputDir, zoom, read_template, index=None):
+    tiler = tile_utils.TileUtils()
+
+    allTiles = tile_sources.DirectorySource(inputDir, read_template, index).list_tiles(minzoom=zoom, maxzoom=zoom)
 
     allTiles, _, _, _, _ = tiler.select_tiles(allTiles, zoom)
 
     for t in allTiles:
-        z, x, y = t
+        z, x, y = [int(i) for i in t]
         click.echo([x, y, z])
 
 
-def stream_dir(inputDir, outputDir, compositezoom, maxzoom, logdir, read_template, scene_template, workers, creation_opts, no_fill, tile_resolution=256):
+def stream_dir(inputDir, outputDir, compositezoom, maxzoom, logdir, read_template, scene_template, workers, creation_opts, no_fill, tile_resolution=256, bounds=None, index=None, **options):
+    """
+    Mosaic a directory of tiles; options are passed on to stream_source
+    """
+    source = tile_sources.DirectorySource(inputDir, read_template, index)
+
+    return stream_source(source, outputDir=outputDir, compositezoom=compositezoom, maxzoom=maxzoom, logdir=logdir, scene_template=scene_template,
+        workers=workers, creation_opts=creation_opts, no_fill=no_fill, tile_resolution=tile_resolution, bounds=bounds, **options)
+
+
+def stream_mbtiles(mbtiles, outputDir, compositezoom, maxzoom, logdir, scene_template, workers, creation_opts, no_fill, tile_resolution=256, bounds=None, **options):
+    """
+    Mosaic the tiles of an MBTiles; options are passed on to stream_source
+    """
+    source = tile_sources.MBTilesSource(mbtiles)
+
+    return stream_source(source, outputDir=outputDir, compositezoom=compositezoom, maxzoom=maxzoom, logdir=logdir, scene_template=scene_template,
+        workers=workers, creation_opts=creation_opts, no_fill=no_fill, tile_resolution=tile_resolution, bounds=bounds, **options)
+
+
+def stream_tar(tarPath, outputDir, compositezoom, maxzoom, logdir, read_template, scene_template, workers, creation_opts, no_fill, tile_resolution=256, bounds=None, concurrency=16, retries=3, **options):
+    """
+    Mosaic the tiles inside a tar archive, local or at an http(s) url (read
+    with range requests); options are passed on to stream_source
+    """
+    if is_url(tarPath):
+        source = tile_sources.HTTPTarSource(tarPath, read_template, concurrency, retries)
+    else:
+        source = tile_sources.TarSource(tarPath, read_template)
+
+    return stream_source(source, outputDir=outputDir, compositezoom=compositezoom, maxzoom=maxzoom, logdir=logdir, scene_template=scene_template,
+        workers=workers, creation_opts=creation_opts, no_fill=no_fill, tile_resolution=tile_resolution, bounds=bounds, **options)
+
+
+def stream_http(urlTemplate, tileList, outputDir, compositezoom, maxzoom, logdir, scene_template, workers, creation_opts, no_fill, tile_resolution=256, bounds=None, concurrency=16, retries=3, **options):
+    """
+    Mosaic the tiles of a tile list from an HTTP endpoint; options are passed on to stream_source
+    """
+    source = tile_sources.HTTPSource(urlTemplate, tileList, concurrency, retries)
+
+    return stream_source(source, outputDir=outputDir, compositezoom=compositezoom, maxzoom=maxzoom, logdir=logdir, scene_template=scene_template,
+        workers=workers, creation_opts=creation_opts, no_fill=no_fill, tile_resolution=tile_resolution, bounds=bounds, **options)
+
+
+def stream_source(source, outputDir, compositezoom, maxzoom, logdir, scene_template, workers, creation_opts, no_fill, tile_resolution=256, bounds=None, decoder='gdal', buffer_mb=None, resampling='bilinear', cache_mb=64, order='hilbert', chunksize=1, longest_first=True, schedule_report=None, split_mb=256, prefetch=4, resume=False, incremental=False, dry_run=False, metrics=None, profile=None, cog=False):
+    """
+    Mosaic all of a tile source's tiles into composite zoom scenetifs.
+    Finished composites are recorded in a manifest in outputDir; resuming
+    skips those whose inputs are unchanged. Incremental runs only make the
+    composites touched by tiles that changed since the last incremental run.
+    A dry run lists the scenetifs that would be made. metrics is a file to
+    write each composite's per stage timings to. With a profile directory,
+    planning and every worker are profiled, and the profiles merged into
+    one pstats file. With cog, scenetifs are written as Cloud Optimized
+    GeoTIFFs, with overviews averaged from the bands as they're assembled.
+    Returns the fill tile cache's hit + miss counts, which the metrics
+    summary reports too
+    """
     tiler = tile_utils.TileUtils()
+    runStart = time.time()
 
-    allFiles = tiler.search_dir(inputDir)
+    if profile:
+        if not os.path.isdir(profile):
+            os.makedirs(profile)
+        planProfiler = cProfile.Profile()
+        planProfiler.enable()
 
-    template, readTemplate, separator = tile_utils.parse_template("%s/%s" % (inputDir, read_template))
+    if decoder == 'pillow' and Image is None:
+        raise ValueError("The pillow decoder requires Pillow to be installed")
 
-    allTiles = np.array([i for i in tiler.get_tiles(allFiles, template, separator)])
+    allTiles = source.list_tiles(maxzoom=maxzoom, bounds=bounds)
 
     if allTiles.shape[0] == 0 or allTiles.shape[1] != 3:
         raise ValueError("No tiles were found for that template")
@@ -235,28 +934,299 @@ def stream_dir(inputDir, outputDir, compositezoom, maxzoom, logdir, read_templat
     if allTiles.shape[0] == 0:
         raise ValueError("No tiles were found below that maxzoom")
 
+    if bounds:
+        allTiles = tiler.filter_bounds(allTiles, bounds)
+
+    if allTiles.shape[0] == 0:
+        raise ValueError("No tiles were found within those bounds")
+
+    discoveredAt = time.time()
+
     _, sceneTemplate, _ = tile_utils.parse_template("%s/%s" % (outputDir, scene_template))
 
-    pool = Pool(workers, global_setup, (inputDir, {
-        'maxzoom': maxzoom,
-        'readTemplate': readTemplate,
-        'outputDir': outputDir,
-        'tileResolution': tile_resolution,
-        'compositezoom': compositezoom,
-        'fileTemplate': '%s/%s_%s_%s_%s.tif',
-        'sceneTemplate': sceneTemplate,
-        'logdir': logdir,
-        'creation_opts': creation_opts,
-        'no_fill': no_fill
-        }))
+    ## tiles above the composite zoom can only fill the composites beneath them
+    ancestorTiles = allTiles[allTiles[:, 0] < compositezoom]
+    allTiles = allTiles[allTiles[:, 0] >= compositezoom]
+
+    if allTiles.shape[0] == 0:
+        raise ValueError("No tiles were found at or below the composite zoom")
 
     superTiles = tiler.get_super_tiles(allTiles, compositezoom)
 
-    for p in pool.imap_unordered(streaming_tile_worker, tiler.get_sub_tiles(allTiles, superTiles)):
+    ## sort once up front, so jobs can be sent to workers as slices of one shared array
+    allTiles, superTiles, runStarts, runEnds = tiler.get_tile_runs(allTiles, superTiles)
+
+    jobs = tiler.get_sub_tiles(allTiles, superTiles, runs=(runStarts, runEnds))
+
+    if len(ancestorTiles) and not no_fill:
+        jobs = tiler.get_ancestor_fill(jobs, ancestorTiles)
+
+    jobs = tiler.order_jobs(jobs, order)
+
+    ## a rerun skips composites finished (per the manifest) from the same inputs
+    settings = {'source': source.path, 'compositezoom': compositezoom, 'tileResolution': tile_resolution,
+        'sceneTemplate': sceneTemplate, 'creation_opts': creation_opts, 'no_fill': no_fill,
+        'decoder': decoder, 'resampling': resampling}
+    if cog:
+        settings['cog'] = True
+    inputHashes = dict(((int(j['z']), int(j['x']), int(j['y'])), tiler.get_job_hash(j, settings)) for j in jobs)
+
+    planned = len(jobs)
+    emptied = []
+
+    if incremental:
+        inventory = tile_manifest.TileInventory(os.path.join(outputDir, INVENTORY_NAME))
+        inputTiles = allTiles if no_fill else np.concatenate((ancestorTiles, allTiles)).astype(np.int32)
+        stamps = source.get_stamps(inputTiles)
+        if stamps is None:
+            raise ValueError("Incremental runs need a tile source that can tell when tiles change")
+
+        previous = inventory.load(settings)
+        if previous is None:
+            click.echo("No inventory from an earlier incremental run with these options; making every composite", err=True)
+        else:
+            ## redo the composites that changed tiles touch, and any whose scenetif is gone
+            added, removed, changed = tiler.get_changed_tiles(previous[0], previous[1], inputTiles, stamps)
+            click.echo("%s added, %s removed, %s changed tiles" % (len(added), len(removed), len(changed)), err=True)
+            affected = set(id(j) for j in tiler.get_affected_jobs(jobs, np.concatenate((added, changed)), compositezoom, removed))
+            ## composites whose tiles were all removed have no job, so their scenetifs are removed instead
+            emptied = [tuple(int(i) for i in t) for t in tiler.get_emptied_composites(jobs, removed, compositezoom)]
+            emptied = [t for t in emptied if os.path.isfile(sceneTemplate % t)]
+            jobs = [j for j in jobs if id(j) in affected or not os.path.isfile(sceneTemplate % (int(j['z']), int(j['x']), int(j['y'])))]
+
+    ## composites an incremental run leaves alone stay finished in the manifest
+    manifest = tile_manifest.TileManifest(os.path.join(outputDir, MANIFEST_NAME))
+    if resume or incremental:
+        manifest.load()
+
+    if resume:
+        remaining = []
+        for j in jobs:
+            tile = (int(j['z']), int(j['x']), int(j['y']))
+            if not manifest.is_done(tile, sceneTemplate % tile, inputHashes[tile]):
+                remaining.append(j)
+        if len(remaining) < len(jobs):
+            click.echo("Skipping %s finished composites" % (len(jobs) - len(remaining)), err=True)
+        jobs = remaining
+
+    if dry_run:
+        if profile:
+            planProfiler.disable()
+            planProfiler.dump_stats(os.path.join(profile, 'main-%s.pstats' % os.getpid()))
+        for j in jobs:
+            click.echo(sceneTemplate % (int(j['z']), int(j['x']), int(j['y'])))
+        for tile in emptied:
+            click.echo("%s would be removed: it has no tiles left" % (sceneTemplate % tile), err=True)
+        click.echo("%s of %s composites would be made" % (len(jobs), planned), err=True)
+        return {'hits': 0, 'misses': 0}
+
+    ## workers killed mid-write (the runs resuming is for) leave their temp files behind
+    if resume:
+        stale = remove_temp_files(sceneTemplate % tile for tile in inputHashes)
+        if stale:
+            click.echo("Removed %s unfinished temp files" % stale, err=True)
+
+    ## overviews are averaged from whole bands, so COGs are always assembled in bands
+    if cog and not buffer_mb:
+        buffer_mb = COG_BUFFER_MB
+
+    predicted = dict(((int(j['z']), int(j['x']), int(j['y'])), (tiler.get_job_features(j), tiler.estimate_cost(j))) for j in jobs)
+
+    ## composites bigger than split_mb are rendered in row bands by many workers, and written here
+    splitBytes = int(split_mb * 2 ** 20) if split_mb else None
+    splits = {}
+    tasks, costs = [], []
+
+    for j in jobs:
+        size = 2 ** (int(j['zMax']) - compositezoom) * tile_resolution
+        if not splitBytes or 4 * size * size <= splitBytes:
+            continue
+
+        tile = (int(j['z']), int(j['x']), int(j['y']))
+        meta = make_src_meta(merc.bounds(tile[1], tile[2], tile[0]), size, creation_opts)
+        ## let GDAL compress the single writer's blocks on as many threads as there are workers
+        if not any(k.lower() == 'num_threads' for k in creation_opts):
+            meta['num_threads'] = str(workers)
+        rowAlign = int(meta.get('blockysize', 256))
+        if cog:
+            overviews = tile_cog.get_overview_sizes(size, size, int(meta.get('blockxsize', 256)))
+            rowAlign = int(np.lcm(rowAlign, 2 ** len(overviews)))
+        bandRows = get_band_rows(size, tile_resolution, rowAlign, splitBytes)
+        bands = [(r0, min(r0 + bandRows, size)) for r0 in range(0, size, bandRows)]
+
+        splits[tile] = {'filename': sceneTemplate % tile, 'meta': meta, 'dst': None, 'bands': len(bands), 'painted': {}, 'seconds': 0.0,
+            'stages': {}}
+
+        payload = tiler.get_job_payload(j)
+        for r0, r1 in bands:
+            tasks.append(('band', (payload, r0, r1)))
+            costs.append(predicted[tile][1] / len(bands))
+
+    jobs = [j for j in jobs if (int(j['z']), int(j['x']), int(j['y'])) not in splits]
+
+    if cache_mb and not no_fill:
+        batches = tiler.get_fill_batches(jobs, workers)
+    else:
+        batches = [[job] for job in jobs]
+
+    for b in batches:
+        tasks.append(('batch', [tiler.get_job_payload(j) for j in b]))
+        costs.append(sum(predicted[(int(j['z']), int(j['x']), int(j['y']))][1] for j in b))
+
+    if longest_first:
+        tasks = tiler.order_by_cost(tasks, costs)
+
+    plannedAt = time.time()
+
+    if profile:
+        planProfiler.disable()
+        planProfiler.dump_stats(os.path.join(profile, 'main-%s.pstats' % os.getpid()))
+
+    tmpdir = tempfile.mkdtemp(prefix='untiler-')
+    tilesPath = os.path.join(tmpdir, 'tiles.npy')
+    np.save(tilesPath, allTiles)
+
+    cacheStats = {'hits': 0, 'misses': 0}
+    report = []
+    stageTotals = {}
+    metricsFile = open(metrics, 'w') if metrics else None
+
+    def report_job(tile, p, seconds, stages):
         click.echo(p)
+        manifest.record(tile, p, inputHashes[tile])
+        (reads, cells), cost = predicted[tile]
+        report.append({'tile': '%s-%s-%s' % tile, 'reads': reads, 'cells': cells, 'predicted': cost, 'actual': seconds})
+        tile_metrics.merge_stages(stageTotals, stages)
+        if metricsFile:
+            metricsFile.write(json.dumps(dict(stages, tile='%s-%s-%s' % tile, file=p, seconds=seconds)) + '\n')
+
+    for tile in emptied:
+        os.remove(sceneTemplate % tile)
+        if logdir and os.path.isfile(os.path.join(logdir, '%s.log' % os.path.basename(sceneTemplate % tile))):
+            os.remove(os.path.join(logdir, '%s.log' % os.path.basename(sceneTemplate % tile)))
+        manifest.forget(tile)
+        click.echo("Removed %s: it has no tiles left" % (sceneTemplate % tile), err=True)
+
+    manifest.open(resume or incremental)
+    pool = None
+    completed = False
+
+    ## a band (up to split_mb) per worker, plus a chunk's worth so a chunk of bands can always be dispatched
+    bandSlots = threading.Semaphore(workers * chunksize)
+    stopping = threading.Event()
 
-    pool.close()
-    pool.join()
+    try:
+        pool = Pool(workers, global_setup, (source.path, {
+            'maxzoom': maxzoom,
+            'source': source,
+            'tiles': tilesPath,
+            'outputDir': outputDir,
+            'tileResolution': tile_resolution,
+            'compositezoom': compositezoom,
+            'fileTemplate': '%s/%s_%s_%s_%s.tif',
+            'sceneTemplate': sceneTemplate,
+            'logdir': logdir,
+            'creation_opts': creation_opts,
+            'no_fill': no_fill,
+            'decoder': decoder,
+            'buffer_bytes': int(buffer_mb * 2 ** 20) if buffer_mb else None,
+            'resampling': resampling,
+            'cache_bytes': int(cache_mb * 2 ** 20) if cache_mb else None,
+            'prefetch': prefetch,
+            'profile': profile,
+            'cog': cog
+            }))
+
+        for kind, result in pool.imap_unordered(streaming_task, limit_bands(tasks, bandSlots, stopping), chunksize):
+            if kind == 'batch':
+                results, stats = result
+                for tile, p, seconds, stages in results:
+                    report_job(tile, p, seconds, stages)
+            else:
+                tile, r0, r1, band, painted, seconds, stages, stats = result
+                split = splits[tile]
+                tile_metrics.merge_stages(split['stages'], stages)
+
+                split['painted'][r0] = painted
+                split['seconds'] += seconds
+                finished = len(split['painted']) == split['bands']
+
+                start = time.perf_counter()
+                if split['dst'] is None:
+                    if cog:
+                        split['dst'] = tile_cog.COGWriter(get_temp_filename(split['filename']), split['meta'])
+                    else:
+                        split['dst'] = rasterio.open(get_temp_filename(split['filename']), 'w', **split['meta'])
+                if band is not None:
+                    split['dst'].write(band, window=((r0, r1), (0, band.shape[2])))
+                if finished:
+                    split['dst'].close()
+                tile_metrics.merge_stages(split['stages'], {'write': {
+                    'seconds': time.perf_counter() - start,
+                    'tiles': (r1 - r0) * split['meta']['width'] // tile_resolution ** 2,
+                    'bytes': band.nbytes if band is not None else 0}})
+
+                bandSlots.release()
+
+                if finished:
+                    os.replace(get_temp_filename(split['filename']), split['filename'])
+                    if logdir:
+                        log = 'FILE: %s\n' % split['filename']
+                        log += ''.join('%s %s %s\n' % t for t in OrderedDict.fromkeys(
+                            t for r in sorted(split['painted']) for t in split['painted'][r]))
+                        with open(os.path.join(logdir, '%s.log' % os.path.basename(split['filename'])), 'w') as logger:
+                            logwriter(logger, log)
+                    report_job(tile, split['filename'], split['seconds'], split['stages'])
+
+            for k in stats:
+                cacheStats[k] += stats[k]
+
+        pool.close()
+        pool.join()
+        pool = None
+        completed = True
+
+        if incremental:
+            inventory.save(inputTiles, stamps, settings)
+
+        if profile:
+            click.echo("Profile saved to %s" % merge_profiles(profile, runStart), err=True)
+
+        if metricsFile:
+            metricsFile.write(json.dumps({'summary': {
+                'composites': len(report),
+                'seconds': time.time() - runStart,
+                'discovery': discoveredAt - runStart,
+                'planning': plannedAt - discoveredAt,
+                'cache': cacheStats,
+                'stages': tile_metrics.summarize_stages(stageTotals)}}) + '\n')
+    finally:
+        ## a failed write or Ctrl-C stops the workers, rather than leaving them running
+        if pool is not None:
+            ## wake the task feeder if it's waiting for a band slot
+            stopping.set()
+            bandSlots.release()
+            pool.terminate()
+            pool.join()
+        if metricsFile:
+            metricsFile.close()
+        for split in splits.values():
+            if split['dst'] is not None and not split['dst'].closed:
+                if cog:
+                    split['dst'].discard()
+                else:
+                    split['dst'].close()
+                    os.remove(get_temp_filename(split['filename']))
+        ## and removes the scenetifs its workers were partway through
+        if not completed:
+            remove_temp_files(sceneTemplate % tile for tile in predicted)
+        manifest.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if schedule_report:
+        write_schedule_report(schedule_report, report)
+
+    return cacheStats
 
 
 if __name__ == "__main__":
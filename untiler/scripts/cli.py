@@ -6,65 +6,171 @@ import click, mercantile, json
 from rasterio.rio.options import creation_options
 
 import untiler
-
-from untiler.scripts.mbtiles_extract import MBTileExtractor
+from untiler.scripts import tile_bench
 
 @click.group()
 def cli():
     pass
 
+## options the stream commands share, in --help order; each command leaves out those it can't use.
+## Their names are stream_source's arguments, so commands pass them straight through
+STREAM_OPTIONS = [
+    ('creation_options', creation_options),
+    ('compositezoom', click.option('--compositezoom', '-c', default=13, type=int,
+        help='Tile size to mosaic into [default=13]')),
+    ('maxzoom', click.option('--maxzoom', '-z', default=None, type=int,
+        help='Force a maxzom [default=max in each compositezoom area]')),
+    ('logdir', click.option('--logdir', '-l', default=None, help="Location for log files [default=None]")),
+    ('read_template', click.option('--readtemplate', '-t', 'read_template', default="jpg/{z}/{x}/{y}.jpg",
+        help="File path template [default='jpg/{z}/{x}/{y}.jpg']")),
+    ('scene_template', click.option('--scenetemplate', '-s', 'scene_template', default="{z}-{x}-{y}-tile.tif",
+        help="Template for output scenetif filenames [default='{z}-{x}-{y}-tile.tif']")),
+    ('workers', click.option('--workers', '-w', default=4, help="Number of workers in the processing pool [default=4]")),
+    ('no_fill', click.option('--no-fill', '-x', is_flag=True, help="Don't fill in with lower zooms")),
+    ('tile_resolution', click.option('--tile-resolution', '-r', default=256, help="Input tiles' size.")),
+    ('bounds', click.option('--bounds', '-b', default=None, type=float, nargs=4,
+        help="Only mosaic tiles intersecting west south east north bounds [default=all]")),
+    ('index', click.option('--index', '-i', default=None, type=click.Path(dir_okay=False),
+        help="Tile inventory file to load and refresh instead of rescanning input_dir [default=None]")),
+    ('decoder', click.option('--decoder', '-d', default='gdal', type=click.Choice(['gdal', 'pillow']),
+        help="Tile decoder; pillow decodes jpg tiles without a GDAL dataset per tile, falling back to gdal [default=gdal]")),
+    ('buffer_mb', click.option('--buffer-mb', default=None, type=float,
+        help="Assemble composites in memory, in block-aligned row bands of at most this many MB, and write each band in one call [default=write tile by tile]")),
+    ('resampling', click.option('--resampling', default='bilinear', type=click.Choice(['nearest', 'bilinear', 'cubic']),
+        help="Resampling used to upsample fill tiles [default=bilinear]")),
+    ('cache_mb', click.option('--cache-mb', default=64, type=float,
+        help="Per worker cache of decoded fill tiles, in MB; 0 to disable [default=64]")),
+    ('order', click.option('--order', default='hilbert', type=click.Choice(['hilbert', 'morton', 'zxy']),
+        help="Order to process composites in; hilbert + morton keep neighbouring composites together [default=hilbert]")),
+    ('chunksize', click.option('--chunksize', default=1, type=click.IntRange(1),
+        help="Composites (or fill batches) handed to a worker at a time [default=1]")),
+    ('longest_first', click.option('--longest-first/--in-order', default=True,
+        help="Dispatch the composites predicted to take longest first [default=longest-first]")),
+    ('schedule_report', click.option('--schedule-report', default=None, type=click.Path(dir_okay=False),
+        help="Write each composite's predicted + actual time as JSON lines [default=None]")),
+    ('split_mb', click.option('--split-mb', default=256, type=float,
+        help="Render composites bigger than this many MB in row bands across workers; 0 to never split [default=256]")),
+    ('prefetch', click.option('--prefetch', default=4, type=click.IntRange(0),
+        help="Tiles each worker reads + decodes ahead on a thread pool; 0 to read one at a time [default=4]")),
+    ('concurrency', click.option('--concurrency', default=16, type=click.IntRange(1),
+        help="Requests each worker keeps in flight [default=16]")),
+    ('retries', click.option('--retries', default=3, type=click.IntRange(0),
+        help="Retries, with exponential backoff, for failed requests [default=3]")),
+    ('resume', click.option('--resume', is_flag=True,
+        help="Skip composites the output directory's manifest records as finished from unchanged inputs")),
+    ('incremental', click.option('--incremental', is_flag=True,
+        help="Only make the composites touched by tiles added, removed or changed (by mtime / size) since the last incremental run")),
+    ('dry_run', click.option('--dry-run', is_flag=True,
+        help="List the scenetifs that would be made, without making them")),
+    ('profile', click.option('--profile-dir', 'profile', default=None, type=click.Path(file_okay=False),
+        help="Profile planning and each worker process into this directory, merged into untiler.pstats [default=None]")),
+    ('metrics', click.option('--metrics', default=None, type=click.Path(dir_okay=False),
+        help="Write each composite's tile counts, bytes read and seconds spent reading, decoding, filling and writing as JSON lines, then a per stage summary [default=None]")),
+    ('cog', click.option('--cog', is_flag=True,
+        help="Write Cloud Optimized GeoTIFFs, with overviews made as the scenetifs are assembled"))
+]
+
+def stream_options(without=()):
+    """
+    Add the shared stream command options, less those named in without
+    """
+    def decorator(f):
+        for name, option in reversed(STREAM_OPTIONS):
+            if name not in without:
+                f = option(f)
+        return f
+    return decorator
+
+def get_stream_args(options):
+    """
+    Rename the parsed options to stream_source's arguments
+    """
+    options['creation_opts'] = options.pop('creation_options')
+    return options
+
 @click.command()
 @click.argument('input_dir', type=click.Path(exists=True))
 @click.argument('output_dir', type=click.Path(exists=True))
-@creation_options
-@click.option('--compositezoom', '-c', default=13, type=int,
-    help='Tile size to mosaic into [default=13]')
-@click.option('--maxzoom', '-z', default=None, type=int,
-    help='Force a maxzom [default=max in each compositezoom area]')
-@click.option('--logdir', '-l', default=None, help="Location for log files [default=None]")
-@click.option('--readtemplate', '-t', default="jpg/{z}/{x}/{y}.jpg", help="File path template [default='jpg/{z}/{x}/{y}.jpg']")
-@click.option('--scenetemplate', '-s', default="{z}-{x}-{y}-tile.tif", help="Template for output scenetif filenames [default='{z}-{x}-{y}-tile.tif']")
-@click.option('--workers', '-w', default=4, help="Number of workers in the processing pool [default=4]")
-@click.option('--no-fill', '-x', is_flag=True, help="Don't fill in with lower zooms")
-@click.option('--tile-resolution', '-r', default=256, help="Input tiles' size.")
-def streamdir(input_dir, output_dir, compositezoom, maxzoom, logdir, readtemplate, scenetemplate, workers, creation_options, no_fill, tile_resolution):
-    # with MBTileExtractor(input_dir) as mbtmp:
-    #     print mbtmp.extract()
-    untiler.stream_dir(input_dir, output_dir, compositezoom, maxzoom, logdir, readtemplate, scenetemplate, workers, creation_options, no_fill, tile_resolution)
+@stream_options(without=('concurrency', 'retries'))
+def streamdir(input_dir, output_dir, **options):
+    untiler.stream_dir(input_dir, output_dir, **get_stream_args(options))
 
 cli.add_command(streamdir)
 
 @click.command()
 @click.argument('mbtiles', type=click.Path(exists=True))
 @click.argument('output_dir', type=click.Path(exists=True))
-@creation_options
-@click.option('--compositezoom', '-c', default=13, type=int,
-    help='Tile size to mosaic into [default=13]')
-@click.option('--maxzoom', '-z', default=None, type=int,
-    help='Force a maxzom [default=max in each compositezoom area]')
-@click.option('--scenetemplate', '-s', default="{z}-{x}-{y}-tile.tif", help="Template for output scenetif filenames [default='{z}-{x}-{y}-tile.tif']")
-@click.option('--workers', '-w', default=4, help="Number of workers in the processing pool [default=4]")
-@click.option('--no-fill', '-x', is_flag=True, help="Don't fill in with lower zooms")
-def streammbtiles(mbtiles, output_dir, compositezoom, maxzoom, creation_options, scenetemplate, workers, no_fill):
-    with MBTileExtractor(mbtiles) as mbtmp:
-        input_tile_dir = mbtmp.extract()
-        with open(os.path.join(input_tile_dir, 'tiles', 'metadata.json')) as ofile:
-            metadata = json.loads(ofile.read())
-        readtemplate = "tiles/{z}/{x}/{y}.%s" % (metadata['format'])
-        untiler.stream_dir(input_tile_dir, output_dir, compositezoom, maxzoom, None, readtemplate, scenetemplate, workers, creation_options, no_fill)
+@stream_options(without=('logdir', 'read_template', 'tile_resolution', 'bounds', 'index', 'concurrency', 'retries'))
+def streammbtiles(mbtiles, output_dir, **options):
+    untiler.stream_mbtiles(mbtiles, output_dir, logdir=None, **get_stream_args(options))
 
 cli.add_command(streammbtiles)
 
+@click.command()
+@click.argument('tar')
+@click.argument('output_dir', type=click.Path(exists=True))
+@click.option('--readtemplate', '-t', 'read_template', default="jpg/{z}/{x}/{y}.jpg",
+    help="Archive member path template [default='jpg/{z}/{x}/{y}.jpg']")
+@stream_options(without=('read_template', 'index'))
+def streamtar(tar, output_dir, **options):
+    ## archives at an http(s) url are read with range requests
+    if not untiler.is_url(tar) and not os.path.isfile(tar):
+        raise click.BadParameter("no archive at %s" % tar, param_hint='TAR')
+    untiler.stream_tar(tar, output_dir, **get_stream_args(options))
+
+cli.add_command(streamtar)
+
+@click.command()
+@click.argument('url_template')
+@click.argument('tile_list', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output_dir', type=click.Path(exists=True))
+@stream_options(without=('read_template', 'index', 'prefetch', 'incremental'))
+def streamhttp(url_template, tile_list, output_dir, **options):
+    untiler.stream_http(url_template, tile_list, output_dir, **get_stream_args(options))
+
+cli.add_command(streamhttp)
+
 @click.command()
 @click.argument('input_dir', type=click.Path(exists=True))
 @click.option('--zoom', '-z', default=None, type=int,
     help='Zoom to inspect [default = all]')
 @click.option('--readtemplate', '-t', default="jpg/{z}/{x}/{y}.jpg",
     help="File path template [default='jpg/{z}/{x}/{y}.jpg']")
-def inspectdir(input_dir, zoom, readtemplate):
-    untiler.inspect_dir(input_dir, zoom, readtemplate)
+@click.option('--index', '-i', default=None, type=click.Path(dir_okay=False),
+    help="Tile inventory file to load and refresh instead of rescanning input_dir [default=None]")
+def inspectdir(input_dir, zoom, readtemplate, index):
+    untiler.inspect_dir(input_dir, zoom, readtemplate, index)
 
 cli.add_command(inspectdir)
 
+@click.command()
+@click.option('--compositezoom', '-c', default=14, type=int, help="Composite zoom [default=14]")
+@click.option('--maxzoom', '-z', default=17, type=int, help="Max zoom of the synthetic pyramid [default=17]")
+@click.option('--spread', default=3, type=click.IntRange(1),
+    help="Number of zooms with tiles, up to maxzoom [default=3]")
+@click.option('--side', default=2, type=click.IntRange(1), help="Composites per side of the pyramid [default=2]")
+@click.option('--coverage', default=0.8, type=click.FloatRange(0, 1),
+    help="Chance of keeping each tile below the top zoom, if its parent was kept; lower is more ragged [default=0.8]")
+@click.option('--format', 'image_format', default='jpg', type=click.Choice(['jpg', 'png']), help="Tile format [default=jpg]")
+@click.option('--tile-resolution', '-r', default=256, type=int, help="Size of the tiles [default=256]")
+@click.option('--workers', '-w', default=[1, 2, 4], type=click.IntRange(1), multiple=True,
+    help="Worker counts to run end to end with; repeatable [default=1 2 4]")
+@click.option('--repeat', default=3, type=click.IntRange(1), help="Runs of each timing to take the fastest of [default=3]")
+@click.option('--seed', default=0, type=int, help="Random seed for the pyramid's coverage [default=0]")
+@click.option('--output', '-o', default='-', type=click.File('w'), help="File to write the JSON results to [default=stdout]")
+def bench(compositezoom, maxzoom, spread, side, coverage, image_format, tile_resolution, workers, repeat, seed, output):
+    """
+    Time discovery, planning, upsampling, the worker, and end to end runs at several
+    worker counts over a synthetic tile pyramid, writing the results as JSON
+    """
+    if maxzoom < compositezoom:
+        raise click.BadParameter("must be at least the composite zoom", param_hint='--maxzoom')
+
+    results = tile_bench.run_bench(compositezoom, maxzoom, spread, side, coverage, image_format,
+        workers, repeat, seed, tile_resolution)
+    output.write(json.dumps(results, indent=2) + '\n')
+
+cli.add_command(bench)
+
 if __name__ == "__main__":
     cli()
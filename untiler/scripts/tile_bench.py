@@ -0,0 +1,187 @@
+from __future__ import division
+import contextlib
+import io
+import os
+import platform
+import shutil
+import tempfile
+import time
+import warnings
+
+import mercantile
+import numpy as np
+from rasterio.io import MemoryFile
+
+import untiler
+import untiler.scripts.tile_utils as tile_utils
+import untiler.scripts.tile_sources as tile_sources
+
+
+def make_tile_image(imageFormat, resolution, seed=0):
+    """
+    Encode a synthetic (smooth gradients + noise, so it compresses like
+    imagery) RGB tile as a jpg or png
+    """
+    rng = np.random.RandomState(seed)
+    ramp = np.linspace(0, 255, resolution)
+    imdata = np.stack([
+        np.add.outer(ramp, ramp) / 2,
+        np.add.outer(ramp[::-1], ramp) / 2,
+        np.tile(ramp, (resolution, 1))])
+    imdata = np.clip(imdata + rng.normal(0, 24, imdata.shape), 0, 255).astype(np.uint8)
+
+    driver = {'jpg': 'JPEG', 'png': 'PNG'}[imageFormat]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with MemoryFile() as memfile:
+            with memfile.open(driver=driver, width=resolution, height=resolution, count=3, dtype=np.uint8) as dst:
+                dst.write(imdata)
+            return memfile.read()
+
+
+def make_pyramid(path, compositezoom, maxzoom, spread, side, coverage, imageFormat='jpg', resolution=256, seed=0):
+    """
+    Write a synthetic pyramid beneath side x side composites, with tiles at the
+    spread zooms up to maxzoom. Every tile of the top zoom is written; below
+    that (and below the composite zoom) each tile is kept with a probability
+    of coverage if its parent was, so lower coverage makes a more ragged
+    pyramid. Returns the [z, x, y]s written
+    """
+    rng = np.random.RandomState(seed)
+    minzoom = maxzoom - spread + 1
+    root = mercantile.tile(-122.4, 37.5, compositezoom)
+    level = [mercantile.Tile(root.x + i, root.y + j, compositezoom) for i in range(side) for j in range(side)]
+
+    tiles = []
+    for z in range(minzoom, compositezoom):
+        tiles += sorted(set(mercantile.parent(t, zoom=z) for t in level))
+
+    for z in range(compositezoom, maxzoom + 1):
+        if z > compositezoom:
+            level = [t for p in level for t in mercantile.children(p)]
+            if z > max(minzoom, compositezoom):
+                level = [t for t in level if rng.rand() < coverage]
+        if z >= minzoom:
+            tiles += level
+
+    data = make_tile_image(imageFormat, resolution, seed)
+    for t in tiles:
+        tileDir = os.path.join(path, str(t.z), str(t.x))
+        if not os.path.isdir(tileDir):
+            os.makedirs(tileDir)
+        with open(os.path.join(tileDir, '%s.%s' % (t.y, imageFormat)), 'wb') as ofile:
+            ofile.write(data)
+
+    return np.array([[t.z, t.x, t.y] for t in tiles], dtype=np.int32).reshape(-1, 3)
+
+
+def get_version():
+    try:
+        from importlib.metadata import version
+        return version('untiler')
+    except Exception:
+        return None
+
+
+def best_of(repeat, func, *args):
+    """
+    Run func repeat times, returning the fastest seconds and its last result
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def plan(tiles, compositezoom, order='hilbert'):
+    """
+    Plan composite jobs as stream_source does
+    """
+    tiler = tile_utils.TileUtils()
+    ancestorTiles = tiles[tiles[:, 0] < compositezoom]
+    tiles = tiles[tiles[:, 0] >= compositezoom]
+    superTiles = tiler.get_super_tiles(tiles, compositezoom)
+    tiles, superTiles, runStarts, runEnds = tiler.get_tile_runs(tiles, superTiles)
+    jobs = tiler.get_sub_tiles(tiles, superTiles, runs=(runStarts, runEnds))
+    if len(ancestorTiles):
+        jobs = tiler.get_ancestor_fill(jobs, ancestorTiles)
+    return tiler.order_jobs(jobs, order)
+
+
+def run_bench(compositezoom=14, maxzoom=17, spread=3, side=2, coverage=0.8, imageFormat='jpg',
+        workers=(1, 2, 4), repeat=3, seed=0, resolution=256):
+    """
+    Time tile discovery, planning, upsampling, the worker (in process), and end
+    to end stream_dir runs at each worker count over a synthetic pyramid.
+    Returns the results as a JSON-able dict
+    """
+    tmp = tempfile.mkdtemp(prefix='untiler-bench-')
+    try:
+        tilesDir = os.path.join(tmp, 'tiles')
+        written = make_pyramid(tilesDir, compositezoom, maxzoom, spread, side, coverage, imageFormat, resolution, seed)
+        template = '{z}/{x}/{y}.%s' % imageFormat
+        outputDir = os.path.join(tmp, 'out')
+        os.mkdir(outputDir)
+
+        source = tile_sources.DirectorySource(tilesDir, template)
+        discovery, tiles = best_of(repeat, source.list_tiles)
+        planning, jobs = best_of(repeat, plan, tiles, compositezoom)
+
+        untiler.global_setup(source.path, {
+            'source': source,
+            'tileResolution': resolution,
+            'compositezoom': compositezoom,
+            'sceneTemplate': os.path.join(outputDir, '%s-%s-%s-tile.tif'),
+            'logdir': None,
+            'creation_opts': {},
+            'no_fill': False,
+            'decoder': 'gdal',
+            'resampling': 'bilinear',
+            'prefetch': 0
+            })
+
+        def work():
+            for job in jobs:
+                untiler.streaming_tile_worker(job)
+
+        results = {
+            'discovery': {'seconds': discovery, 'tiles_per_second': len(tiles) / discovery},
+            'planning': {'seconds': planning, 'composites_per_second': len(jobs) / planning}
+            }
+
+        with warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+            warnings.simplefilter('ignore')
+
+            imdata = untiler.load_tile(*[int(i) for i in tiles[-1]])
+            seconds, _ = best_of(repeat, untiler.upsample_array, imdata, 4, 'bilinear')
+            results['upsample'] = {'seconds': seconds, 'up': 4, 'mpixels_per_second': (4 * resolution) ** 2 / 1e6 / seconds}
+
+            seconds, _ = best_of(repeat, work)
+            results['worker'] = {'seconds': seconds, 'tiles_per_second': len(tiles) / seconds}
+
+            results['end_to_end'] = []
+            for w in workers:
+                seconds, _ = best_of(repeat, untiler.stream_dir, tilesDir, outputDir, compositezoom, None, None,
+                    template, '{z}-{x}-{y}-tile.tif', w, {}, False, resolution)
+                results['end_to_end'].append({'workers': w, 'seconds': seconds,
+                    'tiles_per_second': len(tiles) / seconds, 'composites_per_second': len(jobs) / seconds})
+
+        return {
+            'params': {
+                'compositezoom': compositezoom, 'maxzoom': maxzoom, 'spread': spread, 'side': side,
+                'coverage': coverage, 'format': imageFormat, 'resolution': resolution,
+                'repeat': repeat, 'seed': seed},
+            'tiles': len(written),
+            'composites': len(jobs),
+            'results': results,
+            'platform': {
+                'untiler': get_version(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count()}
+            }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
@@ -0,0 +1,50 @@
+from __future__ import division
+from collections import OrderedDict
+
+
+class TileCache:
+    """
+    A least recently used cache of decoded tile arrays, bounded by the
+    total bytes of the arrays it holds. Cached arrays are made read only,
+    since they're shared by every composite that gets them
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.tiles = OrderedDict()
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def get(self, key):
+        imdata = self.tiles.get(key)
+
+        if imdata is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.tiles.move_to_end(key)
+        return imdata
+
+    def put(self, key, imdata):
+        if imdata.nbytes > self.maxBytes:
+            return imdata
+
+        if key in self.tiles:
+            self.nbytes -= self.tiles.pop(key).nbytes
+
+        imdata.flags.writeable = False
+        self.tiles[key] = imdata
+        self.nbytes += imdata.nbytes
+
+        while self.nbytes > self.maxBytes:
+            _, evicted = self.tiles.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+        return imdata
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,181 @@
+from __future__ import division
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+
+## GTiff creation options the COG driver sets itself, or that describe the raster rather than its encoding
+LAYOUT_OPTIONS = ('driver', 'height', 'width', 'count', 'dtype', 'affine', 'transform', 'crs', 'nodata',
+    'tiled', 'blockxsize', 'blockysize', 'photometric', 'interleave')
+
+## GTiff creation options the COG driver names differently
+RENAMED_OPTIONS = {'jpeg_quality': 'QUALITY', 'webp_level': 'QUALITY', 'zlevel': 'LEVEL', 'zstd_level': 'LEVEL'}
+
+
+def get_overview_sizes(width, height, blocksize=256):
+    """
+    Get the (width, height)s of the overviews a COG needs: halving until the
+    raster fits in one block
+    """
+    sizes = []
+    while max(width, height) > blocksize:
+        width, height = -(-width // 2), -(-height // 2)
+        sizes.append((width, height))
+    return sizes
+
+
+def get_cog_options(meta):
+    """
+    Translate a scenetif's GTiff profile into COG creation options
+    """
+    options = {'BLOCKSIZE': int(meta.get('blockxsize', 256)), 'OVERVIEWS': 'FORCE_USE_EXISTING'}
+    for k, v in meta.items():
+        if k.lower() not in LAYOUT_OPTIONS:
+            options[RENAMED_OPTIONS.get(k.lower(), k.upper())] = v
+    return options
+
+
+def downsample_band(band):
+    """
+    Average 2 x 2 pixels of a (4, rows, cols) RGBA band into one, weighting
+    colour by alpha so empty pixels don't darken the edges of the data
+    """
+    def pool(a):
+        return a[..., ::2, ::2] + a[..., 1::2, ::2] + a[..., ::2, 1::2] + a[..., 1::2, 1::2]
+
+    if band.shape[0] != 4:
+        return ((pool(band.astype(np.uint16)) + 2) // 4).astype(np.uint8)
+
+    alpha = band[3].astype(np.uint32)
+    weights = pool(alpha)
+    out = np.empty((4,) + weights.shape, dtype=np.uint8)
+    out[:3] = (pool(band[:3] * alpha) + weights // 2) // np.maximum(weights, 1)
+    out[3] = (weights + 2) // 4
+    return out
+
+
+class COGWriter:
+    """
+    Write a scenetif as a Cloud Optimized GeoTIFF, with overviews made as
+    it's written. Full width, row aligned bands are written to a temp GTiff
+    (losslessly compressed with fast ZSTD, so they take a fraction of the raw
+    size), and averaged down into a temp GTiff per overview level on the way;
+    closing copies them into the COG in one pass, so the overviews are never
+    read back out of a lossy scenetif and rebuilt
+    """
+    def __init__(self, filename, meta):
+        self.filename = filename
+        self.meta = meta
+        self.width, self.height = int(meta['width']), int(meta['height'])
+        self.count = int(meta['count'])
+        self.options = get_cog_options(meta)
+        self.sizes = get_overview_sizes(self.width, self.height, self.options['BLOCKSIZE'])
+        ## bands must start (and end) on rows every overview level can be averaged from
+        self.align = 2 ** len(self.sizes)
+        self.closed = False
+
+        transform = meta.get('transform', meta.get('affine'))
+        raw = {'driver': 'GTiff', 'count': self.count, 'dtype': meta['dtype'], 'crs': meta.get('crs'),
+            'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'sparse_ok': True,
+            'compress': 'ZSTD', 'zstd_level': 1, 'predictor': 2}
+
+        self.paths = []
+        self._dsts = []
+        try:
+            for k, (width, height) in enumerate([(self.width, self.height)] + self.sizes):
+                path = '%s.%s.raw' % (filename, k)
+                self.paths.append(path)
+                self._dsts.append(rasterio.open(path, 'w', width=width, height=height,
+                    transform=transform * transform.scale(2 ** k) if transform else None, **raw))
+        except Exception:
+            self.discard()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, band, window):
+        """
+        Write rows r0:r1 of the scenetif, and of each overview beneath them
+        """
+        (r0, r1), (c0, c1) = window
+        if c0 != 0 or c1 != self.width:
+            raise ValueError("COG scenetifs must be written in full width bands")
+        if r0 % self.align or (r1 % self.align and r1 != self.height):
+            raise ValueError("COG scenetif bands must be aligned to %s rows" % self.align)
+
+        self._dsts[0].write(band, window=window)
+        for k, dst in enumerate(self._dsts[1:], 1):
+            band = downsample_band(band)
+            r0 = r0 // 2
+            dst.write(band, window=((r0, r0 + band.shape[1]), (0, band.shape[2])))
+
+    def make_vrt(self):
+        """
+        Describe the raw scenetif with the raw overviews as its own. JPEG can't
+        hold an alpha band, so there alpha becomes a mask (as the COG driver
+        would make it)
+        """
+        full = self._dsts[0]
+        root = ET.Element('VRTDataset', rasterXSize=str(self.width), rasterYSize=str(self.height))
+        if full.crs:
+            ET.SubElement(root, 'SRS').text = full.crs.to_wkt()
+        ET.SubElement(root, 'GeoTransform').text = ', '.join(repr(v) for v in full.transform.to_gdal())
+
+        def add_band(parent, b, tag='VRTRasterBand'):
+            band = ET.SubElement(parent, tag, dataType='Byte')
+            for k, dst in enumerate(self._dsts):
+                source = ET.SubElement(band, 'SimpleSource' if k == 0 else 'Overview')
+                ET.SubElement(source, 'SourceFilename', relativeToVRT='0').text = os.path.abspath(dst.name)
+                ET.SubElement(source, 'SourceBand').text = str(b)
+            return band
+
+        mask = self.count == 4 and str(self.options.get('COMPRESS', '')).upper() == 'JPEG'
+        interps = ('Red', 'Green', 'Blue', 'Alpha') if self.count == 4 else ('Gray',) * self.count
+        for b in range(1, self.count + 1 - mask):
+            band = add_band(root, b)
+            band.set('band', str(b))
+            band.insert(0, ET.Element('ColorInterp'))
+            band[0].text = interps[b - 1]
+
+        if mask:
+            add_band(ET.SubElement(root, 'MaskBand'), 4)
+
+        return ET.tostring(root, encoding='unicode')
+
+    def close(self):
+        """
+        Copy the raw scenetif + overviews into the COG, and remove them
+        """
+        if self.closed:
+            return
+        try:
+            for dst in self._dsts:
+                dst.close()
+            vrt = '%s.vrt' % self.filename
+            self.paths.append(vrt)
+            with open(vrt, 'w') as ofile:
+                ofile.write(self.make_vrt())
+            rasterio.shutil.copy(vrt, self.filename, driver='COG', **self.options)
+        finally:
+            self.discard()
+
+    def discard(self):
+        """
+        Remove the raw scenetif + overviews without making the COG
+        """
+        for dst in self._dsts:
+            if not dst.closed:
+                dst.close()
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.closed = True
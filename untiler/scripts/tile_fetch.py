@@ -0,0 +1,261 @@
+from __future__ import division
+import asyncio
+import queue
+import ssl
+import threading
+from collections import defaultdict
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+class FetchError(IOError):
+    """
+    A request that failed for good: a client error, or a server / connection
+    error that outlasted its retries
+    """
+    def __init__(self, url, message, status=None):
+        super(FetchError, self).__init__("%s: %s" % (url, message))
+        self.url = url
+        self.status = status
+
+
+## statuses worth another try
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class AsyncFetcher:
+    """
+    An asyncio HTTP/1.1 client for pulling many small objects (tiles) from
+    HTTP / S3-compatible endpoints. Requests run on an event loop of the
+    fetcher's own, in a background thread started on first use, so its pool
+    of keep-alive connections per host outlives each call. Bounds the
+    requests in flight to concurrency, retries failed requests with
+    exponential backoff, and fetches (offset, length) byte ranges of objects
+    (eg the members of a tar archive). Synchronous callers get one body with
+    get, or stream many back in order with iter_fetch
+    """
+    def __init__(self, concurrency=16, retries=3, backoff=0.1, timeout=30):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.requests = 0
+        self.attempts = 0
+        self._idle = defaultdict(list)
+        self._slots = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = self._loop = asyncio.new_event_loop()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    loop.run_forever()
+                    loop.close()
+
+                threading.Thread(target=run, daemon=True).start()
+            return self._loop
+
+    async def _connect(self, key):
+        idle = self._idle[key]
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.transport.is_closing():
+                return reader, writer
+            writer.close()
+
+        scheme, host, port = key
+        return await asyncio.open_connection(host, port, ssl=ssl.create_default_context() if scheme == 'https' else None)
+
+    async def _request(self, url, byte_range=None):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = [
+            'GET %s HTTP/1.1' % path,
+            'Host: %s' % parts.netloc,
+            'Connection: keep-alive',
+            'Accept-Encoding: identity']
+        if byte_range:
+            headers.append('Range: bytes=%s-%s' % (byte_range[0], byte_range[0] + byte_range[1] - 1))
+
+        reader, writer = await self._connect(key)
+        try:
+            writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'))
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError("Connection closed")
+            version, status = status_line.decode('latin-1').split(None, 2)[:2]
+            status = int(status)
+
+            response = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                k, v = line.decode('latin-1').split(':', 1)
+                response[k.strip().lower()] = v.strip()
+
+            if response.get('transfer-encoding', '').lower() == 'chunked':
+                body = b''
+                while True:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    if size == 0:
+                        await reader.readline()
+                        break
+                    body += await reader.readexactly(size)
+                    await reader.readline()
+            elif 'content-length' in response:
+                body = await reader.readexactly(int(response['content-length']))
+            else:
+                body = await reader.read()
+                response['connection'] = 'close'
+
+            if response.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+                writer.close()
+            else:
+                self._idle[key].append((reader, writer))
+        except BaseException:
+            writer.close()
+            raise
+
+        if byte_range and status == 200:
+            ## the server ignored the range: take it from the whole body
+            body = body[byte_range[0]:byte_range[0] + byte_range[1]]
+            status = 206
+
+        return status, body
+
+    async def fetch(self, url, byte_range=None):
+        """
+        Get the body of url, or the (offset, length) byte_range of it
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+
+        self.requests += 1
+
+        async with self._slots:
+            for attempt in range(self.retries + 1):
+                self.attempts += 1
+                try:
+                    status, body = await asyncio.wait_for(self._request(url, byte_range), self.timeout)
+                except (OSError, EOFError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    error = FetchError(url, repr(e))
+                else:
+                    if status == (206 if byte_range else 200):
+                        return body
+                    error = FetchError(url, "HTTP %s" % status, status)
+                    if status not in RETRY_STATUSES:
+                        raise error
+
+                if attempt < self.retries:
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+
+        raise error
+
+    def get(self, url, byte_range=None):
+        """
+        Fetch one url (or an (offset, length) byte_range of it), waiting for its body
+        """
+        return asyncio.run_coroutine_threadsafe(self.fetch(url, byte_range), self._get_loop()).result()
+
+    def iter_fetch(self, urls, window=None):
+        """
+        Fetch a sequence of urls, or (url, (offset, length)) byte ranges of
+        them, yielding each body in order. At most window bodies (default
+        twice the concurrency) are held ahead of the consumer
+        """
+        window = window or 2 * self.concurrency
+        loop = self._get_loop()
+        done = queue.Queue()
+        state = {}
+
+        async def produce():
+            tasks = []
+
+            async def get(i, request):
+                url, byte_range = (request, None) if isinstance(request, str) else request
+                try:
+                    done.put((i, await self.fetch(url, byte_range), None))
+                except Exception as e:
+                    done.put((i, None, e))
+
+            try:
+                for i, url in enumerate(urls):
+                    await state['ahead'].acquire()
+                    tasks.append(asyncio.ensure_future(get(i, url)))
+                await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                ## the consumer stopped early
+                pass
+            finally:
+                for t in tasks:
+                    t.cancel()
+
+        def start():
+            state['ahead'] = asyncio.Semaphore(window)
+            state['task'] = loop.create_task(produce())
+            ## even a task cancelled before it starts says it's done
+            state['task'].add_done_callback(lambda task: done.put(None))
+
+        loop.call_soon_threadsafe(start)
+
+        arrived = {}
+        nxt = 0
+        finished = False
+        try:
+            while True:
+                while nxt not in arrived:
+                    item = done.get()
+                    if item is None:
+                        finished = True
+                        break
+                    arrived[item[0]] = item[1:]
+                if nxt not in arrived:
+                    break
+
+                body, error = arrived.pop(nxt)
+                nxt += 1
+                if error is not None:
+                    raise error
+
+                if not finished:
+                    loop.call_soon_threadsafe(state['ahead'].release)
+                yield body
+        finally:
+            if not finished:
+                loop.call_soon_threadsafe(lambda: state['task'].cancel())
+                while done.get() is not None:
+                    pass
+
+    def close(self):
+        """
+        Close the kept alive connections, and stop the event loop
+        """
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+
+        async def shutdown():
+            for idle in self._idle.values():
+                for _, writer in idle:
+                    writer.close()
+            self._idle.clear()
+            self._slots = None
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
@@ -0,0 +1,127 @@
+from __future__ import division
+import os
+from collections import defaultdict
+
+import numpy as np
+
+import untiler.scripts.tile_utils as tile_utils
+
+
+class TileIndex:
+    """
+    A sidecar inventory of the tiles beneath a directory, stored as an .npz of
+    z / x / y, mtime and size per tile plus the mtime of every directory.
+    Refreshing only lists directories whose mtime changed since the last save;
+    unchanged directories cost a single stat, and an unchanged index isn't rewritten
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def load(self, root, template):
+        """
+        Load a saved index, or None if there is none for this root + template
+        """
+        if not os.path.isfile(self.path):
+            return None
+
+        with np.load(self.path, allow_pickle=False) as saved:
+            if str(saved['root']) != root or str(saved['template']) != template:
+                return None
+            return dict((k, saved[k]) for k in saved.files)
+
+    def save(self, root, template, dirs, dirMtimes, dirOffsets, tiles, mtimes, sizes):
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as ofile:
+            np.savez(ofile,
+                root=np.array(root),
+                template=np.array(template),
+                dirs=np.array(dirs, dtype=str),
+                dirMtimes=np.array(dirMtimes, dtype=np.int64),
+                dirOffsets=np.array(dirOffsets, dtype=np.int64),
+                tiles=tiles,
+                mtimes=mtimes,
+                sizes=sizes)
+        os.replace(tmp, self.path)
+
+    def refresh(self, directory, template, threads=tile_utils.SCAN_THREADS):
+        """
+        Bring the index up to date with a directory, save it if anything
+        changed, and return its (tiles, mtimes, sizes) arrays
+        """
+        root = os.path.expanduser(directory)
+        tiler = tile_utils.TileUtils()
+        parser = tiler.get_tile_parser(template)
+
+        cached = self.load(root, template)
+        dirIds = {}
+        children = defaultdict(list)
+        if cached is not None:
+            for i, d in enumerate(cached['dirs'].tolist()):
+                dirIds[d] = i
+                if d != '.':
+                    children[os.path.dirname(d) or '.'].append(d)
+
+        def visit(path, depth):
+            rel = os.path.relpath(path, root)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                return [], []
+
+            i = dirIds.get(rel)
+            if i is not None and cached['dirMtimes'][i] == mtime:
+                return [(rel, mtime, i, None)], [(os.path.join(root, c), depth + 1) for c in children[rel]]
+
+            tiles, mtimes, sizes, dirs = [], [], [], []
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                dirs.append(entry.path)
+                            continue
+                        match = parser.match(entry.path)
+                        if match:
+                            st = entry.stat()
+                            tiles.append([int(t) for t in match.groups()[-3:]])
+                            mtimes.append(st.st_mtime_ns)
+                            sizes.append(st.st_size)
+            except OSError:
+                return [], []
+
+            scanned = (
+                np.array(tiles, dtype=np.int32).reshape(-1, 3),
+                np.array(mtimes, dtype=np.int64),
+                np.array(sizes, dtype=np.int64))
+
+            return [(rel, mtime, None, scanned)], [(d, depth + 1) for d in dirs]
+
+        dirs, dirMtimes, dirOffsets = [], [], [0]
+        tiles, mtimes, sizes = [], [], []
+        rescanned = False
+
+        for rel, mtime, i, scanned in sorted(tiler.walk_dirs(root, visit, threads), key=lambda d: d[0]):
+            rescanned |= scanned is not None
+            if scanned is None:
+                start, end = cached['dirOffsets'][i], cached['dirOffsets'][i + 1]
+                scanned = cached['tiles'][start:end], cached['mtimes'][start:end], cached['sizes'][start:end]
+            dirs.append(rel)
+            dirMtimes.append(mtime)
+            dirOffsets.append(dirOffsets[-1] + len(scanned[0]))
+            tiles.append(scanned[0])
+            mtimes.append(scanned[1])
+            sizes.append(scanned[2])
+
+        tiles = np.concatenate(tiles) if tiles else np.empty((0, 3), dtype=np.int32)
+        mtimes = np.concatenate(mtimes) if mtimes else np.empty(0, dtype=np.int64)
+        sizes = np.concatenate(sizes) if sizes else np.empty(0, dtype=np.int64)
+
+        ## a directory listed again (eg the one the index itself is saved in) may hold the same tiles
+        unchanged = cached is not None and dirs == cached['dirs'].tolist() and (not rescanned or (
+            np.array_equal(dirOffsets, cached['dirOffsets']) and np.array_equal(tiles, cached['tiles']) and
+            np.array_equal(mtimes, cached['mtimes']) and np.array_equal(sizes, cached['sizes'])))
+
+        if not unchanged:
+            self.save(root, template, dirs, dirMtimes, dirOffsets, tiles, mtimes, sizes)
+
+        return tiles, mtimes, sizes
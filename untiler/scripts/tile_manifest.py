@@ -0,0 +1,111 @@
+from __future__ import division
+import json
+import os
+
+import numpy as np
+
+
+class TileManifest:
+    """
+    A JSON lines record of the composites a run finished: their scenetif and
+    the hash of their inputs. A line is appended + flushed as each composite
+    finishes, so a run that dies leaves a record of everything it completed
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.done = {}
+        self._file = None
+
+    def load(self):
+        """
+        Load the finished composites of earlier runs. Later lines win, and a
+        line cut short by a crash is ignored
+        """
+        self.done = {}
+        if not os.path.isfile(self.path):
+            return self.done
+
+        with open(self.path) as src:
+            for line in src:
+                try:
+                    record = json.loads(line)
+                    self.done[record['tile']] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+        return self.done
+
+    def open(self, resume=False):
+        """
+        Start recording. Resuming keeps the loaded records (compacted to one
+        line per composite); otherwise the manifest starts over
+        """
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as ofile:
+            if resume:
+                for record in self.done.values():
+                    ofile.write(json.dumps(record) + '\n')
+        os.replace(tmp, self.path)
+
+        if not resume:
+            self.done = {}
+
+        self._file = open(self.path, 'a')
+        return self
+
+    def is_done(self, tile, filename, inputHash):
+        """
+        Whether a composite was finished from the same inputs, and its scenetif is still there
+        """
+        record = self.done.get('%s-%s-%s' % tile)
+        return (record is not None and record['hash'] == inputHash and
+            record['file'] == filename and os.path.isfile(filename))
+
+    def forget(self, tile):
+        """
+        Drop a composite's record (eg when its scenetif is removed) from the next compaction
+        """
+        self.done.pop('%s-%s-%s' % tile, None)
+
+    def record(self, tile, filename, inputHash):
+        record = {'tile': '%s-%s-%s' % tile, 'file': filename, 'hash': inputHash}
+        self.done[record['tile']] = record
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class TileInventory:
+    """
+    A snapshot of the tiles (and their (mtime, size) stamps) a run's
+    composites were made from, stored as an .npz with the run's settings,
+    for the next run to diff against
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def load(self, settings):
+        """
+        Load the snapshot as (tiles, stamps), or None if there is none, or it
+        was made with other settings
+        """
+        if not os.path.isfile(self.path):
+            return None
+
+        with np.load(self.path, allow_pickle=False) as saved:
+            if str(saved['settings']) != json.dumps(settings, sort_keys=True, default=str):
+                return None
+            return saved['tiles'], saved['stamps']
+
+    def save(self, tiles, stamps, settings):
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as ofile:
+            np.savez(ofile,
+                settings=np.array(json.dumps(settings, sort_keys=True, default=str)),
+                tiles=np.asarray(tiles, dtype=np.int32).reshape(-1, 3),
+                stamps=np.asarray(stamps, dtype=np.int64).reshape(-1, 2))
+        os.replace(tmp, self.path)
@@ -0,0 +1,64 @@
+from __future__ import division
+import threading
+import time
+
+## the stages of making a composite, in order
+STAGES = ('read', 'decode', 'fill', 'write')
+
+
+class StageTimer:
+    """
+    Seconds, tiles and bytes spent in each stage of making a composite, in
+    one worker. Prefetch threads read + decode alongside the painting thread,
+    so stage seconds are summed across a worker's threads
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = dict((s, [0.0, 0, 0]) for s in STAGES)
+
+    def add(self, stage, start, tiles=0, nbytes=0):
+        """
+        Add the time since start (a time.perf_counter()) to a stage
+        """
+        seconds = time.perf_counter() - start
+        with self._lock:
+            counts = self.stages[stage]
+            counts[0] += seconds
+            counts[1] += tiles
+            counts[2] += nbytes
+
+    def collect(self):
+        """
+        Get the stages' {'seconds', 'tiles', 'bytes'} since the last collect, and start over
+        """
+        with self._lock:
+            stages, self.stages = self.stages, dict((s, [0.0, 0, 0]) for s in STAGES)
+        return dict((s, {'seconds': c[0], 'tiles': c[1], 'bytes': c[2]}) for s, c in stages.items())
+
+
+def merge_stages(totals, stages):
+    """
+    Add one composite's stages to running totals
+    """
+    for s, counts in stages.items():
+        total = totals.setdefault(s, {'seconds': 0.0, 'tiles': 0, 'bytes': 0})
+        for k in total:
+            total[k] += counts[k]
+    return totals
+
+
+def summarize_stages(totals):
+    """
+    Get the tiles + MB per second of each stage's totals
+    """
+    summary = {}
+    for s, total in totals.items():
+        seconds = total['seconds']
+        summary[s] = dict(total,
+            tiles_per_second=total['tiles'] / seconds if seconds else None,
+            mb_per_second=total['bytes'] / 2 ** 20 / seconds if seconds else None)
+    return summary
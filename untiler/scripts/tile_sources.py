@@ -0,0 +1,379 @@
+from __future__ import division
+import contextlib
+import json
+import os
+import sqlite3
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from urllib.request import pathname2url, urlopen
+except ImportError:
+    from urllib import pathname2url
+    from urllib2 import urlopen
+
+import untiler.scripts.tile_utils as tile_utils
+import untiler.scripts.tile_index as tile_index
+import untiler.scripts.tile_fetch as tile_fetch
+
+
+class TileSource(object):
+    """
+    Somewhere tiles can be listed and read from by [z, x, y].
+    Sources are pickled to each worker process, so anything that
+    can't cross a process boundary (connections, open files) is
+    opened lazily and dropped on pickling. Forked workers inherit
+    the source without pickling, so per thread handles are kept
+    per process too (see thread_local). read may be called from
+    several threads of a worker at once
+    """
+    path = None
+    _handles = ()
+    _local = None
+    _pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in self._handles:
+            state[k] = None
+        state.pop('_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def thread_local(self):
+        """
+        Get the calling thread's handles, starting afresh in a process other than
+        the one they were opened in (eg a worker forked after tiles were listed)
+        """
+        with self._lock:
+            if self._local is None or self._pid != os.getpid():
+                self._local = threading.local()
+                self._pid = os.getpid()
+        return self._local
+
+    def list_tiles(self, minzoom=None, maxzoom=None, bounds=None):
+        """
+        Get the source's tiles as an int32 array of shape (n, 3). Zoom + bounds
+        are hints that sources may use to skip work; callers still filter
+        """
+        raise NotImplementedError
+
+    def read(self, z, x, y):
+        """
+        Get the encoded bytes of a tile
+        """
+        raise NotImplementedError
+
+    def get_stamps(self, tiles):
+        """
+        Get an int64 (mtime, size) per tile, to tell when tiles change between
+        runs, or None if the source can't tell
+        """
+        return None
+
+    def describe(self, z, x, y):
+        """
+        Describe a tile's location for logs + errors
+        """
+        return '%s:%s/%s/%s' % (self.path, z, x, y)
+
+
+class DirectorySource(TileSource):
+    """
+    Tiles in a directory laid out by a {z}/{x}/{y} read template,
+    optionally listed through a persistent tile index
+    """
+    def __init__(self, inputDir, read_template, index=None):
+        self.path = inputDir
+        self.read_template = read_template
+        self.index = index
+        self.template, self.readTemplate, self.separator = tile_utils.parse_template("%s/%s" % (inputDir, read_template))
+
+    def list_tiles(self, minzoom=None, maxzoom=None, bounds=None):
+        if self.index:
+            tiles, _, _ = tile_index.TileIndex(self.index).refresh(self.path, self.template)
+            return tiles
+
+        tiler = tile_utils.TileUtils()
+        allFiles = tiler.search_template(self.path, self.read_template, minzoom=minzoom, maxzoom=maxzoom, bounds=bounds)
+        return tiler.scan_tiles(allFiles, self.template, self.separator)
+
+    def read(self, z, x, y):
+        with open(self.readTemplate % (z, x, y), 'rb') as src:
+            return src.read()
+
+    def get_stamps(self, tiles):
+        """
+        Get each tile's (mtime, size) by stat-ing it. Even with a tile index
+        every tile is stat-ed: the index only relists directories whose mtime
+        changed, so it keeps the old stamps of tiles overwritten in place
+        """
+        def stat(t):
+            st = os.stat(self.readTemplate % tuple(int(i) for i in t))
+            return st.st_mtime_ns, st.st_size
+
+        with ThreadPoolExecutor(tile_utils.SCAN_THREADS) as executor:
+            return np.array(list(executor.map(stat, tiles)), dtype=np.int64).reshape(-1, 2)
+
+    def describe(self, z, x, y):
+        return self.readTemplate % (z, x, y)
+
+
+class MBTilesSource(TileSource):
+    """
+    Read tiles straight out of an MBTiles' tiles table. Connections are
+    opened read-only and lazily, one per thread of each worker process
+    """
+    _handles = ('_local',)
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self._local = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        local = self.thread_local()
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(self.path), uri=True)
+        return conn
+
+    def list_tiles(self, minzoom=None, maxzoom=None, bounds=None, chunksize=65536):
+        """
+        Get every [z, x, y] in the tiles table, flipping TMS rows to XYZ
+        """
+        cursor = self.connect().execute(
+            'SELECT zoom_level, tile_column, tile_row FROM tiles WHERE zoom_level BETWEEN ? AND ?',
+            (0 if minzoom is None else minzoom, 32 if maxzoom is None else maxzoom))
+
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.int32))
+
+        if not chunks:
+            return np.empty((0, 3), dtype=np.int32)
+
+        tiles = np.concatenate(chunks)
+        tiles[:, 2] = (2 ** tiles[:, 0].astype(np.int64) - 1 - tiles[:, 2]).astype(np.int32)
+
+        return tiles
+
+    def read(self, z, x, y):
+        row = self.connect().execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (z, x, 2 ** z - 1 - y)).fetchone()
+
+        if row is None:
+            raise IOError("No tile %s/%s/%s in %s" % (z, x, y, self.path))
+
+        return bytes(row[0])
+
+    def get_stamps(self, tiles):
+        """
+        MBTiles don't record when tiles changed: stamp each with its size
+        """
+        rows = np.array(self.connect().execute(
+            'SELECT zoom_level, tile_column, tile_row, length(tile_data) FROM tiles').fetchall(), dtype=np.int64).reshape(-1, 4)
+        rows[:, 2] = 2 ** rows[:, 0] - 1 - rows[:, 2]
+
+        found = tile_utils.TileUtils().find_tiles(rows[:, :3], tiles)
+        if np.any(found < 0):
+            raise IOError("Tiles are missing from %s" % (self.path))
+
+        return np.column_stack((np.zeros(len(found), dtype=np.int64), rows[found, 3]))
+
+
+class TarSource(TileSource):
+    """
+    Tiles inside an uncompressed tar archive, matched against a read template.
+    A member offset table is built once when the tiles are listed; reads are
+    positioned reads (pread) on a per-process file handle, so threads can share it
+    """
+    _handles = ('_fh',)
+
+    def __init__(self, path, read_template):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.read_template = read_template
+        self.template, _, self.separator = tile_utils.parse_template(read_template)
+        self.keys = None
+        self.offsets = None
+        self.sizes = None
+        self.mtimes = None
+        self._fh = None
+        self._lock = threading.Lock()
+
+    def build_index(self):
+        """
+        Scan the archive's headers once, recording the data offset + size of
+        every member that matches the read template
+        """
+        tiler = tile_utils.TileUtils()
+        parser = tiler.get_tile_parser(r"(?:.*/)?" + self.template)
+
+        tiles, offsets, sizes, mtimes = [], [], [], []
+
+        try:
+            with self.open_archive() as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    match = parser.match(member.name)
+                    if match:
+                        tiles.append([int(i) for i in match.groups()[-3:]])
+                        offsets.append(member.offset_data)
+                        sizes.append(member.size)
+                        mtimes.append(int(member.mtime))
+        except tarfile.ReadError:
+            raise ValueError("%s is not an uncompressed tar archive" % (self.path))
+
+        tiles = np.array(tiles, dtype=np.int32).reshape(-1, 3)
+        keys = tiler.pack_tiles(tiles)
+        order = np.argsort(keys, kind='stable')
+
+        self.keys = keys[order]
+        self.offsets = np.array(offsets, dtype=np.int64)[order]
+        self.sizes = np.array(sizes, dtype=np.int64)[order]
+        self.mtimes = np.array(mtimes, dtype=np.int64)[order]
+
+        return tiles[order]
+
+    def open_archive(self):
+        return tarfile.open(self.path, mode='r:')
+
+    def list_tiles(self, minzoom=None, maxzoom=None, bounds=None):
+        return self.build_index()
+
+    def locate(self, z, x, y):
+        """
+        Get the (offset, size) of a tile's member data
+        """
+        with self._lock:
+            if self.keys is None:
+                self.build_index()
+
+        key = tile_utils.TileUtils().pack_tiles(np.array([[z, x, y]]))[0]
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise IOError("No tile %s/%s/%s in %s" % (z, x, y, self.path))
+
+        return int(self.offsets[i]), int(self.sizes[i])
+
+    def read(self, z, x, y):
+        offset, size = self.locate(z, x, y)
+        with self._lock:
+            if self._fh is None:
+                self._fh = open(self.path, 'rb')
+
+        return os.pread(self._fh.fileno(), size, offset)
+
+    def get_stamps(self, tiles):
+        """
+        Get each tile's member (mtime, size)
+        """
+        if self.keys is None:
+            self.build_index()
+
+        i = np.searchsorted(self.keys, tile_utils.TileUtils().pack_tiles(tiles))
+        return np.column_stack((self.mtimes[i], self.sizes[i]))
+
+
+class HTTPTarSource(TarSource):
+    """
+    An uncompressed tar archive behind an HTTP / S3-compatible endpoint. The
+    member offset table is built from one streamed pass over the archive, and
+    each tile is fetched with a range request for its member's data
+    """
+    _handles = ('_local',)
+
+    def __init__(self, url, read_template, concurrency=16, retries=3):
+        TarSource.__init__(self, url, read_template)
+        self.path = url
+        self.concurrency = concurrency
+        self.retries = retries
+        self._local = None
+
+    @contextlib.contextmanager
+    def open_archive(self):
+        with contextlib.closing(urlopen(self.path)) as response:
+            with tarfile.open(fileobj=response, mode='r|') as tar:
+                yield tar
+
+    def fetcher(self):
+        return get_fetcher(self)
+
+    def fetch_many(self, tiles):
+        """
+        Stream the encoded bytes of many tiles back in order, fetching up to
+        concurrency member ranges at once
+        """
+        return self.fetcher().iter_fetch([(self.path, self.locate(z, x, y)) for z, x, y in tiles])
+
+    def read(self, z, x, y):
+        return self.fetcher().get(self.path, self.locate(z, x, y))
+
+
+class HTTPSource(TileSource):
+    """
+    Tiles behind an HTTP / S3-compatible endpoint, at a {z}/{x}/{y} url
+    template. Endpoints can't be listed, so tiles come from a tile list file
+    of [x, y, z] lines, as written by inspectdir. Workers fetch each
+    composite's tiles concurrently with tile_fetch.AsyncFetcher, one per
+    thread of each worker process, kept (with its connections) between reads
+    """
+    _handles = ('_local',)
+
+    def __init__(self, url_template, tile_list, concurrency=16, retries=3):
+        if not all(k in url_template for k in ('{z}', '{x}', '{y}')):
+            raise ValueError('Invalid url template "%s"' % (url_template))
+        self.path = url_template
+        self.tile_list = tile_list
+        self.concurrency = concurrency
+        self.retries = retries
+        self._local = None
+        self._lock = threading.Lock()
+
+    def url(self, z, x, y):
+        return self.path.replace('{z}', str(z)).replace('{x}', str(x)).replace('{y}', str(y))
+
+    def list_tiles(self, minzoom=None, maxzoom=None, bounds=None):
+        with open(self.tile_list) as src:
+            tiles = [json.loads(line) for line in src if line.strip()]
+
+        return np.array([[z, x, y] for x, y, z in tiles], dtype=np.int32).reshape(-1, 3)
+
+    def fetcher(self):
+        return get_fetcher(self)
+
+    def fetch_many(self, tiles):
+        """
+        Stream the encoded bytes of many tiles back in order, fetching up to
+        concurrency of them at once
+        """
+        return self.fetcher().iter_fetch([self.url(z, x, y) for z, x, y in tiles])
+
+    def read(self, z, x, y):
+        return self.fetcher().get(self.url(z, x, y))
+
+    def describe(self, z, x, y):
+        return self.url(z, x, y)
+
+
+def get_fetcher(source):
+    """
+    Get the calling thread's tile_fetch.AsyncFetcher for a source fetched over
+    HTTP, kept (with its connections) between reads
+    """
+    local = source.thread_local()
+    fetcher = getattr(local, 'fetcher', None)
+    if fetcher is None:
+        fetcher = local.fetcher = tile_fetch.AsyncFetcher(source.concurrency, source.retries)
+    return fetcher
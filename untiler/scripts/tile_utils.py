@@ -1,26 +1,139 @@
 from __future__ import division
+import hashlib
+import json
 import numpy as np
 import re
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
 
+import mercantile as merc
+
+## number of threads used to list directories during tile discovery
+SCAN_THREADS = 8
+
+## the latitude Web Mercator (and so its tiles) stops at
+MAX_LATITUDE = 85.0511287798066
+
+## seconds per tile read + decode, and per zMax cell (tile sized block) of output,
+## used to predict how long a composite takes
+COST_WEIGHTS = {'read': 0.002, 'cell': 0.005}
+
+
+def list_dir(path):
+    """
+    List a directory's files and (non-symlinked) subdirectories, like one step of os.walk
+    """
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                else:
+                    files.append(entry.path)
+    except OSError:
+        pass
+
+    return files, dirs
+
+
 class TileUtils:
-    def search_dir(self, directory):
-        for dp, dn, fn in os.walk(os.path.expanduser(directory)):
-            for f in fn:
-                yield os.path.join(dp, f)
+    def walk_dirs(self, root, visit, threads=SCAN_THREADS):
+        """
+        Breadth-first walk from root, calling visit(path, depth) for each directory
+        on a thread pool. visit returns (files, subdirectories to descend into);
+        files are yielded as soon as their directory has been listed
+        """
+        with ThreadPoolExecutor(threads) as executor:
+            pending = {executor.submit(visit, root, 0)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirs = future.result()
+                    for d, depth in subdirs:
+                        pending.add(executor.submit(visit, d, depth))
+                    for f in files:
+                        yield f
+
+    def search_dir(self, directory, threads=SCAN_THREADS):
+        """
+        Yield every file beneath a directory
+        """
+        def visit(path, depth):
+            files, dirs = list_dir(path)
+            return files, [(d, depth + 1) for d in dirs]
+
+        return self.walk_dirs(os.path.expanduser(directory), visit, threads)
+
+    def search_template(self, directory, read_template, minzoom=None, maxzoom=None, bounds=None, threads=SCAN_THREADS):
+        """
+        Yield the files beneath a directory that a read template could match.
+        For .../{z}/{x}/{y}.ext layouts, zoom directories outside of min / max zoom
+        and x directories outside of bounds are pruned without being listed;
+        other layouts fall back to search_dir
+        """
+        parts = read_template.split('/')
+
+        if len(parts) < 3 or parts[-3:-1] != ['{z}', '{x}'] or not parts[-1].startswith('{y}') or '{' in ''.join(parts[:-3]):
+            return self.search_dir(directory, threads)
+
+        def keep_zoom(z):
+            return (minzoom is None or z >= minzoom) and (maxzoom is None or z <= maxzoom)
+
+        def visit(path, depth):
+            files, dirs = list_dir(path)
+            if depth == 0:
+                dirs = [d for d in dirs if os.path.basename(d).isdigit() and keep_zoom(int(os.path.basename(d)))]
+                return [], [(d, 1) for d in dirs]
+            elif depth == 1:
+                dirs = [d for d in dirs if os.path.basename(d).isdigit()]
+                if bounds is not None:
+                    minX, _, maxX, _ = get_bounds_range(bounds, int(os.path.basename(path)))
+                    dirs = [d for d in dirs if minX <= int(os.path.basename(d)) <= maxX]
+                return [], [(d, 2) for d in dirs]
+            else:
+                return files, []
+
+        return self.walk_dirs(os.path.join(os.path.expanduser(directory), *parts[:-3]), visit, threads)
+
+    def get_tile_parser(self, template):
+        """
+        Compile a match template (from parse_template) into one regex
+        that validates a pathname and captures its Z X Y
+        """
+        return re.compile(template.replace(r"\d+", r"(\d+)"))
 
     def get_tiles(self, filenames, template, separator):
         """
         Given a list of tar pathnames + templates, parse Z X Ys
         """
-        validtile = re.compile(template)
+        parser = self.get_tile_parser(template)
+        for f in filenames:
+            match = parser.match(f)
+            if match:
+                yield [int(i) for i in match.groups()[-3:]]
+
+    def scan_tiles(self, filenames, template, separator, chunksize=65536):
+        """
+        Given an iterable of pathnames + templates, parse Z X Ys
+        into an int32 array of shape (n, 3) without building
+        intermediate lists
+        """
+        parser = self.get_tile_parser(template)
+        tiles = np.empty((chunksize, 3), dtype=np.int32)
+        n = 0
+
         for f in filenames:
-            if validtile.match(f):
-                matchstring = r"\d+%s\d+%s\d+" % (separator, separator)
-                yield [
-                    int(i) for i in re.compile(matchstring).findall(f)[-1].split(separator)
-                ]
+            match = parser.match(f)
+            if match:
+                if n == tiles.shape[0]:
+                    tiles = np.concatenate([tiles, np.empty_like(tiles)])
+                tiles[n] = match.groups()[-3:]
+                n += 1
+
+        return tiles[:n].copy()
 
     def select_tiles(self, tiles, zoom):
         """
@@ -98,11 +211,101 @@ class TileUtils:
         else:
             return subTiles[np.where(subTiles[:, 0] == subTileMax)], False
 
-    def get_sub_tiles(self, subTiles, superTiles):
-        for t in self.get_unique_tiles(superTiles):
-            z, x, y = t
-            zMaxTiles, maxCovTiles = self.get_zoom_tiles(subTiles, superTiles, t)
-            
+    def pack_tiles(self, tiles):
+        """
+        Pack an array of [z, x, y] tiles into int64 keys that sort in (z, x, y) order
+        """
+        tiles = np.asarray(tiles, dtype=np.int64)
+        return (tiles[:, 0] << 58) | (tiles[:, 1] << 29) | tiles[:, 2]
+
+    def get_tile_runs(self, subTiles, superTiles):
+        """
+        Sort sub tiles by (super tile, zoom) in a single pass.
+        Returns the sorted sub and super tiles, and the start / end
+        of each run of tiles sharing a super tile and zoom
+        """
+        if subTiles.shape != superTiles.shape:
+            raise ValueError("Input sub and super tiles must have the same shape")
+
+        superKeys = self.pack_tiles(superTiles)
+        order = np.lexsort((subTiles[:, 0], superKeys))
+
+        subTiles, superTiles, superKeys = subTiles[order], superTiles[order], superKeys[order]
+        zooms = subTiles[:, 0]
+
+        breaks = np.flatnonzero((superKeys[1:] != superKeys[:-1]) | (zooms[1:] != zooms[:-1])) + 1
+        runStarts = np.concatenate(([0], breaks)).astype(np.int64)
+        runEnds = np.concatenate((breaks, [len(subTiles)])).astype(np.int64)
+
+        return subTiles, superTiles, runStarts, runEnds
+
+    def get_sub_tiles(self, subTiles, superTiles, tilefloor=15, runs=None):
+        """
+        Given an array of [z, x, y] sub tiles and their matching super tiles,
+        yield one composite job per unique super tile (in (z, x, y) order)
+        with its zMax and zMaxCov tiles. Equivalent to calling get_zoom_tiles
+        for each unique super tile, but plans every super tile from one sort.
+        Jobs also carry fillTiles: every tile from the finest complete level
+        (whatever the floor, as anything coarser is hidden beneath it; or the
+        coarsest level if none is complete) up to (but not including) zMax,
+        coarsest first, for a cascading fill. Every tile array
+        is a view into the sub tiles sorted by get_tile_runs, and its (start, stop)
+        within them is kept in the job's slices. Tiles already sorted by
+        get_tile_runs can be passed with their (runStarts, runEnds) as runs,
+        so they aren't sorted again
+        """
+        if subTiles.shape[0] == 0:
+            return
+
+        if runs is None:
+            subTiles, superTiles, runStarts, runEnds = self.get_tile_runs(subTiles, superTiles)
+        else:
+            runStarts, runEnds = runs
+
+        runKeys = self.pack_tiles(superTiles[runStarts])
+        groupBreaks = np.flatnonzero(runKeys[1:] != runKeys[:-1]) + 1
+        groupStarts = np.concatenate(([0], groupBreaks))
+        groupEnds = np.concatenate((groupBreaks, [len(runStarts)]))
+
+        for gs, ge in zip(groupStarts, groupEnds):
+            starts, ends = runStarts[gs:ge], runEnds[gs:ge]
+            z, x, y = superTiles[starts[0]]
+
+            runZooms = subTiles[starts, 0]
+            subTileMin, subTileMax = runZooms[0], runZooms[-1]
+
+            if subTileMax < tilefloor:
+                raise ValueError("No tiles found below that floor")
+
+            counts = dict(zip(runZooms.tolist(), (ends - starts).tolist()))
+
+            for zMaxCov in range(subTileMax, max([subTileMin - 1, tilefloor - 1]), -1):
+                if 4 ** (zMaxCov - z) == counts.get(zMaxCov, 0):
+                    break
+
+            slices = {'zMaxTiles': (int(starts[-1]), int(ends[-1]))}
+
+            fillZoom = subTileMin
+            for fz in range(subTileMax, subTileMin - 1, -1):
+                if 4 ** (fz - z) == counts.get(fz, 0):
+                    fillZoom = fz
+                    break
+
+            r = np.searchsorted(runZooms, fillZoom)
+            slices['fillTiles'] = (int(starts[r]), int(ends[-2])) if r < len(starts) - 1 else (0, 0)
+
+            if subTileMax != zMaxCov and zMaxCov in counts:
+                r = np.searchsorted(runZooms, zMaxCov)
+                slices['maxCovTiles'] = (int(starts[r]), int(ends[r]))
+            elif subTileMax != zMaxCov:
+                slices['maxCovTiles'] = (0, 0)
+            else:
+                slices['maxCovTiles'] = None
+
+            zMaxTiles, fillTiles, maxCovTiles = [
+                False if slices[k] is None else subTiles[slices[k][0]:slices[k][1]]
+                for k in ('zMaxTiles', 'fillTiles', 'maxCovTiles')]
+
             if not np.any(maxCovTiles):
                 zMaxCov = False
             else:
@@ -113,18 +316,273 @@ class TileUtils:
                 'maxCovTiles': maxCovTiles,
                 'zMax': zMaxTiles[0][0],
                 'zMaxCov': zMaxCov,
+                'fillTiles': fillTiles,
+                'ancestorTiles': subTiles[:0],
+                'slices': slices,
                 'x': x,
                 'y': y,
                 'z': z
             })
 
+    def get_job_payload(self, job):
+        """
+        Strip a job's tile arrays down to their slices of the sorted sub tiles
+        (see get_sub_tiles), so sending it to a worker costs a few bytes however
+        many tiles it has. Workers rebuild it with load_job
+        """
+        payload = dict((k, v) for k, v in job.items() if k not in ('zMaxTiles', 'maxCovTiles', 'fillTiles', 'ancestorTiles'))
+        payload['ancestorTiles'] = np.asarray(job.get('ancestorTiles', []), dtype=np.int32).reshape(-1, 3).tolist()
+        for k in ('z', 'x', 'y', 'zMax'):
+            payload[k] = int(job[k])
+        payload['zMaxCov'] = int(job['zMaxCov']) if job['zMaxCov'] is not False else False
+        return payload
+
+    def load_job(self, payload, tiles):
+        """
+        Rebuild a job from its payload and the sorted sub tiles
+        """
+        job = OrderedDict(payload)
+        slices = payload['slices']
+        ancestorTiles = np.array(payload['ancestorTiles'], dtype=np.int32).reshape(-1, 3)
+
+        for k in ('zMaxTiles', 'fillTiles', 'maxCovTiles'):
+            job[k] = False if slices[k] is None else tiles[slices[k][0]:slices[k][1]]
+
+        job['ancestorTiles'] = ancestorTiles
+        if len(ancestorTiles):
+            job['fillTiles'] = np.concatenate((ancestorTiles, job['fillTiles']))
+
+        return job
+
+    def is_covered(self, job):
+        """
+        Whether a job's own tiles cover its whole composite at some level, so
+        nothing above the composite zoom would show through
+        """
+        z = int(job['z'])
+        fillTiles = np.asarray(job['fillTiles']).reshape(-1, 3)
+        if len(fillTiles):
+            fillZoom = int(fillTiles[0][0])
+            return np.count_nonzero(fillTiles[:, 0] == fillZoom) == 4 ** (fillZoom - z)
+        return len(job['zMaxTiles']) == 4 ** (int(job['zMax']) - z)
+
+    def get_ancestor_fill(self, jobs, ancestorTiles):
+        """
+        Prepend the finest of the ancestorTiles (tiles above the composite zoom)
+        containing each job's composite to its fillTiles, where the composite's
+        own tiles leave gaps. Coarser ancestors would be hidden beneath it, and
+        a covered composite never shows any, so neither is read
+        """
+        keys = np.sort(self.pack_tiles(ancestorTiles))
+        zooms = np.unique(ancestorTiles[:, 0])
+
+        for job in jobs:
+            if not self.is_covered(job):
+                z, x, y = int(job['z']), int(job['x']), int(job['y'])
+                parents = np.array([[pz, x >> (z - pz), y >> (z - pz)] for pz in zooms if pz < z], dtype=np.int32).reshape(-1, 3)
+                parentKeys = self.pack_tiles(parents)
+                found = parents[keys[np.minimum(np.searchsorted(keys, parentKeys), len(keys) - 1)] == parentKeys]
+
+                if len(found):
+                    job['ancestorTiles'] = found[-1:]
+                    job['fillTiles'] = np.concatenate((found[-1:], job['fillTiles']))
+
+            yield job
+
+    def get_job_features(self, job):
+        """
+        Get the (tile reads, output cells) a composite job's cost is predicted from
+        """
+        reads = len(job['zMaxTiles']) + len(job.get('fillTiles', []))
+        cells = 4 ** (int(job['zMax']) - int(job['z']))
+        return reads, cells
+
+    def get_job_hash(self, job, settings=None):
+        """
+        Hash the tiles a composite job reads (in any order), and any settings its
+        output depends on, to tell whether a finished composite's inputs changed since
+        """
+        digest = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+        digest.update(str(int(job['zMax'])).encode('utf-8'))
+        for k in ('zMaxTiles', 'fillTiles'):
+            tiles = job.get(k)
+            tiles = np.asarray(tiles if tiles is not None and tiles is not False else [], dtype=np.int64).reshape(-1, 3)
+            digest.update(np.ascontiguousarray(tiles[np.lexsort(tiles.T[::-1])]).tobytes())
+            digest.update(b'|')
+        return digest.hexdigest()
+
+    def estimate_cost(self, job, weights=COST_WEIGHTS):
+        """
+        Predict a composite job's run time in seconds from its tile reads
+        (zMax + fill tiles) and its output size (its zMax - z zoom difference)
+        """
+        reads, cells = self.get_job_features(job)
+        return weights['read'] * reads + weights['cell'] * cells
+
+    def order_by_cost(self, batches, costs):
+        """
+        Order batches longest first so no worker is left with a giant composite
+        at the end. Costs are bucketed by powers of two and the sort is stable,
+        so batches of a similar cost keep their (curve) order
+        """
+        buckets = np.floor(np.log2(np.maximum(np.asarray(costs, dtype=np.float64), 1e-9)))
+        return [batches[i] for i in np.argsort(-buckets, kind='stable')]
+
+    def order_jobs(self, jobs, curve='hilbert'):
+        """
+        Order composite jobs along a space filling curve ('hilbert' or 'morton')
+        of their x / y, so consecutive jobs are spatial neighbours. 'zxy' keeps
+        the (z, x, y) planning order
+        """
+        jobs = list(jobs)
+
+        if curve == 'zxy' or len(jobs) < 2:
+            return jobs
+
+        composites = np.array([[job['z'], job['x'], job['y']] for job in jobs], dtype=np.int64)
+        order = int(composites[:, 0].max())
+
+        if curve == 'hilbert':
+            keys = hilbert_keys(composites[:, 1], composites[:, 2], order)
+        elif curve == 'morton':
+            keys = morton_keys(composites[:, 1], composites[:, 2], order)
+        else:
+            raise ValueError("Unknown job order %s" % (curve))
+
+        return [jobs[i] for i in np.lexsort((keys, composites[:, 0]))]
+
+    def get_fill_batches(self, jobs, workers=1):
+        """
+        Group composite jobs that fill from the same ancestor tile (see
+        get_ancestor_fill) into batches, in order of each batch's first job.
+        Jobs with nothing to share are batches of one. Batches are capped at
+        len(jobs) // workers jobs, so one ancestor over every composite
+        still makes at least a task per worker
+        """
+        jobs = list(jobs)
+        batchMax = max(1, len(jobs) // workers)
+        batches = OrderedDict()
+
+        for i, job in enumerate(jobs):
+            key = i
+            ancestorTiles = job.get('ancestorTiles', [])
+            if len(ancestorTiles):
+                key = tuple(int(v) for v in ancestorTiles[-1])
+            batches.setdefault(key, []).append(job)
+
+        return [batch[i:i + batchMax] for batch in batches.values() for i in range(0, len(batch), batchMax)]
+
     def filter_tiles(self, tiles, zoomfloor):
         return tiles[np.where(tiles[:, 0] <= zoomfloor)]
 
+    def filter_bounds(self, tiles, bounds):
+        """
+        Select the tiles that intersect (west, south, east, north) bounds
+        """
+        keep = np.zeros(tiles.shape[0], dtype=bool)
+        for z in np.unique(tiles[:, 0]):
+            minX, minY, maxX, maxY = get_bounds_range(bounds, int(z))
+            keep |= ((tiles[:, 0] == z) &
+                (tiles[:, 1] >= minX) & (tiles[:, 1] <= maxX) &
+                (tiles[:, 2] >= minY) & (tiles[:, 2] <= maxY))
+
+        return tiles[keep]
+
+    def count_tiles(self, tiles, queryTiles):
+        """
+        Count the occurrences of each [z, x, y] in queryTiles within tiles
+        """
+        keys = np.sort(self.pack_tiles(tiles))
+        queryKeys = self.pack_tiles(queryTiles)
+        return np.searchsorted(keys, queryKeys, side='right') - np.searchsorted(keys, queryKeys, side='left')
+
+    def find_tiles(self, tiles, queryTiles):
+        """
+        Find the index of each [z, x, y] in queryTiles within tiles, or -1 where it's missing
+        """
+        keys = self.pack_tiles(np.asarray(tiles).reshape(-1, 3))
+        queryKeys = self.pack_tiles(np.asarray(queryTiles).reshape(-1, 3))
+        if len(keys) == 0:
+            return np.full(len(queryKeys), -1, dtype=np.int64)
+
+        order = np.argsort(keys, kind='stable')
+        found = order[np.minimum(np.searchsorted(keys, queryKeys, sorter=order), len(keys) - 1)]
+        return np.where(keys[found] == queryKeys, found, -1)
+
+    def get_changed_tiles(self, oldTiles, oldStamps, tiles, stamps):
+        """
+        Diff two inventories of [z, x, y] tiles and their (mtime, size) stamps.
+        Returns the added, removed and changed tiles
+        """
+        found = self.find_tiles(oldTiles, tiles)
+        kept = found >= 0
+        changed = np.any(np.asarray(stamps)[kept] != np.asarray(oldStamps)[found[kept]], axis=1)
+        removed = self.find_tiles(tiles, oldTiles) < 0
+
+        return tiles[~kept], oldTiles[removed], tiles[kept][changed]
+
+    def get_affected_jobs(self, jobs, changedTiles, zoom, removedTiles=None):
+        """
+        Select the composite jobs at zoom that changed tiles touch: the super
+        tiles of changed (or removed) tiles at or below zoom, the composites
+        that fill from a changed tile above zoom, and the uncovered composites
+        that filled from a removed one (it was finer than what they fill from now)
+        """
+        changedTiles = np.asarray(changedTiles, dtype=np.int64).reshape(-1, 3)
+        removedTiles = np.asarray(removedTiles if removedTiles is not None else [], dtype=np.int64).reshape(-1, 3)
+        jobTiles = np.array([[int(j['z']), int(j['x']), int(j['y'])] for j in jobs], dtype=np.int64).reshape(-1, 3)
+
+        below = np.concatenate((changedTiles[changedTiles[:, 0] >= zoom], removedTiles[removedTiles[:, 0] >= zoom]))
+        affected = np.zeros(len(jobTiles), dtype=bool)
+        if len(below):
+            affected |= self.count_tiles(self.get_super_tiles(below, zoom), jobTiles) > 0
+
+        ## a job holds (at most) the one ancestor its fill paints from
+        ancestors = np.full((len(jobTiles), 3), -1, dtype=np.int64)
+        for i, job in enumerate(jobs):
+            ancestorTiles = np.asarray(job.get('ancestorTiles', []), dtype=np.int64).reshape(-1, 3)
+            if len(ancestorTiles):
+                ancestors[i] = ancestorTiles[-1]
+
+        above = changedTiles[changedTiles[:, 0] < zoom]
+        if len(above):
+            affected |= self.count_tiles(above, ancestors) > 0
+
+        removed = removedTiles[removedTiles[:, 0] < zoom]
+        if len(removed):
+            uncovered = np.array([not self.is_covered(j) for j in jobs], dtype=bool)
+            for z in np.unique(removed[:, 0]):
+                parents = jobTiles >> int(zoom - z)
+                parents[:, 0] = z
+                affected |= uncovered & (ancestors[:, 0] < z) & (self.count_tiles(removed[removed[:, 0] == z], parents) > 0)
+
+        return [j for j, a in zip(jobs, affected) if a]
+
+    def get_emptied_composites(self, jobs, removedTiles, zoom):
+        """
+        Get the [z, x, y]s of the composites at zoom that removed tiles were
+        beneath, that have no tiles left (so no job), and whose scenetifs are stale
+        """
+        removedTiles = np.asarray(removedTiles, dtype=np.int64).reshape(-1, 3)
+        removedTiles = removedTiles[removedTiles[:, 0] >= zoom]
+        if len(removedTiles) == 0:
+            return removedTiles
+
+        composites = self.get_unique_tiles(self.get_super_tiles(removedTiles, zoom))
+        jobTiles = np.array([[int(j['z']), int(j['x']), int(j['y'])] for j in jobs], dtype=np.int64).reshape(-1, 3)
+        return composites[self.find_tiles(jobTiles, composites) < 0]
+
     def get_fill_super_tiles(self, superTiles, fillTiles, fillThresh):
-        for ct in ((np.all(superTiles == a, axis=1).sum(), a) for a in fillTiles):
-            if ct[0] != fillThresh or ct[0] == 0:
-                yield ct[1]
+        """
+        Yield the fill tiles that are not completely covered, eg
+        that don't have fillThresh sub tiles beneath them
+        """
+        if len(fillTiles) == 0:
+            return
+
+        for count, a in zip(self.count_tiles(superTiles, fillTiles), fillTiles):
+            if count != fillThresh or count == 0:
+                yield a
 
     def get_sub_base_zoom(self, px, py, pz, z):
         if z < pz:
@@ -133,6 +591,54 @@ class TileUtils:
         return (px * mult, py * mult)
 
 
+def morton_keys(x, y, order):
+    """
+    Morton (z-order) curve positions of x / y arrays on a 2 ** order grid
+    """
+    x, y = np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64)
+    keys = np.zeros(x.shape, dtype=np.int64)
+    for b in range(order):
+        keys |= ((x >> b) & 1) << (2 * b) | ((y >> b) & 1) << (2 * b + 1)
+    return keys
+
+
+def hilbert_keys(x, y, order):
+    """
+    Hilbert curve positions of x / y arrays on a 2 ** order grid
+    """
+    x, y = np.array(x, dtype=np.int64), np.array(y, dtype=np.int64)
+    keys = np.zeros(x.shape, dtype=np.int64)
+    last = (1 << order) - 1
+    s = 1 << max(order - 1, 0)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        ## rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x[flip], y[flip] = last - x[flip], last - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= 1
+    return keys
+
+
+def get_bounds_range(bounds, zoom):
+    """
+    Get the min / max X and Y of the tiles at a zoom that intersect (west, south, east, north) bounds.
+    Bounds past the edges of Web Mercator (eg the whole world's -180 -90 180 90) are clamped to them
+    """
+    west, south, east, north = bounds
+    west, east = max(west, -180.0), min(east, 180.0)
+    south, north = max(south, -MAX_LATITUDE), min(north, MAX_LATITUDE)
+    eps = 1e-9
+    ul = merc.tile(west, north, zoom)
+    lr = merc.tile(max(west, east - eps), min(north, south + eps), zoom)
+    last = 2 ** zoom - 1
+    return (min(max(ul.x, 0), last), min(max(ul.y, 0), last),
+        min(max(lr.x, 0), last), min(max(lr.y, 0), last))
+
+
 def parse_template(template):
     """
     Parse and verify a pathname template